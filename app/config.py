@@ -14,18 +14,77 @@ class Settings(BaseSettings):
     # === MonoPay
     MONOPAY_TOKEN: str = ""                 # X-Token мерчанта
     MONOPAY_WEBHOOK_PATH: str = "/monopay"  # путь вебхука
+    MONO_KEY_REFRESH_MIN_SEC: float = 300.0 # не перечитувати pubkey частіше (захист від флуду битих підписів)
     # Минимальный вывод в «монетах»/поинтах бот
+    MIN_WITHDRAW_QC: int = 10000
+
+    # === Інвойси активації
+    INVOICE_TTL_SEC: int = 86400               # термін життя інвойсу у провайдера
+    INVOICE_REFRESH_MARGIN_SEC: int = 3600     # інвойс, що спливає раніше, вже не показуємо
+    INVOICE_PREWARM_INTERVAL_SEC: int = 300    # 0 — вимкнути фонове створення
+    INVOICE_PREWARM_BATCH: int = 20
+    INVOICE_PREWARM_MAX_AGE_DAYS: int = 7      # не гріємо тих, хто вибрав мову давно й не платить
 
     # === CryptoBot
     CRYPTO_PAY_TOKEN: str = ""                 # токен из @CryptoBot
     CRYPTO_WEBHOOK_PATH: str = "/cryptobot"    # путь вебхука
+    CRYPTO_RECONCILE_INTERVAL_SEC: int = 60    # звірка відкритих інвойсів через getInvoices; 0 — вимкнути
+    CRYPTO_RECONCILE_PAGE: int = 100
+
+    # === HTTP-клієнти провайдерів (спільні, keep-alive)
+    HTTP_TIMEOUT: float = 30.0
+    HTTP_CONNECT_TIMEOUT: float = 10.0
+    HTTP_POOL_SIZE: int = 20
 
     TEST_MODE: bool = False
     WEBHOOK_URL: str | None = None
     WEBHOOK_PATH: str = "/webhook"
     TZ_KYIV: str = "Europe/Kyiv"
+
+    # === Вебхук: швидкий ACK + черга з воркерами (шардинг по from_user.id)
+    WEBHOOK_ASYNC: bool = False
+    UPDATE_WORKERS: int = 8
+    UPDATE_QUEUE_SIZE: int = 2000          # сумарно на всі шарди; переповнення -> 503
+    STATS_TOKEN: str = ""                  # GET /stats?token=...; порожньо — /stats віддає 403
     REF_BONUS_QC: int = 120
 
+    # === Кеш юзерів (LRU + TTL, див. tasks_service)
+    USER_CACHE_SIZE: int = 5000
+    USER_CACHE_TTL: float = 60.0
+
+    # === Перевірка підписки (getChatMember)
+    MEMBER_CACHE_TTL_OK: float = 120.0   # «підписаний» кешуємо довше
+    MEMBER_CACHE_TTL_NO: float = 10.0    # «не підписаний» — коротко, юзер міг щойно вступити
+    MEMBER_CHECK_RPS: float = 20.0       # глобальний ліміт викликів getChatMember
+    MEMBER_CHECK_BURST: float = 20.0
+
+    # === Розсилки (services/broadcast.py)
+    BROADCAST_RPS: float = 25.0          # глобальний ліміт Telegram ~30 msg/s, лишаємо запас іншим відправкам
+    BROADCAST_CONCURRENCY: int = 10
+    BROADCAST_CHUNK: int = 200           # одержувачів між чекпойнтами
+
+    # === Статистика адмінки (stats_counters)
+    STATS_RESYNC_INTERVAL_SEC: int = 3600  # повний перерахунок проти дрейфу; 0 — лише один на старті
+
+    # === Звірка балансів з журналом (services/reconcile.py)
+    RECONCILE_INTERVAL_SEC: int = 86400    # як часто запускати фоном (одна репліка); 0 — тільки CLI
+    RECONCILE_BATCH: int = 500             # юзерів за один запит
+    RECONCILE_DUTY: float = 0.2            # частка часу, яку звірка займає БД (решта — пауза між пачками)
+
+    # === Сповіщення адмінів про заявки на вивід (services/admin_notify.py)
+    ADMIN_NOTIFY_MAX_PER_MIN: int = 10     # більше — замість окремих повідомлень зведення
+    ADMIN_NOTIFY_DIGEST_SEC: float = 60.0  # як часто слати зведення
+
+    # === Автовиплати схвалених заявок (services/payouts.py)
+    PAYOUT_PROVIDER: str = ""              # "cryptobot" | "fake"; порожньо — виплати вручну і без кнопки @CryptoBot
+    PAYOUT_ASSET: str = "USDT"
+    PAYOUT_QC_RATE: float = 0.005          # одиниць PAYOUT_ASSET за 1 QC
+    PAYOUT_BATCH: int = 50                 # заявок за одну пачку
+    PAYOUT_CONCURRENCY: int = 5            # одночасних переказів
+    PAYOUT_INTERVAL_SEC: float = 30.0      # пауза, коли черга порожня
+    PAYOUT_MAX_ATTEMPTS: int = 5           # далі — unknown: заявка лишається paying до `payouts resolve`
+    PAYOUT_FAKE_FAIL_RATE: float = 0.0     # fake-провайдер: частка штучних збоїв
+
 
     class Config:
         env_file = ".env"
@@ -3,7 +3,8 @@ import os
 import logging
 import random
 import asyncio
-from typing import Optional
+import uuid
+from typing import Optional, Callable
 
 import asyncpg
 
@@ -11,6 +12,12 @@ log = logging.getLogger("db")
 
 _pool: Optional[asyncpg.pool.Pool] = None
 
+# application_name соединений этого процесса: по нему реплика узнаёт свои же NOTIFY
+APP_NAME = f"qc-{os.getenv('RAILWAY_REPLICA_ID') or uuid.uuid4().hex[:8]}"[:63]
+
+# LISTEN/NOTIFY: канал -> колбэки (payload: str | None; None = «переподключились, пересинхронизируйся»)
+_listeners: dict[str, list[Callable]] = {}
+
 
 def _pool_sizes():
     # Мелкий пул, чтобы не упираться в лимиты Railway
@@ -58,6 +65,7 @@ async def connect() -> asyncpg.pool.Pool:
                 command_timeout=command_timeout,
                 init=_init_connection,  # пингуем соединения при выдаче
                 max_inactive_connection_lifetime=60,  # убираем подвисшие
+                server_settings={"application_name": APP_NAME},
             )
             log.info("DB pool created (min=%s, max=%s)", min_size, max_size)
             return _pool
@@ -106,3 +114,57 @@ async def fetchval(query: str, *args):
     async with _pool.acquire() as con:
         return await con.fetchval(query, *args)
 
+
+
+async def dedicated_connection() -> asyncpg.Connection:
+    """Окреме з'єднання поза пулом — для довгих курсорів/LISTEN, щоб не займати маленький пул."""
+    return await asyncpg.connect(
+        os.getenv("DATABASE_URL"), server_settings={"application_name": APP_NAME}
+    )
+
+
+async def notify(channel: str, payload: str = ""):
+    await execute("SELECT pg_notify($1, $2)", channel, payload)
+
+
+def on_notify(channel: str, callback: Callable):
+    """Регистрируем колбэк на канал. Вызывать до старта listener_loop()."""
+    _listeners.setdefault(channel, []).append(callback)
+
+
+def _dispatch(channel: str, payload: str | None):
+    for cb in _listeners.get(channel, ()):
+        try:
+            cb(payload)
+        except Exception as e:
+            log.warning("notify callback failed (%s): %s: %s", channel, type(e).__name__, e)
+
+
+async def listener_loop():
+    """
+    Отдельное соединение (НЕ из пула — LISTEN держит его навсегда) под все каналы из on_notify().
+    При обрыве переподключаемся и шлём колбэкам None: пока нас не было, уведомления могли потеряться.
+    """
+    dsn = os.getenv("DATABASE_URL")
+    delay = 0.5
+    while True:
+        con = None
+        try:
+            con = await asyncpg.connect(dsn)
+            lost = asyncio.Event()
+            con.add_termination_listener(lambda _c: lost.set())
+            for channel in _listeners:
+                await con.add_listener(channel, lambda _c, _pid, ch, payload: _dispatch(ch, payload))
+                _dispatch(channel, None)
+            log.info("DB listener started: %s", ", ".join(_listeners))
+            delay = 0.5
+            await lost.wait()
+            log.warning("DB listener connection lost")
+        except asyncio.CancelledError:
+            if con is not None and not con.is_closed():
+                await con.close()
+            raise
+        except Exception as e:
+            log.warning("DB listener failed: %s: %s", type(e).__name__, e)
+        await asyncio.sleep(delay + random.uniform(0, 0.4))
+        delay = min(delay * 2, 8.0)
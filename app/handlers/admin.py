@@ -1,3 +1,4 @@
+import html
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
@@ -6,38 +7,44 @@ from ..utils.i18n import i18n
 from ..utils.keyboards import admin_menu_kb
 from ..db import fetch, fetchrow, execute
 from ..services.tasks_service import get_or_create_chain
+from ..services import catalog, broadcast, segments, stats, withdrawals
+from ..services.referrals import top_referrers
 from ..utils.tg import replace_message
 
 router = Router()
 
+REFS_PAGE = 10
+WD_PAGE = 10
+WD_FIELD_MAX = 200
+
 def is_admin(uid: int) -> bool:
     return uid in settings.ADMIN_IDS
 
+def _lang(user) -> str:
+    # user — снимок из UserMiddleware (у админа строки в users может и не быть)
+    return (user and user["language"]) or "en"
+
 @router.message(Command("admin"))
-async def admin_entry(msg: Message):
+async def admin_entry(msg: Message, user=None):
     if not is_admin(msg.from_user.id):
         await msg.answer(i18n.t("en","admin_only"))
         return
-    lang = (await fetchrow("SELECT language FROM users WHERE tg_id=$1", msg.from_user.id))["language"] or "en"
+    lang = _lang(user)
     await msg.answer(i18n.t(lang,"admin_menu"), reply_markup=admin_menu_kb(i18n._texts[lang]))
 
 @router.callback_query(F.data.startswith("admin:"))
-async def admin_menu(cb: CallbackQuery):
+async def admin_menu(cb: CallbackQuery, user=None):
     if not is_admin(cb.from_user.id):
         await cb.answer("Nope")
         return
-    lang = (await fetchrow("SELECT language FROM users WHERE tg_id=$1", cb.from_user.id))["language"] or "en"
-    key = cb.data.split(":")[1]
+    lang = _lang(user)
+    parts = cb.data.split(":")
+    key = parts[1]
     if key=="stats":
-        users = await fetchrow("SELECT COUNT(*) c FROM users")
-        active = await fetchrow("SELECT COUNT(*) c FROM users WHERE status='active'")
-        sum_balance = await fetchrow("SELECT COALESCE(SUM(balance_qc),0) s FROM users")
-        sum_earned = await fetchrow("SELECT COALESCE(SUM(earned_total_qc),0) s FROM users")
-        payments = await fetchrow("SELECT COUNT(*) c FROM payments")
-        refs = await fetchrow("SELECT COUNT(*) c FROM referral_rewards")
-        await replace_message(cb.message, i18n.t(lang,"stats_text", users=users["c"], active=active["c"],
-                                           sum_balance=sum_balance["s"], sum_earned=sum_earned["s"],
-                                           payments=payments["c"], refs=refs["c"]))
+        st = await stats.get()
+        await replace_message(cb.message, i18n.t(lang,"stats_text", users=st["users_total"], active=st["users_active"],
+                                           sum_balance=st["balance_sum"], sum_earned=st["earned_sum"],
+                                           payments=st["payments_total"], refs=st["referrals_total"]))
     elif key=="tasks":
         # list chains
         chains = await fetch("SELECT * FROM chains ORDER BY id")
@@ -55,66 +62,169 @@ async def admin_menu(cb: CallbackQuery):
         await replace_message(cb.message, i18n.t(lang,"broadcast_enter"))
         router.broadcast_wait[cb.from_user.id] = True
     elif key=="withdraws":
-        rows = await fetch("SELECT * FROM withdrawals WHERE status='pending' ORDER BY id")
-        if not rows:
-            await replace_message(cb.message, i18n.t(lang,"withdraw_list") + " (0)")
+        await _withdrawals_page(cb.message, lang, "pending", 0)
+    elif key=="refs":
+        # admin:refs[:<activated>:<user_id>] — keyset-курсор следующей страницы
+        after = (int(parts[2]), int(parts[3])) if len(parts) == 4 else None
+        rows = await top_referrers(REFS_PAGE + 1, after)
+        page, more = rows[:REFS_PAGE], len(rows) > REFS_PAGE
+        if not page:
+            await replace_message(cb.message, i18n.t(lang,"refs_empty"), reply_markup=admin_menu_kb(i18n._texts[lang]))
             return
+        lines = [f"{r['tg_id']}: {r['invited']} / {r['activated']} / {r['invited_l2']} / {r['bonus_qc']}" for r in page]
         from aiogram.utils.keyboard import InlineKeyboardBuilder
         kb = InlineKeyboardBuilder()
-        parts = []
-        for r in rows:
-            parts.append(i18n.t(lang,"withdraw_card_admin", id=r["id"], user_id=r["user_id"], qc=r["amount_qc"],
-                                country=r["country"], method=r["method"], details=r["details"]))
-            kb.row(__import__('aiogram.types').types.InlineKeyboardButton(text=f"#{r['id']}", callback_data=f"w:{r['id']}"))
-        await replace_message(cb.message, "\n\n".join(parts), reply_markup=kb.as_markup())
+        nav = []
+        if after is not None:
+            nav.append(__import__('aiogram.types').types.InlineKeyboardButton(text=i18n.t(lang,"first_page"), callback_data="admin:refs"))
+        if more:
+            last = page[-1]
+            nav.append(__import__('aiogram.types').types.InlineKeyboardButton(text=i18n.t(lang,"next_page"), callback_data=f"admin:refs:{last['activated']}:{last['user_id']}"))
+        if nav:
+            kb.row(*nav)
+        kb.row(__import__('aiogram.types').types.InlineKeyboardButton(text=i18n.t(lang,"back"), callback_data="admin:menu"))
+        await replace_message(cb.message, i18n.t(lang,"refs_top") + "\n\n" + "\n".join(lines), reply_markup=kb.as_markup())
     elif key=="menu":
         await replace_message(cb.message, i18n.t(lang,"admin_menu"), reply_markup=admin_menu_kb(i18n._texts[lang]))
 
+# ===== Очередь выводов: wq:<status>:<after_id> — страница, wa:<act>:<id>:<status>:<after_id> — действие,
+# wp:<status>:<after_id>:<last_id>:<token> — «выплатить страницу» (token — withdrawals.page_token)
+async def _withdrawals_page(message, lang: str, status: str, after_id: int):
+    rows = await withdrawals.page(status, after_id, WD_PAGE + 1)
+    page, more = rows[:WD_PAGE], len(rows) > WD_PAGE
+    from aiogram.utils.keyboard import InlineKeyboardBuilder
+    Btn = __import__('aiogram.types').types.InlineKeyboardButton
+    kb = InlineKeyboardBuilder()
+    parts = [i18n.t(lang,"withdraw_list" if status == "pending" else "withdraw_list_processed") + (" (0)" if not page else "")]
+    for r in page:
+        parts.append(i18n.t(lang,"withdraw_card_admin", id=r["id"], user_id=r["tg_id"], qc=r["amount_qc"],
+                            country=_short(r["country"]), method=_short(r["method"]), details=_short(r["details"])))
+        row = []
+        if r["status"] == "pending":
+            row.append(Btn(text=f"✅ #{r['id']}", callback_data=f"wa:ok:{r['id']}:{status}:{after_id}"))
+        row.append(Btn(text=f"💸 #{r['id']}", callback_data=f"wa:paid:{r['id']}:{status}:{after_id}"))
+        row.append(Btn(text=f"❌ #{r['id']}", callback_data=f"wa:no:{r['id']}:{status}:{after_id}"))
+        kb.row(*row)
+    nav = []
+    if after_id:
+        nav.append(Btn(text=i18n.t(lang,"first_page"), callback_data=f"wq:{status}:0"))
+    if more:
+        nav.append(Btn(text=i18n.t(lang,"next_page"), callback_data=f"wq:{status}:{page[-1]['id']}"))
+    if nav:
+        kb.row(*nav)
+    if page:
+        kb.row(Btn(text=i18n.t(lang,"mark_page_paid", n=len(page)), callback_data=f"wp:{status}:{after_id}:{page[-1]['id']}:{withdrawals.page_token([r['id'] for r in page])}"))
+    other = "processed" if status == "pending" else "pending"
+    kb.row(Btn(text=i18n.t(lang,"withdraw_tab_" + other), callback_data=f"wq:{other}:0"),
+           Btn(text=i18n.t(lang,"back"), callback_data="admin:menu"))
+    await replace_message(message, "\n\n".join(parts), reply_markup=kb.as_markup())
+
+def _short(v, n: int = WD_FIELD_MAX) -> str:
+    # картка не повинна роздувати сторінку за ліміт Telegram (4096 символів); поля вводить юзер — екрануємо під HTML
+    v = v or ""
+    return html.escape(v if len(v) <= n else v[:n - 1] + "…")
+
+@router.callback_query(F.data.startswith("wq:"))
+async def withdrawals_queue(cb: CallbackQuery, user=None):
+    if not is_admin(cb.from_user.id):
+        await cb.answer("Nope")
+        return
+    _, status, after_id = cb.data.split(":")
+    await _withdrawals_page(cb.message, _lang(user), status, int(after_id))
+
+@router.callback_query(F.data.startswith("wa:"))
+async def withdrawal_action(cb: CallbackQuery, user=None):
+    if not is_admin(cb.from_user.id):
+        await cb.answer("Nope")
+        return
+    lang = _lang(user)
+    _, act, wd_id, status, after_id = cb.data.split(":")
+    if act == "ok":
+        done, ok_text = await withdrawals.approve(int(wd_id)), "processed_ok"
+    elif act == "paid":
+        row = await withdrawals.mark_paid(int(wd_id))
+        done, ok_text = row and row["paid"], "paid_ok"
+        if row and not row["ok"]:
+            done, ok_text = True, "withdraw_no_balance"
+    else:
+        done, ok_text = await withdrawals.reject(int(wd_id)), "rejected_ok"
+    await cb.answer(i18n.t(lang, ok_text if done else "withdraw_not_open"))
+    await _withdrawals_page(cb.message, lang, status, int(after_id))
+
+@router.callback_query(F.data.startswith("wp:"))
+async def withdrawals_page_paid(cb: CallbackQuery, user=None):
+    if not is_admin(cb.from_user.id):
+        await cb.answer("Nope")
+        return
+    lang = _lang(user)
+    _, status, after_id, last_id, token = cb.data.split(":")
+    res = await withdrawals.mark_page_paid(status, int(after_id), int(last_id), token)
+    if res is None:
+        await cb.answer(i18n.t(lang, "withdraw_page_changed"), show_alert=True)
+    else:
+        n, short = res
+        text = i18n.t(lang, "page_paid_ok", n=n)
+        if short:
+            text += "\n" + i18n.t(lang, "page_paid_short", n=short)
+        await cb.answer(text, show_alert=True)
+    await _withdrawals_page(cb.message, lang, status, int(after_id))
+
 router.broadcast_wait = {}
 
 @router.message(F.text.regexp(r".+"), lambda m: router.broadcast_wait.get(m.from_user.id))
-async def broadcast_confirm(msg: Message):
+async def broadcast_confirm(msg: Message, user=None):
     if not is_admin(msg.from_user.id):
         return
-    lang = (await fetchrow("SELECT language FROM users WHERE tg_id=$1", msg.from_user.id))["language"] or "en"
-    text = msg.html_text or msg.text
+    lang = _lang(user)
+    try:
+        seg, texts = segments.parse(msg.html_text or msg.text)
+    except ValueError as e:
+        await msg.answer(i18n.t(lang,"broadcast_bad_segment", error=str(e)))
+        return
+    total = await segments.count(seg)
     from aiogram.utils.keyboard import InlineKeyboardBuilder
     kb = InlineKeyboardBuilder()
-    total = await fetchrow("SELECT COUNT(*) c FROM users")
-    kb.row(__import__('aiogram.types').types.InlineKeyboardButton(text=i18n.t(lang,"broadcast_confirm", count=total["c"]), callback_data="send_bc"))
+    kb.row(__import__('aiogram.types').types.InlineKeyboardButton(text=i18n.t(lang,"broadcast_confirm", count=total), callback_data="send_bc"))
     kb.row(__import__('aiogram.types').types.InlineKeyboardButton(text=i18n.t(lang,"back"), callback_data="admin:menu"))
-    router.broadcast_text[msg.from_user.id] = text
-    await msg.answer(text, reply_markup=kb.as_markup())
+    router.broadcast_text[msg.from_user.id] = (seg, texts, total)
+    # превью: аудитория + каждый вариант текста
+    preview = [i18n.t(lang,"broadcast_audience", segment=segments.describe(seg), count=total)]
+    preview += [f"<b>[{k}]</b>\n{v}" for k, v in texts.items()]
+    await msg.answer("\n\n".join(preview), reply_markup=kb.as_markup())
 
 router.broadcast_text = {}
 
 @router.callback_query(F.data=="send_bc")
-async def do_broadcast(cb: CallbackQuery):
+async def do_broadcast(cb: CallbackQuery, user=None):
     if not is_admin(cb.from_user.id):
         await cb.answer("Nope")
         return
-    text = router.broadcast_text.pop(cb.from_user.id, None)
+    draft = router.broadcast_text.pop(cb.from_user.id, None)
     router.broadcast_wait.pop(cb.from_user.id, None)
-    if not text:
+    if not draft:
         await cb.answer("No text")
         return
-    users = await fetch("SELECT tg_id FROM users ORDER BY id")
-    ok=bad=0
-    for r in users:
-        try:
-            await cb.bot.send_message(r["tg_id"], text)
-            ok+=1
-        except Exception:
-            bad+=1
-        await __import__('asyncio').sleep(0.05)
-    lang = (await fetchrow("SELECT language FROM users WHERE tg_id=$1", cb.from_user.id))["language"] or "en"
-    await replace_message(cb.message, i18n.t(lang,"broadcast_done", ok=ok, bad=bad))
+    # сама рассылка — фоновая задача (services/broadcast.py), здесь только ставим её и показываем прогресс
+    lang = _lang(user)
+    seg, texts, total = draft
+    job_id = await broadcast.create_job(cb.from_user.id, lang, texts, seg, total)
+    job = {"id": job_id, "lang": lang, "sent": 0, "failed": 0, "total": total}
+    msg = await replace_message(cb.message, broadcast.progress_text(job), reply_markup=broadcast.cancel_kb(job_id, lang))
+    await broadcast.attach_progress(job_id, msg.chat.id, msg.message_id)
+
+@router.callback_query(F.data.startswith("bc_cancel:"))
+async def cancel_broadcast(cb: CallbackQuery, user=None):
+    if not is_admin(cb.from_user.id):
+        await cb.answer("Nope")
+        return
+    ok = await broadcast.cancel_job(int(cb.data.split(":")[1]))
+    await cb.answer(i18n.t(_lang(user), "broadcast_canceled" if ok else "broadcast_not_active"), show_alert=True)
 
 @router.callback_query(F.data.startswith("chain:"))
-async def chain_screen(cb: CallbackQuery):
+async def chain_screen(cb: CallbackQuery, user=None):
     if not is_admin(cb.from_user.id):
         return
-    lang = (await fetchrow("SELECT language FROM users WHERE tg_id=$1", cb.from_user.id))["language"] or "en"
+    lang = _lang(user)
     _, cid = cb.data.split(":")
     if cid=="new":
         # ask for key
@@ -137,19 +247,19 @@ router.new_chain_wait = {}
 router.step_create_state = {}
 
 @router.message(lambda m: router.new_chain_wait.get(m.from_user.id)=="key")
-async def new_chain_key(msg: Message):
+async def new_chain_key(msg: Message, user=None):
     key = msg.text.strip()
     row = await get_or_create_chain(key)
     router.new_chain_wait.pop(msg.from_user.id, None)
     await msg.answer(f"Chain '{key}' created (id={row['id']}). Use the admin menu again.")
 
 @router.callback_query(F.data.startswith("step:"))
-async def step_ops(cb: CallbackQuery):
+async def step_ops(cb: CallbackQuery, user=None):
     if not is_admin(cb.from_user.id):
         return
     _, op, cid = cb.data.split(":")
     cid = int(cid)
-    lang = (await fetchrow("SELECT language FROM users WHERE tg_id=$1", cb.from_user.id))["language"] or "en"
+    lang = _lang(user)
     if op=="add":
         router.step_create_state[cb.from_user.id] = {"cid": cid, "stage": "desc_uk"}
         await replace_message(cb.message, i18n.t(lang,"ask_desc_uk"))
@@ -157,20 +267,23 @@ async def step_ops(cb: CallbackQuery):
         last = await fetchrow("SELECT id FROM steps WHERE chain_id=$1 ORDER BY order_no DESC LIMIT 1", cid)
         if last:
             await execute("DELETE FROM steps WHERE id=$1", last["id"])
+            await catalog.notify_changed()
             await replace_message(cb.message, i18n.t(lang,"deleted"))
     elif op=="toggle":
         # flip all
         await execute("UPDATE steps SET is_active = NOT is_active WHERE chain_id=$1", cid)
+        await catalog.notify_changed()
         await replace_message(cb.message, i18n.t(lang,"toggled"))
     elif op=="wipe":
         await execute("DELETE FROM user_steps WHERE step_id IN (SELECT id FROM steps WHERE chain_id=$1)", cid)
         await execute("DELETE FROM steps WHERE chain_id=$1", cid)
+        await catalog.notify_changed()
         await replace_message(cb.message, i18n.t(lang,"wiped"))
 
 @router.message(lambda m: isinstance(router.step_create_state.get(m.from_user.id), dict))
-async def step_create_flow(msg: Message):
+async def step_create_flow(msg: Message, user=None):
     s = router.step_create_state[msg.from_user.id]
-    lang = (await fetchrow("SELECT language FROM users WHERE tg_id=$1", msg.from_user.id))["language"] or "en"
+    lang = _lang(user)
     if s["stage"]=="desc_uk":
         s["desc_uk"]=msg.text
         s["stage"]="desc_ru"
@@ -222,4 +335,5 @@ async def step_create_flow(msg: Message):
             RETURNING id
         """, cid, order_no, s["title_uk"], s["title_ru"], s["title_en"], s["desc_uk"], s["desc_ru"], s["desc_en"], s["url"], s["reward_qc"])
         router.step_create_state.pop(msg.from_user.id, None)
+        await catalog.notify_changed()
         await msg.answer(i18n.t(lang,"step_saved"))
@@ -1,13 +1,12 @@
 from aiogram import Router, F
 from aiogram.types import Message
-from ..services.tasks_service import get_user
 from ..utils.i18n import i18n
+from ..services.referrals import get_stats
 
 router = Router()
 
 @router.message(F.text.in_({"👤 Профіль", "👤 Профиль", "👤 Profile"}))
-async def profile_btn(msg: Message):
-    user = await get_user(msg.from_user.id)
+async def profile_btn(msg: Message, user=None):
     if not user or not user["language"]:
         await msg.answer("Use /start")
         return
@@ -28,6 +27,10 @@ async def profile_btn(msg: Message):
         done=user["today_count"],
     )
     ref = i18n.t(lang, "ref_link", bot=bot_username, tg_id=user["tg_id"])
+    rs = await get_stats(user["id"])
+    if rs:
+        ref += "\n\n" + i18n.t(lang, "ref_stats", invited=rs["invited"], activated=rs["activated"],
+                                bonus=rs["bonus_qc"], l2=rs["invited_l2"])
 
     await msg.answer(f"{i18n.t(lang,'profile_title')}\n\n{text}\n\n{ref}")
 
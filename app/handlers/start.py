@@ -5,18 +5,13 @@ from ..utils.i18n import i18n
 from ..utils.keyboards import lang_kb, activation_kb, main_menu_kb
 from ..services.tasks_service import (
     ensure_user, set_language, get_user,
-    award_referral_if_needed, activate_user
+    activate_user, drop_cached_user
 )
-from ..config import settings
-from ..db import execute, fetchrow
+from ..db import fetchrow
 from ..utils.tg import replace_message
 
-# Новые провайдеры оплаты
-from ..utils.payments import (
-    create_monopay_invoice,
-    create_cryptobot_invoice,
-    get_cryptobot_invoice
-)
+from ..services.invoice_service import get_or_create_invoices
+from ..services.referrals import credit_referrer
 
 import time
 import re
@@ -44,64 +39,6 @@ def parse_ref(payload: str | None) -> int | None:
         return None
 
 
-async def _get_or_create_invoices(user_row, locale_code: str):
-    """
-    Возвращает ссылки pay_url_mono, pay_url_crypto.
-    Если актуальных инвойсов нет — создаёт и сохраняет их в БД.
-    """
-    user_id = user_row["id"]
-    tg_id = user_row["tg_id"]
-
-    # 1) пробуем найти свежие "created/pending"
-    mono = await fetchrow(
-        """SELECT link, uuid FROM payments
-           WHERE user_id=$1 AND provider='monopay' AND status IN ('created','pending')
-           ORDER BY id DESC LIMIT 1""",
-        user_id,
-    )
-    crypto = await fetchrow(
-        """SELECT link, uuid FROM payments
-           WHERE user_id=$1 AND provider='cryptobot' AND status IN ('created','pending')
-           ORDER BY id DESC LIMIT 1""",
-        user_id,
-    )
-
-    pay_url_mono = mono["link"] if mono else None
-    pay_url_crypto = crypto["link"] if crypto else None
-
-    # 2) если нет — создаём
-    order_suffix = str(int(time.time()))
-    description = "Activation"
-
-    if not pay_url_mono and settings.MONOPAY_TOKEN:
-        inv_mono = await create_monopay_invoice(
-            order_id=f"ACT-MONO:{tg_id}:{order_suffix}",
-            description=description
-        )
-        await execute(
-            """INSERT INTO payments (user_id, provider, uuid, link, status, currency, amount_usd, order_id)
-               VALUES ($1,'monopay',$2,$3,'created','UAH',$4,$5)""",
-            user_id, inv_mono.invoice_id, inv_mono.pay_url, settings.PRICE_USD,
-            f"ACT-MONO:{tg_id}:{order_suffix}",
-        )
-        pay_url_mono = inv_mono.pay_url
-
-    if not pay_url_crypto and settings.CRYPTO_PAY_TOKEN:
-        inv_crypto = await create_cryptobot_invoice(
-            order_id=f"ACT-CRYPTO:{tg_id}:{order_suffix}",
-            description=description
-        )
-        await execute(
-            """INSERT INTO payments (user_id, provider, uuid, link, status, currency, amount_usd, order_id)
-               VALUES ($1,'cryptobot',$2,$3,'created','USD',$4,$5)""",
-            user_id, inv_crypto.invoice_id, inv_crypto.pay_url, settings.PRICE_USD,
-            f"ACT-CRYPTO:{tg_id}:{order_suffix}",
-        )
-        pay_url_crypto = inv_crypto.pay_url
-
-    return pay_url_mono, pay_url_crypto
-
-
 async def _activation_screen(message_or_cb, texts, pay_url_mono: str | None, pay_url_crypto: str | None):
     """
     Показывает экран активации с двумя URL-кнопками (MonoPay/CryptoBot) и кнопкой «Я оплатил».
@@ -146,7 +83,7 @@ async def on_start(msg: Message):
     if user["status"] != "active":
         lang = user["language"]
         texts = i18n._texts[lang]
-        pay_url_mono, pay_url_crypto = await _get_or_create_invoices(user, lang)
+        pay_url_mono, pay_url_crypto = await get_or_create_invoices(user)
         await _activation_screen(msg, texts, pay_url_mono, pay_url_crypto)
         return
 
@@ -172,7 +109,7 @@ async def set_lang_cb(cb: CallbackQuery):
     texts = i18n._texts[code]
 
     # создаём (или берём) инвойсы для выбранного языка
-    pay_url_mono, pay_url_crypto = await _get_or_create_invoices(user, code)
+    pay_url_mono, pay_url_crypto = await get_or_create_invoices(user)
 
     # экран активации
     await cb.message.answer("\u2063", reply_markup=ReplyKeyboardRemove())
@@ -188,48 +125,35 @@ async def set_lang_cb(cb: CallbackQuery):
 async def _check_paid_and_activate(user_row) -> bool:
     """
     Унифицированная логика для 'activation:check' и 'paid_check'.
-    1) Сначала ищем уже 'paid' в БД (MonoPay/CryptoBot) — это основной путь через вебхуки.
-    2) Если нет — пробуем подтянуть статус последнего инвойса CryptoBot по API.
-       (MonoPay статус тянем вебхуком: подпись X-Sign проверяет сервер.)
+    Только чтение из БД: оплату проводят вебхуки (MonoPay/CryptoBot) и фоновый reconciler CryptoBot,
+    они же активируют юзера в той же транзакции.
     """
-    # 1) есть ли уже paid?
-    paid = await fetchrow(
-        """SELECT 1 FROM payments
-           WHERE user_id=$1 AND status='paid'
-           ORDER BY id DESC LIMIT 1""",
+    row = await fetchrow(
+        """SELECT u.status,
+                  EXISTS (
+                      SELECT 1 FROM payments p
+                      WHERE p.user_id=u.id AND p.provider IN ('monopay','cryptobot') AND p.status='paid'
+                  ) AS paid
+           FROM users u WHERE u.id=$1""",
         user_row["id"],
     )
-    if paid:
-        await execute("UPDATE users SET status='active' WHERE id=$1", user_row["id"])
-        await award_referral_if_needed(user_row["tg_id"])
+    if not row:
+        return False
+    if row["status"] == "active":
+        drop_cached_user(user_row["tg_id"])  # снимок в кеше мог ещё не получить NOTIFY
+        return True
+    if row["paid"]:
+        # оплата проведена до атомарного settle_payment (старые данные) — доактивируем
+        await activate_user(user_row["tg_id"])
+        await credit_referrer(user_row["tg_id"])
         return True
-
-    # 2) CryptoBot: проверим по API последний созданный инвойс
-    inv_crypto = await fetchrow(
-        """SELECT uuid FROM payments
-           WHERE user_id=$1 AND provider='cryptobot' AND status IN ('created','pending')
-           ORDER BY id DESC LIMIT 1""",
-        user_row["id"],
-    )
-    if inv_crypto and inv_crypto["uuid"]:
-        try:
-            info = await get_cryptobot_invoice(inv_crypto["uuid"])
-            status = (getattr(info, "status", None) or "").lower()
-            if status in ("paid", "completed"):
-                await execute("UPDATE payments SET status='paid' WHERE uuid=$1", inv_crypto["uuid"])
-                await execute("UPDATE users SET status='active' WHERE id=$1", user_row["id"])
-                await award_referral_if_needed(user_row["tg_id"])
-                return True
-        except Exception:
-            # молча даём вебхуку завершить
-            pass
-
     return False
 
 
 @router.callback_query(F.data == "activation:check")
-async def activation_check(cb: CallbackQuery):
-    user = await get_user(cb.from_user.id)
+async def activation_check(cb: CallbackQuery, user=None):
+    if user is None:
+        user = await ensure_user(cb.from_user.id)
     if user["status"] == "active":
         await cb.answer("Уже активировано ✅", show_alert=True)
         return
@@ -247,5 +171,5 @@ async def activation_check(cb: CallbackQuery):
 
 # Сохраняем старый хендлер имени, чтобы ничего не отвалилось в меню/кнопках
 @router.callback_query(F.data == "paid_check")
-async def paid_check_alias(cb: CallbackQuery):
-    await activation_check(cb)
+async def paid_check_alias(cb: CallbackQuery, user=None):
+    await activation_check(cb, user)
@@ -1,9 +1,10 @@
 from aiogram import Router, F
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 
-from ..services.tasks_service import get_user
 from ..utils.i18n import i18n
-from ..db import fetchrow
+from ..services import admin_notify
+from ..services.ledger import reserve_withdrawal
+from ..services.tasks_service import drop_cached_user
 from ..config import settings
 router = Router()
 
@@ -12,65 +13,43 @@ class WState:
     stage = {}  # user_id -> 'country' | 'method' | 'details' | 'amount'
     data = {}   # user_id -> {'country':..., 'method':..., 'details':..., 'amount_qc':...}
 
-async def notify_admins_withdrawal(bot, user_row, wd_row, username: str | None):
-    """
-    Шле адмінам повідомлення про нову заявку.
-    user_row — рядок з таблиці users (ти вже маєш user у хендлерах),
-    wd_row — рядок з таблиці withdrawals, повернутий RETURNING.
-    """
-    tg_id = user_row["tg_id"]
-    uname = (username or "").lstrip("@")
-    usd = wd_row["amount_qc"] * 0.005  # 1 QC = $0.005
-
-    title = "💸 Нова заявка на вивід"  # або "Новая заявка на вывод"
-    # посилання працює навіть без username
-    contact = f"<a href='tg://user?id={tg_id}'>#{tg_id}</a>"
-    if uname:
-        contact += f" (@{uname})"
-
-    text = (
-        f"{title}\n\n"
-        f"ID заявки: <code>{wd_row['id']}</code>\n"
-        f"Користувач: {contact}\n"
-        f"Сума: <b>{wd_row['amount_qc']} QC</b> (~${usd:.2f})\n"
-        f"Країна: {wd_row['country']}\n"
-        f"Спосіб: {wd_row['method']}\n"
-        f"Реквізити: {wd_row['details']}\n"
-        f"Статус: pending"
-    )
-
-    for admin_id in settings.ADMIN_IDS:
-        try:
-            await bot.send_message(admin_id, text)
-        except Exception:
-            # ігноруємо одиничні фейли відправки, щоб не валити потік
-            pass
-
 def reset(uid: int):
     WState.stage.pop(uid, None)
     WState.data.pop(uid, None)
 
+# код способу (withdrawals.method_code) -> ключ тексту кнопки; автовиплата — тільки cryptobot
+METHODS = {
+    "cryptobot": "withdraw_cryptobot",
+    "crypto": "withdraw_crypto",
+    "card": "withdraw_card",
+    "other": "withdraw_other",
+}
+
+def method_code(text: str) -> str | None:
+    """Кнопка будь-якою мовою -> код; введене вручну -> None."""
+    for code, key in METHODS.items():
+        if any(text == i18n.t(lang, key) for lang in ("uk", "ru", "en")):
+            return code
+    return None
+
 def kb_methods(lang: str):
+    # @CryptoBot пропонуємо лише коли його виплачує воркер (services/payouts.py)
+    codes = [c for c in METHODS if c != "cryptobot" or settings.PAYOUT_PROVIDER]
     return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text=i18n.t(lang, "withdraw_crypto"))],
-            [KeyboardButton(text=i18n.t(lang, "withdraw_card"))],
-            [KeyboardButton(text=i18n.t(lang, "withdraw_other"))],
-        ],
+        keyboard=[[KeyboardButton(text=i18n.t(lang, METHODS[c]))] for c in codes],
         resize_keyboard=True,
         one_time_keyboard=True,
     )
 
 # --- СТАРТ МАЙСТРА ---
 @router.message(F.text.in_(("🤑 Вивід коштів", "🤑 Вывод средств", "🤑 Withdraw")))
-async def withdraw_entry(msg: Message):
-    user = await get_user(msg.from_user.id)
+async def withdraw_entry(msg: Message, user=None):
     lang = user["language"]
 
     # проверяем минималку
-    if user["balance_qc"] < 10000:
+    if user["balance_qc"] < settings.MIN_WITHDRAW_QC:
         # ключ в локалях должен поддерживать плейсхолдер {min}
-        await msg.answer(i18n.t(lang, "withdraw_min", min=MIN_WITHDRAW))
+        await msg.answer(i18n.t(lang, "withdraw_min", min=settings.MIN_WITHDRAW_QC))
         return
 
     reset(msg.from_user.id)
@@ -81,8 +60,7 @@ async def withdraw_entry(msg: Message):
 
 # --- КРАЇНА ---
 @router.message(lambda m: WState.stage.get(m.from_user.id) == "country")
-async def w_country(msg: Message):
-    user = await get_user(msg.from_user.id)
+async def w_country(msg: Message, user=None):
     lang = user["language"]
 
     WState.data[msg.from_user.id]["country"] = msg.text.strip()
@@ -92,12 +70,23 @@ async def w_country(msg: Message):
 
 # --- МЕТОД ---
 @router.message(lambda m: WState.stage.get(m.from_user.id) == "method")
-async def w_method(msg: Message):
-    user = await get_user(msg.from_user.id)
+async def w_method(msg: Message, user=None):
     lang = user["language"]
 
     # приймаємо будь-що, але зазвичай це одна з кнопок:
-    WState.data[msg.from_user.id]["method"] = msg.text.strip()
+    text = msg.text.strip()
+    code = method_code(text)
+    WState.data[msg.from_user.id]["method"] = text
+    WState.data[msg.from_user.id]["method_code"] = code
+
+    if code == "cryptobot":
+        # переказ іде на @CryptoBot цього tg-акаунта — реквізити не питаємо, але кажемо, куди прийде
+        WState.data[msg.from_user.id]["details"] = "@CryptoBot"
+        WState.stage[msg.from_user.id] = "amount"
+        await msg.answer(i18n.t(lang, "withdraw_cryptobot_note"), reply_markup=ReplyKeyboardRemove())
+        await msg.answer(i18n.t(lang, "withdraw_amount"))
+        return
+
     WState.stage[msg.from_user.id] = "details"
 
     # прибираємо клаву, щоб не дублювалась
@@ -105,8 +94,7 @@ async def w_method(msg: Message):
 
 # --- РЕКВІЗИТИ ---
 @router.message(lambda m: WState.stage.get(m.from_user.id) == "details")
-async def w_details(msg: Message):
-    user = await get_user(msg.from_user.id)
+async def w_details(msg: Message, user=None):
     lang = user["language"]
 
     WState.data[msg.from_user.id]["details"] = msg.text.strip()
@@ -116,8 +104,7 @@ async def w_details(msg: Message):
 
 # --- СУМА ---
 @router.message(lambda m: WState.stage.get(m.from_user.id) == "amount")
-async def w_amount(msg: Message):
-    user = await get_user(msg.from_user.id)
+async def w_amount(msg: Message, user=None):
     lang = user["language"]
 
     try:
@@ -131,6 +118,9 @@ async def w_amount(msg: Message):
     if val > user["balance_qc"]:
         await msg.answer("Too much.")
         return
+    if val < settings.MIN_WITHDRAW_QC:
+        await msg.answer(i18n.t(lang, "withdraw_min", min=settings.MIN_WITHDRAW_QC))
+        return
 
     WState.data[msg.from_user.id]["amount_qc"] = val
     d = WState.data[msg.from_user.id]
@@ -143,29 +133,19 @@ async def w_amount(msg: Message):
         method=d["method"],
         details=d["details"],
     )
-    await msg.answer(confirm)
+    # зберігаємо заявку й одразу резервуємо суму (холд у журналі); баланс перевіряється атомарно,
+    # тож дві заявки на ті самі QC не пройдуть
+    wd_row = await reserve_withdrawal(msg.from_user.id, val, d["country"], d["method"], d["details"],
+                                      d.get("method_code"))
+    drop_cached_user(msg.from_user.id)
+    if wd_row is None:
+        await msg.answer("Too much.")
+        return
 
-    # зберігаємо заявку
-    wd_row = await fetchrow(
-        """
-        INSERT INTO withdrawals (user_id, amount_qc, country, method, details)
-        VALUES ((SELECT id FROM users WHERE tg_id=$1), $2, $3, $4, $5)
-        RETURNING id, amount_qc, country, method, details, status, created_at
-        """,
-        msg.from_user.id,
-        val,
-        d["country"],
-        d["method"],
-        d["details"],
-    )
+    await msg.answer(confirm)
 
-    # повідомляємо адмінів (без кнопок, просто повідомлення)
-    await notify_admins_withdrawal(
-        bot=msg.bot,
-        user_row=user,
-        wd_row=wd_row,
-        username=msg.from_user.username,
-    )
+    # повідомляємо адмінів фоном (services/admin_notify.py): відповідь юзеру не чекає Telegram
+    admin_notify.withdrawal_created(user, wd_row, msg.from_user.username)
 
     await msg.answer(i18n.t(lang, 'withdraw_saved'), reply_markup=ReplyKeyboardRemove())
     reset(msg.from_user.id)
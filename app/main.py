@@ -1,4 +1,5 @@
-import asyncio, sys, logging, hmac, hashlib, json, base64, os, aiohttp
+import asyncio, sys, logging, hmac, hashlib, json, base64, os, time
+from concurrent.futures import ThreadPoolExecutor
 from aiohttp import web
 from aiogram import Bot, Dispatcher
 from aiogram.types import BotCommand
@@ -7,9 +8,29 @@ from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
 
 from .config import settings
-from .db import connect, close, execute, fetchrow, fetchval, fetch
-from .schema import ensure_schema, run_stars_migration
+from .db import connect, close, listener_loop
+from .schema import (
+    ensure_schema, run_stars_migration, run_payments_migration, run_referrals_migration,
+    run_broadcast_migration,
+)
 from .handlers import start, profile, tasks, withdraw, admin
+from .services import catalog
+from .services.tasks_service import user_cache_stats
+from .services.payments_service import (
+    store_payment_event, cryptobot_event_id, monopay_event_id, settler_loop, settler_stats,
+    reconciler_loop,
+)
+from .services.membership import membership_stats
+from .services.update_queue import UpdateQueue
+from .services.invoice_service import prewarm_loop
+from .services.notifier import notifier_loop, notifier_stats
+from .services.broadcast import broadcast_loop, broadcast_stats
+from .services.stats import stats_loop
+from .services.reconcile import reconcile_loop
+from .services.admin_notify import admin_notify_loop, admin_notify_stats
+from .services.payouts import payout_loop, payout_stats
+from .utils.payments import init_clients, close_clients, http
+from .middlewares import UserMiddleware
 from aiocryptopay import AioCryptoPay, Networks  # лишаю для payments.py
 
 # cryptography — надійна валідація MonoPay (DER/RAW + urlsafe b64) і парс PEM/DER ключа/сертифіката
@@ -21,133 +42,26 @@ from functools import lru_cache
 
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("main")
-ref_log = logging.getLogger("main.ref")
 
 MONO_BASE = "https://api.monobank.ua"
 
 # Кеш публічного ключа Mono
 _MONO_PUBKEY_PEM: bytes | None = None
 _MONO_PUBKEY_OBJ = None  # ec.EllipticCurvePublicKey
-
-_REF_COL_CACHE = None          # type: str | None
-_REF_COL_LOCK = asyncio.Lock()
-
-async def _detect_ref_column() -> str | None:
-    """
-    Определяем, в какой колонке таблицы users хранится реферал.
-    Кэшируем строковое имя колонки, а не корутину.
-    """
-    global _REF_COL_CACHE
-    if _REF_COL_CACHE is not None:
-        return _REF_COL_CACHE
-
-    async with _REF_COL_LOCK:
-        if _REF_COL_CACHE is not None:
-            return _REF_COL_CACHE
-
-        rows = await fetch("""
-            SELECT column_name
-            FROM information_schema.columns
-            WHERE table_schema='public' AND table_name='users'
-        """)
-        cols = {r["column_name"] for r in rows}
-        candidates = [
-            "referrer_id", "invited_by", "ref", "inviter",
-            "ref_tg", "referrer_tg", "parent_id", "parent_tg",
-        ]
-        for c in candidates:
-            if c in cols:
-                _REF_COL_CACHE = c
-                break
-        else:
-            _REF_COL_CACHE = None
-
-        ref_log.info("[ref] detected ref column: %s", _REF_COL_CACHE)
-        return _REF_COL_CACHE
-
-
-
-
-async def _get_referrer_tg_id(invitee_tg_id: int) -> int | None:
-    col = await _detect_ref_column()
-    if not col:
-        ref_log.info("[ref] skip: no ref column for invitee %s", invitee_tg_id)
-        return None
-
-    row = await fetchrow(f"SELECT {col} AS ref_raw FROM users WHERE tg_id=$1", invitee_tg_id)
-    if not row:
-        ref_log.info("[ref] skip: invitee %s not found in users", invitee_tg_id)
-        return None
-
-    ref_raw = row["ref_raw"]
-    if not ref_raw or ref_raw == 0:
-        ref_log.info("[ref] skip: no referrer set for invitee %s", invitee_tg_id)
-        return None
-
-    # raw как tg_id?
-    u = await fetchrow("SELECT tg_id FROM users WHERE tg_id=$1", ref_raw)
-    if u:
-        return int(ref_raw)
-
-    # raw как internal id?
-    u = await fetchrow("SELECT tg_id FROM users WHERE id=$1", ref_raw)
-    if u and u["tg_id"]:
-        return int(u["tg_id"])
-
-    ref_log.info("[ref] skip: ref_raw %s for invitee %s not resolvable to tg_id", ref_raw, invitee_tg_id)
-    return None
-
-
-
-
-async def _get_user_id_by_tg(tg_id: int) -> int | None:
-    row = await fetchrow("SELECT id FROM users WHERE tg_id = $1", tg_id)
-    return row["id"] if row else None
-
-
-async def award_ref_bonus_if_needed(invitee_tg_id: int) -> None:
-    try:
-        ref_log.info("[ref] try bonus for invitee %s", invitee_tg_id)
-
-        ref_tg = await _get_referrer_tg_id(invitee_tg_id)
-        if not ref_tg:
-            ref_log.info("[ref] stop: no referrer for invitee %s", invitee_tg_id)
-            return
-
-        marker = f"ref:{invitee_tg_id}"
-        paid = await fetchval(
-            "SELECT 1 FROM payments WHERE provider='ref_bonus' AND uuid=$1",
-            marker
-        )
-        if paid:
-            ref_log.info("[ref] stop: marker exists for invitee %s", invitee_tg_id)
-            return
-
-        ref_user = await fetchrow("SELECT id FROM users WHERE tg_id=$1", ref_tg)
-        ref_user_id = ref_user["id"] if ref_user else None
-
-        await execute(
-            "UPDATE users SET balance_qc = COALESCE(balance_qc,0) + $1 WHERE tg_id = $2",
-            settings.REF_BONUS_QC, ref_tg
-        )
-
-        try:
-            await execute(
-                "INSERT INTO payments (provider, uuid, status, user_id, amount) "
-                "VALUES ('ref_bonus', $1, 'paid', $2, $3)",
-                marker, ref_user_id, settings.REF_BONUS_QC
-            )
-        except Exception:
-            await execute(
-                "INSERT INTO payments (provider, uuid, status) VALUES ('ref_bonus', $1, 'paid')",
-                marker
-            )
-
-        ref_log.info("[ref] OK +%s QC to inviter %s (invitee %s)",
-                     settings.REF_BONUS_QC, ref_tg, invitee_tg_id)
-
-    except Exception as e:
-        ref_log.warning("[ref] FAIL for invitee %s: %r", invitee_tg_id, e)
+_MONO_KEY_GEN = 0                 # +1 на кожне успішне перечитування ключа
+_MONO_KEY_REFRESHED_AT = 0.0      # monotonic
+_MONO_KEY_FAILS = 0               # невдалих завантажень ключа поспіль (backoff, поки ключа немає)
+_MONO_KEY_LOCK = asyncio.Lock()
+_MONO_SIG_MODE: str | None = None  # der | raw — яке кодування X-Sign спрацювало останнім
+_MONO_VERIFY_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="mono-verify")
+_MONO_SIGN_STATS = {
+    "verify_calls": 0, "verify_ok": 0, "verify_failed": 0,
+    "verify_ms_total": 0.0, "verify_ms_max": 0.0,
+    "refreshes": 0, "refresh_skipped": 0, "refresh_errors": 0,
+}
+
+# Фонові задачі (LISTEN, воркери) — гасимо на shutdown
+_BG_TASKS: list[asyncio.Task] = []
 
 # ===================== Mono: робота з публічним ключем =====================
 
@@ -273,11 +187,10 @@ async def _fetch_mono_pubkey_pem() -> bytes:
 
     # 2) API
     headers = {"X-Token": settings.MONOPAY_TOKEN}
-    async with aiohttp.ClientSession() as s:
-        async with s.get(f"{MONO_BASE}/api/merchant/pubkey", headers=headers, timeout=15) as r:
-            txt = await r.text()
-            if r.status != 200:
-                raise RuntimeError(f"monobank pubkey error {r.status}: {txt}")
+    async with http().get(f"{MONO_BASE}/api/merchant/pubkey", headers=headers) as r:
+        txt = await r.text()
+        if r.status != 200:
+            raise RuntimeError(f"monobank pubkey error {r.status}: {txt}")
 
     pem = _try_parse_pubkey_from_text(txt)
     if not pem:
@@ -321,42 +234,115 @@ def _decode_b64_maybe_urlsafe(s: str) -> bytes:
         return base64.b64decode(s2)
 
 
-def _verify_mono_xsign(body: bytes, x_sign_b64: str) -> bool:
+def _verify_mono_xsign(pubkey, body: bytes, x_sign_b64: str) -> bool:
     """
-    Валідація X-Sign: спочатку DER, якщо ні — raw r||s (64 байти).
+    Валідація X-Sign: DER або raw r||s (64 байти).
+    Кодування, що спрацювало, запам'ятовуємо і наступного разу пробуємо першим.
+    Викликається в пулі потоків (див. _verify_mono_xsign_async) — ключ передаємо явно.
     """
-    if not _MONO_PUBKEY_OBJ:
-        raise RuntimeError("mono pubkey obj not initialized")
+    global _MONO_SIG_MODE
     try:
         sig = _decode_b64_maybe_urlsafe(x_sign_b64)
     except Exception:
         return False
 
-    # 1) DER
-    try:
-        _MONO_PUBKEY_OBJ.verify(sig, body, ec.ECDSA(hashes.SHA256()))
-        return True
-    except InvalidSignature:
-        pass
-    except Exception:
-        pass
+    def as_der():
+        return sig
 
-    # 2) RAW r||s -> DER
-    try:
-        if len(sig) == 64:
-            r = int.from_bytes(sig[:32], "big")
-            s = int.from_bytes(sig[32:], "big")
-            sig_der = utils.encode_dss_signature(r, s)
-            _MONO_PUBKEY_OBJ.verify(sig_der, body, ec.ECDSA(hashes.SHA256()))
+    def as_raw():
+        if len(sig) != 64:
+            return None
+        r = int.from_bytes(sig[:32], "big")
+        s = int.from_bytes(sig[32:], "big")
+        return utils.encode_dss_signature(r, s)
+
+    modes = [("der", as_der), ("raw", as_raw)]
+    if _MONO_SIG_MODE == "raw":
+        modes.reverse()
+
+    for mode, encode in modes:
+        try:
+            sig_der = encode()
+            if sig_der is None:
+                continue
+            pubkey.verify(sig_der, body, ec.ECDSA(hashes.SHA256()))
+            _MONO_SIG_MODE = mode
             return True
-    except InvalidSignature:
-        pass
-    except Exception:
-        pass
+        except InvalidSignature:
+            pass
+        except Exception:
+            pass
 
     return False
 
 
+async def _verify_mono_xsign_async(body: bytes, x_sign_b64: str) -> bool:
+    """ECDSA — CPU, не блокуємо event loop."""
+    if _MONO_PUBKEY_OBJ is None:
+        raise RuntimeError("mono pubkey obj not initialized")
+    t0 = time.perf_counter()
+    ok = await asyncio.get_running_loop().run_in_executor(
+        _MONO_VERIFY_POOL, _verify_mono_xsign, _MONO_PUBKEY_OBJ, body, x_sign_b64
+    )
+    ms = (time.perf_counter() - t0) * 1000
+    st = _MONO_SIGN_STATS
+    st["verify_calls"] += 1
+    st["verify_ok" if ok else "verify_failed"] += 1
+    st["verify_ms_total"] += ms
+    st["verify_ms_max"] = max(st["verify_ms_max"], ms)
+    return ok
+
+
+async def _refresh_mono_pubkey(seen_gen: int) -> bool:
+    """
+    Перечитати ключ Mono (можлива ротація). Single-flight: паралельні виклики чекають один запит.
+    Не частіше MONO_KEY_REFRESH_MIN_SEC — потік битих підписів не перетворюється на потік запитів до API.
+    Поки ключа немає взагалі (preload впав, API лежить) — експоненційний backoff від 5 с до того ж інтервалу.
+    seen_gen — покоління ключа, з яким перевіряв виклик; якщо ключ уже оновили, поки чекали — True без запиту.
+    Повертає True, якщо є новий ключ і перевірку варто повторити.
+    """
+    global _MONO_KEY_GEN, _MONO_KEY_REFRESHED_AT, _MONO_KEY_FAILS
+    async with _MONO_KEY_LOCK:
+        if _MONO_KEY_GEN != seen_gen and _MONO_PUBKEY_OBJ is not None:
+            return True
+        now = time.monotonic()
+        min_sec = settings.MONO_KEY_REFRESH_MIN_SEC
+        if _MONO_PUBKEY_OBJ is None and _MONO_KEY_FAILS:
+            min_sec = min(5 * 2 ** (_MONO_KEY_FAILS - 1), min_sec)
+        if _MONO_KEY_REFRESHED_AT and now - _MONO_KEY_REFRESHED_AT < min_sec:
+            _MONO_SIGN_STATS["refresh_skipped"] += 1
+            return False
+        _MONO_KEY_REFRESHED_AT = now
+        old = (_MONO_PUBKEY_PEM, _MONO_PUBKEY_OBJ)
+        _reset_mono_pubkey_cache()
+        try:
+            await _fetch_mono_pubkey_pem()
+            _load_mono_pubkey_obj()
+        except Exception:
+            _MONO_SIGN_STATS["refresh_errors"] += 1
+            _MONO_KEY_FAILS += 1
+            if old[1] is not None:
+                _restore_mono_pubkey(*old)  # лишаємо старий ключ, ніж жодного
+            raise
+        _MONO_KEY_GEN += 1
+        _MONO_KEY_FAILS = 0
+        _MONO_SIGN_STATS["refreshes"] += 1
+        return True
+
+
+def _restore_mono_pubkey(pem: bytes | None, obj) -> None:
+    global _MONO_PUBKEY_PEM, _MONO_PUBKEY_OBJ
+    _MONO_PUBKEY_PEM, _MONO_PUBKEY_OBJ = pem, obj
+
+
+def mono_sign_stats() -> dict:
+    st = dict(_MONO_SIGN_STATS)
+    st["verify_ms_avg"] = round(st["verify_ms_total"] / st["verify_calls"], 3) if st["verify_calls"] else 0.0
+    st["sig_mode"] = _MONO_SIG_MODE
+    st["key_gen"] = _MONO_KEY_GEN
+    return st
+
+
 # ===================== CryptoPay: секретний шлях вебхука =====================
 
 def _crypto_secret_path() -> str:
@@ -387,11 +373,27 @@ async def _connect_db_with_retry(max_tries: int = 8) -> None:
 
 async def on_startup(bot: Bot):
     await _connect_db_with_retry()
+    await init_clients()
     await ensure_schema()
     try:
         await run_stars_migration()
     except Exception:
         pass
+    await run_payments_migration()
+    await run_referrals_migration()
+    await run_broadcast_migration()
+    # каталог цепочек/шагов в память + подписка на его изменения (NOTIFY)
+    await catalog.reload()
+    _spawn(listener_loop(), "db-listener")
+    _spawn(settler_loop(), "payments-settler")
+    _spawn(reconciler_loop(), "cryptobot-reconciler")
+    _spawn(notifier_loop(bot), "notifier")
+    _spawn(prewarm_loop(), "invoice-prewarm")
+    _spawn(broadcast_loop(bot), "broadcast")
+    _spawn(stats_loop(), "stats-resync")
+    _spawn(reconcile_loop(), "balance-reconcile")
+    _spawn(admin_notify_loop(bot), "admin-notify")
+    _spawn(payout_loop(), "payouts")
     await bot.get_me()
     await bot.set_my_commands([
         BotCommand(command="start", description="Start"),
@@ -401,35 +403,50 @@ async def on_startup(bot: Bot):
     # Підвантажимо і проініціалізуємо ключ Mono
     if settings.MONOPAY_TOKEN:
         try:
-            await _fetch_mono_pubkey_pem()
-            _load_mono_pubkey_obj()
+            await _refresh_mono_pubkey(_MONO_KEY_GEN)
             log.info("Mono pubkey cached")
         except Exception as e:
             log.warning("Mono pubkey preload failed: %s", e)
 
 
+def _spawn(coro, name: str) -> asyncio.Task:
+    task = asyncio.create_task(coro, name=name)
+    _BG_TASKS.append(task)
+    return task
+
+
 async def on_shutdown(bot: Bot):
+    for task in _BG_TASKS:
+        task.cancel()
+    await asyncio.gather(*_BG_TASKS, return_exceptions=True)
+    _BG_TASKS.clear()
+    await close_clients()
     await close()
 
 
-async def polling():
+def _build_dispatcher() -> Dispatcher:
     dp = Dispatcher(storage=MemoryStorage())
+    # один SELECT юзера на апдейт -> data["user"] (+ identity map для tasks_service)
+    dp.update.outer_middleware(UserMiddleware())
     dp.include_router(start.router)
     dp.include_router(profile.router)
     dp.include_router(tasks.router)
     dp.include_router(withdraw.router)
     dp.include_router(admin.router)
+    return dp
 
-    bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
-    async def startup(_): await on_startup(bot)
-    async def shutdown(_): await on_shutdown(bot)
+async def polling():
+    dp = _build_dispatcher()
+    # aiogram 3: хуки реєструються на dp, а не kwargs start_polling
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
     try:
         await dp.start_polling(
             bot,
-            on_startup=startup,
-            on_shutdown=shutdown,
             allowed_updates=dp.resolve_used_update_types(),
         )
     finally:
@@ -453,31 +470,8 @@ async def _handle_cryptobot_webhook(request: web.Request):
             return web.Response(status=403, text="bad signature")
 
     data = json.loads(body.decode("utf-8"))
-    if data.get("update_type") == "invoice_paid":
-        payload = data.get("payload") or {}
-        inv = str(payload.get("invoice_id"))
-
-    # 1) отметить платёж
-        await execute(
-            "UPDATE payments SET status='paid' WHERE provider='cryptobot' AND uuid=$1",
-            inv
-        )
-
-    # 2) найти платеж и юзера
-        row = await fetchrow(
-            "SELECT user_id FROM payments WHERE provider='cryptobot' AND uuid=$1",
-            inv
-        )
-        if row:
-        # 3) активировать доступ
-            await execute("UPDATE users SET status='active' WHERE id=$1", row["user_id"])
-
-        # 4) tg_id -> реф-бонус
-            u = await fetchrow("SELECT tg_id FROM users WHERE id=$1", row["user_id"])
-            if u and u["tg_id"]:
-                await award_ref_bonus_if_needed(u["tg_id"])
-
-        log.info("CryptoBot invoice_paid: %s", inv)
+    # в inbox и сразу 200; проводит платёж фоновый settler
+    await store_payment_event("cryptobot", cryptobot_event_id(data), body.decode("utf-8"))
 
     return web.json_response({"ok": True})
 
@@ -493,17 +487,15 @@ async def _handle_monopay_webhook(request: web.Request):
     if not x_sign:
         return web.Response(status=403, text="no signature")
 
-    # Перевірка підпису; при фейлі один раз оновимо ключ (можлива ротація)
+    # Перевірка підпису; при фейлі — оновлення ключа (можлива ротація), але не частіше мін. інтервалу
     try:
+        gen = _MONO_KEY_GEN
         if _MONO_PUBKEY_PEM is None or _MONO_PUBKEY_OBJ is None:
-            await _fetch_mono_pubkey_pem()
-            _load_mono_pubkey_obj()
-        ok = _verify_mono_xsign(raw, x_sign)
-        if not ok:
-            _reset_mono_pubkey_cache()
-            await _fetch_mono_pubkey_pem()
-            _load_mono_pubkey_obj()
-            ok = _verify_mono_xsign(raw, x_sign)
+            await _refresh_mono_pubkey(gen)
+            gen = _MONO_KEY_GEN
+        ok = await _verify_mono_xsign_async(raw, x_sign)
+        if not ok and await _refresh_mono_pubkey(gen):
+            ok = await _verify_mono_xsign_async(raw, x_sign)
     except Exception as e:
         log.warning("Mono webhook: pubkey load error: %s", e)
         return web.Response(status=403, text="pubkey error")
@@ -513,61 +505,50 @@ async def _handle_monopay_webhook(request: web.Request):
         return web.Response(status=403, text="bad signature")
 
     data = json.loads(raw.decode("utf-8"))
-    status = (data.get("status") or "").lower()
-    info = data.get("merchantPaymInfo") or {}
-    reference = info.get("reference") or data.get("reference")
-    invoice_id = data.get("invoiceId") or data.get("invoice_id")
-
-    if status == "success":
-# 1) отметить платёж оплаченным
-        await execute("""
-            UPDATE payments SET status='paid'
-            WHERE provider='monopay' AND (uuid=$1 OR uuid=$2 OR order_id=$3)
-        """, str(invoice_id), str(reference), str(reference))
-
-# 2) найти пользователя из этого платежа
-        row = await fetchrow("""
-            SELECT user_id
-            FROM payments
-            WHERE provider='monopay' AND (uuid=$1 OR uuid=$2 OR order_id=$3)
-            ORDER BY id DESC LIMIT 1
-        """, str(invoice_id), str(reference), str(reference))
-
-        if row:
-            u = await fetchrow("SELECT id, tg_id, referrer_id FROM users WHERE id=$1", row["user_id"])
-            ref_log.info("[ref] invitee candidate (mono): user_id=%s tg_id=%s ref_id=%s",
-                         row["user_id"], u["tg_id"] if u else None, u["referrer_id"] if u else None)
-
-            # активируем доступ
-            await execute("UPDATE users SET status='active' WHERE id=$1", row["user_id"])
-
-            # начисляем бонус
-            if u and u["tg_id"]:
-                await award_ref_bonus_if_needed(u["tg_id"])
-
+    await store_payment_event("monopay", monopay_event_id(data), raw.decode("utf-8"))
+    return web.json_response({"ok": True})
 
 
 async def webhook():
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.include_router(start.router)
-    dp.include_router(profile.router)
-    dp.include_router(tasks.router)
-    dp.include_router(withdraw.router)
-    dp.include_router(admin.router)
+    dp = _build_dispatcher()
 
     bot = Bot(token=settings.BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 
     app = web.Application()
+    queue = UpdateQueue(dp, bot, settings.UPDATE_WORKERS, settings.UPDATE_QUEUE_SIZE) if settings.WEBHOOK_ASYNC else None
 
     async def handle_tg(request: web.Request):
         if request.path != (settings.WEBHOOK_PATH or "/webhook"):
             return web.Response(text="OK")
         data = await request.json()
+        if queue is not None:
+            # ACK одразу; якщо черга шарда повна — 503, Telegram доставить повторно
+            if not queue.submit(data):
+                return web.Response(status=503, text="busy")
+            return web.Response(text="ok")
         await dp.feed_webhook_update(bot, data)
         return web.Response(text="ok")
 
+    async def handle_stats(request: web.Request):
+        # без STATS_TOKEN ендпойнт закритий: лічильники не для публіки
+        token = request.query.get("token", "")
+        if not settings.STATS_TOKEN or not hmac.compare_digest(token.encode(), settings.STATS_TOKEN.encode()):
+            return web.Response(status=403, text="forbidden")
+        return web.json_response({
+            "update_queue": queue.stats() if queue is not None else None,
+            "user_cache": user_cache_stats(),
+            "membership": membership_stats(),
+            "payments_settler": settler_stats(),
+            "notifier": notifier_stats(),
+            "mono_sign": mono_sign_stats(),
+            "broadcast": broadcast_stats(),
+            "admin_notify": admin_notify_stats(),
+            "payouts": payout_stats(),
+        })
+
     # Telegram webhook
     app.router.add_post(settings.WEBHOOK_PATH, handle_tg)
+    app.router.add_get("/stats", handle_stats)
 
     # CryptoPay webhook — секретний шлях
     CRYPTO_PATH = _crypto_secret_path()
@@ -579,6 +560,8 @@ async def webhook():
 
     async def on_app_start(app_):
         await on_startup(bot)
+        if queue is not None:
+            queue.start()
         # Telegram webhook
         wh_url = (settings.WEBHOOK_URL or "").rstrip("/") + settings.WEBHOOK_PATH
         await bot.delete_webhook(drop_pending_updates=True)
@@ -586,6 +569,8 @@ async def webhook():
         await bot.set_webhook(wh_url, drop_pending_updates=True, allowed_updates=updates)
 
     async def on_app_stop(_):
+        if queue is not None:
+            await queue.stop()
         await on_shutdown(bot)
         await bot.delete_webhook()
 
@@ -0,0 +1,29 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from ..services.tasks_service import get_user, open_identity_map, close_identity_map
+
+
+class UserMiddleware(BaseMiddleware):
+    """
+    Outer-middleware на dp.update: один SELECT юзера на апдейт.
+    Открывает identity map (tasks_service.get_user дальше берёт строку оттуда)
+    и кладёт снимок в data["user"] — хендлер получает его параметром `user`.
+    Юзера может не быть (первый /start) — тогда user=None.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        token = open_identity_map()
+        try:
+            from_user: User | None = data.get("event_from_user")
+            data["user"] = await get_user(from_user.id) if from_user else None
+            return await handler(event, data)
+        finally:
+            close_identity_map(token)
@@ -1,3 +1,4 @@
+from .config import settings
 from .db import execute
 
 SCHEMA_SQL = '''
@@ -72,10 +73,15 @@ CREATE TABLE IF NOT EXISTS withdrawals (
     country TEXT,
     method TEXT,
     details TEXT,
-    status TEXT NOT NULL DEFAULT 'pending', -- pending|processed|paid
+    status TEXT NOT NULL DEFAULT 'pending', -- pending|processed|paying|paid|rejected
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
 );
+-- код способу (handlers/withdraw.METHODS): cryptobot|crypto|card|other, NULL — введено вручну; method — текст для людей
+ALTER TABLE withdrawals ADD COLUMN IF NOT EXISTS method_code TEXT;
+-- черга виводів в адмінці: keyset по id усередині статусу (services/withdrawals.py)
+CREATE INDEX IF NOT EXISTS withdrawals_pending_idx ON withdrawals(id) WHERE status='pending';
+CREATE INDEX IF NOT EXISTS withdrawals_processed_idx ON withdrawals(id) WHERE status='processed';
 
 CREATE TABLE IF NOT EXISTS referral_rewards (
     id BIGSERIAL PRIMARY KEY,
@@ -83,9 +89,422 @@ CREATE TABLE IF NOT EXISTS referral_rewards (
     referee_id BIGINT REFERENCES users(id) ON DELETE CASCADE,
     awarded BOOLEAN NOT NULL DEFAULT FALSE,
     awarded_at TIMESTAMPTZ,
+    amount_qc BIGINT,
     UNIQUE(referee_id)
 );
+
+-- лічильники реферера, ведуться інкрементально (services/referrals.py)
+CREATE TABLE IF NOT EXISTS referral_stats (
+    user_id BIGINT PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    invited INT NOT NULL DEFAULT 0,      -- прийшли за його посиланням
+    activated INT NOT NULL DEFAULT 0,    -- з них оплатили (= нараховано бонус)
+    bonus_qc BIGINT NOT NULL DEFAULT 0,  -- сума реф-бонусів
+    invited_l2 INT NOT NULL DEFAULT 0,   -- запрошені його запрошеними
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS referral_stats_top_idx ON referral_stats(activated DESC, user_id DESC);
+
+-- журнал QC: тільки INSERT; users.balance_qc / earned_total_qc — його проекція (тригер LEDGER_SQL)
+CREATE TABLE IF NOT EXISTS qc_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL REFERENCES users(id) ON DELETE RESTRICT,
+    amount BIGINT NOT NULL,                  -- зміна balance_qc (+ нарахування, − холд)
+    earned_delta BIGINT NOT NULL DEFAULT 0,  -- зміна earned_total_qc
+    kind TEXT NOT NULL,                      -- opening|step|referral|admin|withdraw_hold|withdraw_release
+    ref_id BIGINT,                           -- user_steps.id / referee users.id / withdrawals.id / users.id для opening
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    UNIQUE(kind, ref_id)
+);
+CREATE INDEX IF NOT EXISTS qc_ledger_user_idx ON qc_ledger(user_id, id);
+
+-- звірка балансів (services/reconcile.py): прогони і знайдені розбіжності
+CREATE TABLE IF NOT EXISTS balance_audit_runs (
+    id BIGSERIAL PRIMARY KEY,
+    source TEXT NOT NULL DEFAULT 'auto',     -- auto | cli
+    status TEXT NOT NULL DEFAULT 'running',  -- running|done|failed
+    last_user_id BIGINT NOT NULL DEFAULT 0,
+    checked INT NOT NULL DEFAULT 0,
+    mismatched INT NOT NULL DEFAULT 0,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMPTZ
+);
+-- не більше одного running-прогону на всю базу: зайвих (з часів без індексу) закриваємо
+UPDATE balance_audit_runs SET status='failed', finished_at=NOW()
+WHERE status='running' AND id <> (SELECT MAX(id) FROM balance_audit_runs WHERE status='running');
+CREATE UNIQUE INDEX IF NOT EXISTS balance_audit_runs_running_idx ON balance_audit_runs((1)) WHERE status='running';
+CREATE TABLE IF NOT EXISTS balance_audit (
+    id BIGSERIAL PRIMARY KEY,
+    run_id BIGINT NOT NULL REFERENCES balance_audit_runs(id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    balance_qc BIGINT NOT NULL,
+    ledger_balance BIGINT NOT NULL,
+    earned_total_qc BIGINT NOT NULL,
+    ledger_earned BIGINT NOT NULL,
+    missing_step_credits INT NOT NULL DEFAULT 0,  -- user_steps без проводки step
+    missing_ref_credits INT NOT NULL DEFAULT 0,   -- referral_rewards без проводки referral
+    missing_holds INT NOT NULL DEFAULT 0,         -- заявки на вивід без холду
+    wrong_step_credits INT NOT NULL DEFAULT 0,    -- проводка step не дорівнює steps.reward_qc
+    wrong_ref_credits INT NOT NULL DEFAULT 0,     -- проводка referral не дорівнює referral_rewards.amount_qc
+    missing_releases INT NOT NULL DEFAULT 0,      -- відхилені заявки з холдом без withdraw_release
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+ALTER TABLE balance_audit ADD COLUMN IF NOT EXISTS wrong_step_credits INT NOT NULL DEFAULT 0;
+ALTER TABLE balance_audit ADD COLUMN IF NOT EXISTS wrong_ref_credits INT NOT NULL DEFAULT 0;
+ALTER TABLE balance_audit ADD COLUMN IF NOT EXISTS missing_releases INT NOT NULL DEFAULT 0;
+CREATE INDEX IF NOT EXISTS balance_audit_run_idx ON balance_audit(run_id, user_id);
+CREATE INDEX IF NOT EXISTS referral_rewards_referrer_idx ON referral_rewards(referrer_id);
+CREATE INDEX IF NOT EXISTS withdrawals_user_idx ON withdrawals(user_id, created_at);
+
+-- розсилки: задача в БД, прогрес чекпойнтиться, після рестарту продовжуємо (services/broadcast.py)
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    admin_tg BIGINT NOT NULL,
+    lang TEXT NOT NULL DEFAULT 'en',
+    text TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',   -- queued|running|done|canceled
+    last_user_id BIGINT NOT NULL DEFAULT 0,  -- чекпойнт: усім з id <= уже відправлено
+    total INT NOT NULL DEFAULT 0,
+    sent INT NOT NULL DEFAULT 0,
+    failed INT NOT NULL DEFAULT 0,
+    progress_chat_id BIGINT,
+    progress_msg_id BIGINT,
+    owner TEXT,                              -- application_name репліки, що веде розсилку
+    heartbeat_at TIMESTAMPTZ,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    finished_at TIMESTAMPTZ
+);
+CREATE INDEX IF NOT EXISTS broadcast_jobs_active_idx ON broadcast_jobs(id) WHERE status IN ('queued','running');
+
+-- автовиплати схвалених заявок: рядок на заявку, статус кожного переказу (services/payouts.py)
+CREATE TABLE IF NOT EXISTS payouts (
+    id BIGSERIAL PRIMARY KEY,
+    withdrawal_id BIGINT NOT NULL UNIQUE REFERENCES withdrawals(id) ON DELETE CASCADE,
+    provider TEXT NOT NULL,
+    spend_id TEXT NOT NULL UNIQUE,           -- ключ ідемпотентності в провайдера
+    asset TEXT NOT NULL,
+    amount NUMERIC(18,2) NOT NULL,
+    status TEXT NOT NULL DEFAULT 'new',      -- new|sending|retry|done|failed|unknown|canceled
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    external_id TEXT,                        -- id переказу в провайдера
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),  -- для sending — кінець аренди
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+CREATE INDEX IF NOT EXISTS payouts_due_idx ON payouts(next_attempt_at) WHERE status IN ('new','retry','sending');
+CREATE INDEX IF NOT EXISTS payouts_unknown_idx ON payouts(id) WHERE status='unknown';
+
+-- inbox вебхуків оплат: вебхук = один INSERT, проводить фоновий settler
+CREATE TABLE IF NOT EXISTS payment_events (
+    id BIGSERIAL PRIMARY KEY,
+    provider TEXT NOT NULL,
+    event_id TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'new', -- new|done|failed
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    processed_at TIMESTAMPTZ,
+    UNIQUE(provider, event_id)
+);
+
+CREATE INDEX IF NOT EXISTS payment_events_new_idx
+ON payment_events(next_attempt_at) WHERE status='new';
+
+-- outbox повідомлень юзерам: пишеться в транзакції зміни даних, шле services/notifier.py
+CREATE TABLE IF NOT EXISTS notifications_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    tg_id BIGINT NOT NULL,
+    kind TEXT NOT NULL,              -- activated | ...
+    payload JSONB,
+    dedup_key TEXT UNIQUE,           -- повторне проведення не дублює повідомлення
+    status TEXT NOT NULL DEFAULT 'new', -- new|sent|failed
+    attempts INT NOT NULL DEFAULT 0,
+    last_error TEXT,
+    next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS notifications_outbox_new_idx
+ON notifications_outbox(next_attempt_at) WHERE status='new';
 '''
+# Зарахування кроку одним викликом: ліміт дня, кулдаун, «вже виконано» і нарахування
+# в одній транзакції. FOR UPDATE по юзеру серіалізує паралельні колбеки (дабл-тап).
+COMPLETE_STEP_SQL = '''
+CREATE OR REPLACE FUNCTION qc_complete_step(
+    p_tg_id BIGINT,
+    p_step_id BIGINT,
+    p_chain_id BIGINT,
+    p_today DATE,
+    p_daily_limit INT,
+    p_cooldown INTERVAL
+) RETURNS TABLE (outcome TEXT, reward INT, new_balance BIGINT, done_today INT, wait_sec DOUBLE PRECISION)
+LANGUAGE plpgsql AS $$
+DECLARE
+    u users%ROWTYPE;
+    v_reward INT;
+    v_count INT;
+    v_naa TIMESTAMPTZ;
+    v_us_id BIGINT;
+BEGIN
+    SELECT * INTO u FROM users WHERE tg_id = p_tg_id FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'no_user'::TEXT, 0, 0::BIGINT, 0, 0::DOUBLE PRECISION;
+        RETURN;
+    END IF;
+
+    SELECT s.reward_qc INTO v_reward
+    FROM steps s
+    WHERE s.id = p_step_id AND s.chain_id = p_chain_id AND s.is_active = TRUE;
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT 'no_step'::TEXT, 0, u.balance_qc, u.today_count, 0::DOUBLE PRECISION;
+        RETURN;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM user_steps us WHERE us.user_id = u.id AND us.step_id = p_step_id) THEN
+        RETURN QUERY SELECT 'already_done'::TEXT, 0, u.balance_qc, u.today_count, 0::DOUBLE PRECISION;
+        RETURN;
+    END IF;
+
+    SELECT st.next_available_at INTO v_naa
+    FROM user_chain_state st
+    WHERE st.user_id = u.id AND st.chain_id = p_chain_id;
+    IF v_naa IS NOT NULL AND v_naa > NOW() THEN
+        RETURN QUERY SELECT 'cooldown'::TEXT, 0, u.balance_qc, u.today_count,
+                            EXTRACT(EPOCH FROM (v_naa - NOW()))::DOUBLE PRECISION;
+        RETURN;
+    END IF;
+
+    v_count := CASE WHEN u.today_date = p_today THEN u.today_count ELSE 0 END;
+    IF v_count >= p_daily_limit THEN
+        RETURN QUERY SELECT 'limit'::TEXT, 0, u.balance_qc, v_count, 0::DOUBLE PRECISION;
+        RETURN;
+    END IF;
+
+    INSERT INTO user_steps (user_id, step_id) VALUES (u.id, p_step_id) RETURNING id INTO v_us_id;
+
+    INSERT INTO user_chain_state (user_id, chain_id, next_available_at)
+    VALUES (u.id, p_chain_id, NOW() + p_cooldown)
+    ON CONFLICT (user_id, chain_id) DO UPDATE SET next_available_at = EXCLUDED.next_available_at;
+
+    -- баланс/earned оновить тригер журналу
+    INSERT INTO qc_ledger (user_id, amount, earned_delta, kind, ref_id)
+    VALUES (u.id, v_reward, v_reward, 'step', v_us_id);
+
+    UPDATE users
+    SET today_date = p_today,
+        today_count = v_count + 1
+    WHERE id = u.id;
+
+    -- кеш юзерів інших реплік (див. tasks_service.USERS_CHANNEL)
+    PERFORM pg_notify('qc_users', p_tg_id::TEXT || ':' || current_setting('application_name'));
+
+    RETURN QUERY SELECT 'ok'::TEXT, v_reward, u.balance_qc + v_reward, v_count + 1, 0::DOUBLE PRECISION;
+END
+$$;
+'''
+
+# Лічильники адмін-статистики: 16 рядків-шардів, ведуться statement-тригерами (transition tables) у тих самих
+# транзакціях, що міняють users/payments/referral_rewards. Тригер пише в шард свого з'єднання
+# (qc_stats_shard), тож паралельні транзакції не чекають одна одну на одному рядку, а одна транзакція
+# завжди чіпає один шард (без дедлоків між шардами). Значення — сума шардів (services/stats.py).
+# Дрейф (ручні правки, збої) виправляє qc_stats_resync() — фоновий services/stats.py.
+STATS_SQL = '''
+CREATE TABLE IF NOT EXISTS stats_counters (
+    id SMALLINT PRIMARY KEY,
+    users_total BIGINT NOT NULL DEFAULT 0,
+    users_active BIGINT NOT NULL DEFAULT 0,
+    balance_sum BIGINT NOT NULL DEFAULT 0,
+    earned_sum BIGINT NOT NULL DEFAULT 0,
+    payments_total BIGINT NOT NULL DEFAULT 0,
+    referrals_total BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    resynced_at TIMESTAMPTZ
+);
+
+-- раніше таблиця була одним рядком (id = 1): знімаємо обмеження, старий рядок лишається одним із шардів
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_constraint
+               WHERE conname = 'stats_counters_id_check' AND conrelid = 'stats_counters'::regclass) THEN
+        ALTER TABLE stats_counters DROP CONSTRAINT stats_counters_id_check;
+        ALTER TABLE stats_counters ALTER COLUMN id DROP DEFAULT;
+    END IF;
+END
+$$;
+
+INSERT INTO stats_counters (id) SELECT generate_series(0, 15) ON CONFLICT (id) DO NOTHING;
+
+CREATE OR REPLACE FUNCTION qc_stats_shard() RETURNS SMALLINT
+LANGUAGE sql STABLE AS $$ SELECT (pg_backend_pid() % 16)::SMALLINT $$;
+
+CREATE OR REPLACE FUNCTION qc_stats_users() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    d_total BIGINT := 0; d_active BIGINT := 0; d_balance BIGINT := 0; d_earned BIGINT := 0;
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        SELECT d_total + COUNT(*), d_active + COUNT(*) FILTER (WHERE status = 'active'),
+               d_balance + COALESCE(SUM(balance_qc), 0), d_earned + COALESCE(SUM(earned_total_qc), 0)
+        INTO d_total, d_active, d_balance, d_earned
+        FROM new_rows;
+    END IF;
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        SELECT d_total - COUNT(*), d_active - COUNT(*) FILTER (WHERE status = 'active'),
+               d_balance - COALESCE(SUM(balance_qc), 0), d_earned - COALESCE(SUM(earned_total_qc), 0)
+        INTO d_total, d_active, d_balance, d_earned
+        FROM old_rows;
+    END IF;
+    -- більшість UPDATE (мова, today_count) нічого не міняє — шард не чіпаємо
+    IF d_total <> 0 OR d_active <> 0 OR d_balance <> 0 OR d_earned <> 0 THEN
+        UPDATE stats_counters
+        SET users_total = users_total + d_total, users_active = users_active + d_active,
+            balance_sum = balance_sum + d_balance, earned_sum = earned_sum + d_earned,
+            updated_at = NOW()
+        WHERE id = qc_stats_shard();
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION qc_stats_count() RETURNS trigger
+LANGUAGE plpgsql AS $$
+DECLARE
+    d BIGINT;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        SELECT COUNT(*) INTO d FROM new_rows;
+    ELSE
+        SELECT -COUNT(*) INTO d FROM old_rows;
+    END IF;
+    IF d <> 0 THEN
+        IF TG_TABLE_NAME = 'payments' THEN
+            UPDATE stats_counters SET payments_total = payments_total + d, updated_at = NOW()
+            WHERE id = qc_stats_shard();
+        ELSE
+            UPDATE stats_counters SET referrals_total = referrals_total + d, updated_at = NOW()
+            WHERE id = qc_stats_shard();
+        END IF;
+    END IF;
+    RETURN NULL;
+END
+$$;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'qc_stats_users_ins') THEN
+        CREATE TRIGGER qc_stats_users_ins AFTER INSERT ON users
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION qc_stats_users();
+        CREATE TRIGGER qc_stats_users_upd AFTER UPDATE ON users
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION qc_stats_users();
+        CREATE TRIGGER qc_stats_users_del AFTER DELETE ON users
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION qc_stats_users();
+        CREATE TRIGGER qc_stats_payments_ins AFTER INSERT ON payments
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION qc_stats_count();
+        CREATE TRIGGER qc_stats_payments_del AFTER DELETE ON payments
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION qc_stats_count();
+        CREATE TRIGGER qc_stats_refs_ins AFTER INSERT ON referral_rewards
+            REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION qc_stats_count();
+        CREATE TRIGGER qc_stats_refs_del AFTER DELETE ON referral_rewards
+            REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION qc_stats_count();
+    END IF;
+END
+$$;
+
+-- Повний перерахунок без довгого блокування. Агрегати й суму шардів читаємо ОДНИМ statement'ом —
+-- один снапшот, у ньому лічильники й дані узгоджені з точністю до дрейфу (тригери пишуть у тій же
+-- транзакції, що й дані). Потім додаємо дрейф інкрементом у шард 0: блокується лише цей рядок і лише
+-- на цей UPDATE, а зміни, закомічені під час сканів, не губляться. Повертає дрейф.
+CREATE OR REPLACE FUNCTION qc_stats_resync()
+RETURNS TABLE (users_total BIGINT, users_active BIGINT, balance_sum BIGINT, earned_sum BIGINT,
+               payments_total BIGINT, referrals_total BIGINT)
+LANGUAGE plpgsql AS $$
+#variable_conflict use_column
+DECLARE
+    d stats_counters%ROWTYPE;
+BEGIN
+    INSERT INTO stats_counters (id) VALUES (0) ON CONFLICT (id) DO NOTHING;
+
+    SELECT a.users_total - s.users_total, a.users_active - s.users_active,
+           a.balance_sum - s.balance_sum, a.earned_sum - s.earned_sum,
+           (SELECT COUNT(*) FROM payments) - s.payments_total,
+           (SELECT COUNT(*) FROM referral_rewards) - s.referrals_total
+    INTO d.users_total, d.users_active, d.balance_sum, d.earned_sum, d.payments_total, d.referrals_total
+    FROM (SELECT SUM(c.users_total) AS users_total, SUM(c.users_active) AS users_active,
+                 SUM(c.balance_sum) AS balance_sum, SUM(c.earned_sum) AS earned_sum,
+                 SUM(c.payments_total) AS payments_total, SUM(c.referrals_total) AS referrals_total
+          FROM stats_counters c) s,
+         (SELECT COUNT(*) AS users_total, COUNT(*) FILTER (WHERE u.status = 'active') AS users_active,
+                 COALESCE(SUM(u.balance_qc), 0) AS balance_sum, COALESCE(SUM(u.earned_total_qc), 0) AS earned_sum
+          FROM users u) a;
+
+    UPDATE stats_counters s
+    SET users_total = s.users_total + d.users_total, users_active = s.users_active + d.users_active,
+        balance_sum = s.balance_sum + d.balance_sum, earned_sum = s.earned_sum + d.earned_sum,
+        payments_total = s.payments_total + d.payments_total,
+        referrals_total = s.referrals_total + d.referrals_total,
+        updated_at = NOW(), resynced_at = NOW()
+    WHERE s.id = 0;
+
+    RETURN QUERY SELECT d.users_total, d.users_active, d.balance_sum, d.earned_sum,
+                        d.payments_total, d.referrals_total;
+END
+$$;
+'''
+
+# Проекція журналу на users у тій самій транзакції. Перше розгортання: під блокуванням users
+# записуємо поточні баланси як opening-проводки й лише потім вмикаємо тригер — історія сходиться.
+LEDGER_SQL = '''
+CREATE OR REPLACE FUNCTION qc_ledger_apply() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    UPDATE users
+    SET balance_qc = balance_qc + NEW.amount,
+        earned_total_qc = earned_total_qc + NEW.earned_delta
+    WHERE id = NEW.user_id;
+    RETURN NULL;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION qc_ledger_readonly() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    RAISE EXCEPTION 'qc_ledger is append-only';
+END
+$$;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'qc_ledger_apply') THEN
+        LOCK TABLE users IN SHARE ROW EXCLUSIVE MODE;
+        INSERT INTO qc_ledger (user_id, amount, earned_delta, kind, ref_id)
+        SELECT id, balance_qc, earned_total_qc, 'opening', id FROM users
+        ON CONFLICT (kind, ref_id) DO NOTHING;
+        CREATE TRIGGER qc_ledger_apply AFTER INSERT ON qc_ledger
+            FOR EACH ROW EXECUTE FUNCTION qc_ledger_apply();
+        CREATE TRIGGER qc_ledger_readonly BEFORE UPDATE ON qc_ledger
+            FOR EACH ROW EXECUTE FUNCTION qc_ledger_readonly();
+    END IF;
+    -- видалення теж заборонене: і прямий DELETE/TRUNCATE, і каскад від users (раніше FK був CASCADE)
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'qc_ledger_nodelete') THEN
+        CREATE TRIGGER qc_ledger_nodelete BEFORE DELETE ON qc_ledger
+            FOR EACH ROW EXECUTE FUNCTION qc_ledger_readonly();
+        CREATE TRIGGER qc_ledger_notruncate BEFORE TRUNCATE ON qc_ledger
+            FOR EACH STATEMENT EXECUTE FUNCTION qc_ledger_readonly();
+    END IF;
+    IF EXISTS (SELECT 1 FROM pg_constraint
+               WHERE conname = 'qc_ledger_user_id_fkey' AND conrelid = 'qc_ledger'::regclass
+                 AND confdeltype = 'c') THEN
+        ALTER TABLE qc_ledger DROP CONSTRAINT qc_ledger_user_id_fkey,
+            ADD CONSTRAINT qc_ledger_user_id_fkey FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE RESTRICT;
+    END IF;
+END
+$$;
+'''
+
 async def run_stars_migration():
     await execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS provider TEXT")
     await execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS order_id TEXT")
@@ -121,5 +540,102 @@ async def run_stars_migration():
         ON payments(provider)
     """)
 
+async def run_payments_migration():
+    # термін дії інвойсу: прострочені не віддаємо юзеру
+    await execute("ALTER TABLE payments ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ")
+    # старі Mono-інвойси створювались з validityDuration=86400
+    await execute("""
+        UPDATE payments SET expires_at = created_at + INTERVAL '1 day'
+        WHERE provider='monopay' AND expires_at IS NULL AND status IN ('created','pending')
+    """)
+    # пошук відкритого інвойсу юзера по провайдеру
+    await execute("""
+        CREATE INDEX IF NOT EXISTS payments_open_idx
+        ON payments(user_id, provider, expires_at)
+        WHERE status IN ('created','pending')
+    """)
+    # звірка відкритих CryptoBot-інвойсів (keyset по id)
+    await execute("""
+        CREATE INDEX IF NOT EXISTS payments_cryptobot_open_idx
+        ON payments(id)
+        WHERE provider='cryptobot' AND status IN ('created','pending')
+    """)
+    # кандидати на фонове створення інвойсів (мову вибрали, не оплатили)
+    await execute("""
+        CREATE INDEX IF NOT EXISTS users_unpaid_idx
+        ON users(created_at)
+        WHERE status='inactive' AND language IS NOT NULL
+    """)
+
+async def run_referrals_migration():
+    await execute("ALTER TABLE referral_rewards ADD COLUMN IF NOT EXISTS amount_qc BIGINT")
+    # раньше вебхуки помечали бонус маркером payments(provider='ref_bonus', uuid='ref:<tg_id приглашённого>');
+    # переносим в referral_rewards, чтобы уже выплаченные бонусы не начислились повторно.
+    # user_id у маркеров почти всегда NULL (писал fallback-INSERT), так что пригласивший — referrer_id приглашённого
+    # Если referral_stats уже заполнены (миграция прошла раньше, со старым бэкфиллом) — досчитываем
+    # перенесённые сейчас награды инкрементом; на чистой базе их посчитает заполнение ниже.
+    await execute("""
+        WITH ins AS (
+            INSERT INTO referral_rewards (referrer_id, referee_id, awarded, awarded_at, amount_qc)
+            SELECT u.referrer_id, u.id, TRUE, p.created_at, $1
+            FROM payments p
+            JOIN users u ON 'ref:' || u.tg_id = p.uuid
+            WHERE p.provider='ref_bonus' AND p.uuid LIKE 'ref:%' AND u.referrer_id IS NOT NULL
+            ON CONFLICT (referee_id) DO NOTHING
+            RETURNING referrer_id, amount_qc
+        )
+        INSERT INTO referral_stats (user_id, activated, bonus_qc)
+        SELECT referrer_id, COUNT(*), SUM(amount_qc)
+        FROM ins
+        WHERE EXISTS (SELECT 1 FROM referral_stats)
+        GROUP BY referrer_id
+        ON CONFLICT (user_id) DO UPDATE
+            SET activated = referral_stats.activated + EXCLUDED.activated,
+                bonus_qc = referral_stats.bonus_qc + EXCLUDED.bonus_qc,
+                updated_at = NOW()
+    """, settings.REF_BONUS_QC)
+    # старий шлях через referral_rewards нараховував фіксовані 60 QC
+    await execute("UPDATE referral_rewards SET amount_qc=60 WHERE amount_qc IS NULL AND awarded")
+    # лічильники рефералів: одноразове заповнення з історії, далі — тільки інкременти
+    await execute("""
+        INSERT INTO referral_stats (user_id, invited, activated, bonus_qc, invited_l2)
+        SELECT r.id, COALESCE(l1.n, 0), COALESCE(a.n, 0), COALESCE(a.qc, 0), COALESCE(l2.n, 0)
+        FROM users r
+        LEFT JOIN (
+            SELECT referrer_id, COUNT(*) n FROM users WHERE referrer_id IS NOT NULL GROUP BY referrer_id
+        ) l1 ON l1.referrer_id = r.id
+        LEFT JOIN (
+            SELECT referrer_id, COUNT(*) n, SUM(COALESCE(amount_qc, 0)) qc
+            FROM referral_rewards WHERE awarded GROUP BY referrer_id
+        ) a ON a.referrer_id = r.id
+        LEFT JOIN (
+            SELECT p.referrer_id, COUNT(*) n
+            FROM users c JOIN users p ON p.id = c.referrer_id
+            WHERE p.referrer_id IS NOT NULL
+            GROUP BY p.referrer_id
+        ) l2 ON l2.referrer_id = r.id
+        WHERE (l1.n IS NOT NULL OR a.n IS NOT NULL OR l2.n IS NOT NULL)
+          AND NOT EXISTS (SELECT 1 FROM referral_stats)
+        ON CONFLICT (user_id) DO NOTHING
+    """)
+
+async def run_broadcast_migration():
+    # сегмент і мовні варіанти розсилки (services/segments.py)
+    await execute("ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS segment JSONB NOT NULL DEFAULT '{}'")
+    await execute("ALTER TABLE broadcast_jobs ADD COLUMN IF NOT EXISTS texts JSONB")
+    # індекси під умови сегментів
+    await execute("CREATE INDEX IF NOT EXISTS users_segment_idx ON users(status, language)")
+    await execute("CREATE INDEX IF NOT EXISTS users_earned_idx ON users(earned_total_qc)")
+    await execute("CREATE INDEX IF NOT EXISTS user_steps_user_done_idx ON user_steps(user_id, completed_at)")
+    await execute("""
+        CREATE INDEX IF NOT EXISTS withdrawals_pending_user_idx
+        ON withdrawals(user_id)
+        WHERE status='pending'
+    """)
+
 async def ensure_schema():
     await execute(SCHEMA_SQL)
+    # журнал — до qc_complete_step: нова функція пише в нього, проекція має вже працювати
+    await execute(LEDGER_SQL)
+    await execute(COMPLETE_STEP_SQL)
+    await execute(STATS_SQL)
@@ -0,0 +1,137 @@
+# app/services/admin_notify.py
+"""
+Уведомления админам о новых заявках на вывод.
+
+Хендлер только кладёт событие в очередь процесса (put_nowait) — ответ юзеру не ждёт Telegram.
+Фоновый воркер рассылает всем админам параллельно. Если заявок больше ADMIN_NOTIFY_MAX_PER_MIN
+за минуту, отдельные сообщения прекращаются: события копятся и раз в ADMIN_NOTIFY_DIGEST_SEC
+уходят одной сводкой «N новых заявок на X QC».
+Очередь в памяти: при рестарте теряются только уведомления, сами заявки — в БД (очередь в админке).
+"""
+import asyncio
+import html
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from ..config import settings
+
+log = logging.getLogger("admin_notify")
+
+QUEUE_SIZE = 1000
+QC_USD = 0.005  # 1 QC = $0.005
+
+_queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+_stats = {"queued": 0, "dropped": 0, "sent": 0, "digests": 0, "errors": 0}
+
+
+def admin_notify_stats() -> dict:
+    return {**_stats, "depth": _queue.qsize()}
+
+
+def withdrawal_created(user_row, wd_row, username: str | None):
+    """Не блокирует: событие в очередь; переполнение — только лог (заявка уже в БД)."""
+    try:
+        _queue.put_nowait({
+            "tg_id": user_row["tg_id"],
+            "username": (username or "").lstrip("@"),
+            "wd": dict(wd_row),
+        })
+        _stats["queued"] += 1
+    except asyncio.QueueFull:
+        _stats["dropped"] += 1
+        log.warning("admin notify queue full, dropped withdrawal #%s", wd_row["id"])
+
+
+# ===================== Тексты
+
+def _queue_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text="📥 Черга виводів", callback_data="wq:pending:0")
+    ]])
+
+
+def _format_one(ev: dict) -> str:
+    wd, tg_id = ev["wd"], ev["tg_id"]
+    esc = lambda v: html.escape(str(v or ""))  # поля вводить юзер, а повідомлення — HTML
+    # посилання працює навіть без username
+    contact = f"<a href='tg://user?id={tg_id}'>#{tg_id}</a>"
+    if ev["username"]:
+        contact += f" (@{esc(ev['username'])})"
+    return (
+        "💸 Нова заявка на вивід\n\n"
+        f"ID заявки: <code>{wd['id']}</code>\n"
+        f"Користувач: {contact}\n"
+        f"Сума: <b>{wd['amount_qc']} QC</b> (~${wd['amount_qc'] * QC_USD:.2f})\n"
+        f"Країна: {esc(wd['country'])}\n"
+        f"Спосіб: {esc(wd['method'])}\n"
+        f"Реквізити: {esc(wd['details'])}\n"
+        f"Статус: {wd['status']}"
+    )
+
+
+def _format_digest(events: list[dict]) -> str:
+    total = sum(ev["wd"]["amount_qc"] for ev in events)
+    ids = [ev["wd"]["id"] for ev in events]
+    return (
+        f"💸 Нових заявок на вивід: <b>{len(events)}</b>\n"
+        f"Разом: <b>{total} QC</b> (~${total * QC_USD:.2f})\n"
+        f"ID: {min(ids)}…{max(ids)}"
+    )
+
+
+# ===================== Доставка
+
+async def _send(bot: Bot, admin_id: int, text: str, markup=None):
+    for _ in range(2):
+        try:
+            await bot.send_message(admin_id, text, reply_markup=markup)
+            _stats["sent"] += 1
+            return
+        except TelegramRetryAfter as e:
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            _stats["errors"] += 1
+            log.debug("admin %s notify failed: %s: %s", admin_id, type(e).__name__, e)
+            return
+
+
+async def _fan_out(bot: Bot, text: str, markup=None):
+    await asyncio.gather(*(_send(bot, a, text, markup) for a in settings.ADMIN_IDS))
+
+
+async def admin_notify_loop(bot: Bot):
+    recent: deque[float] = deque()   # моменты отдельных уведомлений за последнюю минуту
+    digest: list[dict] = []
+    digest_due = 0.0
+    while True:
+        timeout = max(digest_due - time.monotonic(), 0) if digest else None
+        try:
+            ev = await asyncio.wait_for(_queue.get(), timeout)
+        except asyncio.TimeoutError:
+            ev = None
+        try:
+            now = time.monotonic()
+            while recent and recent[0] < now - 60:
+                recent.popleft()
+            if ev is not None:
+                if not digest and len(recent) < settings.ADMIN_NOTIFY_MAX_PER_MIN:
+                    recent.append(now)
+                    await _fan_out(bot, _format_one(ev))
+                else:
+                    if not digest:
+                        digest_due = now + settings.ADMIN_NOTIFY_DIGEST_SEC
+                    digest.append(ev)
+            if digest and time.monotonic() >= digest_due:
+                events, digest = digest, []
+                _stats["digests"] += 1
+                await _fan_out(bot, _format_digest(events), _queue_kb())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _stats["errors"] += 1
+            log.warning("admin notify iteration failed: %s: %s", type(e).__name__, e)
@@ -0,0 +1,233 @@
+# app/services/broadcast.py
+"""
+Рассылки админа.
+
+Задача — строка broadcast_jobs. Воркер (broadcast_loop, на каждой реплике) берёт одну активную
+задачу с протухшим heartbeat и ведёт её:
+  - получатели читаются серверным курсором на отдельном соединении — список не грузится в память
+    и не занимает маленький пул; курсор переоткрываем каждые CURSOR_ROWS строк от чекпойнта,
+    чтобы не держать транзакцию/снимок весь прогон;
+  - отправка параллельная, но не быстрее BROADCAST_RPS (общий TokenBucket); RetryAfter
+    замораживает ведро целиком — это глобальный флуд-лимит бота, а не одного чата;
+  - после каждой пачки BROADCAST_CHUNK — чекпойнт одним UPDATE: last_user_id и счётчики,
+    он же продлевает аренду и возвращает статус (отмена из админки).
+После рестарта продолжаем с чекпойнта: повторно может уйти не больше одной пачки.
+Аудитория — сегмент задачи (services/segments.py), текст — вариант по языку получателя.
+Каждому получателю уходит одно сообщение, так что пер-чатовый лимит (~1 msg/s) не достигается.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+from ..config import settings
+from ..db import APP_NAME, dedicated_connection, fetchrow, fetchval, notify, on_notify
+from ..utils.i18n import i18n
+from ..utils.ratelimit import TokenBucket
+from . import segments
+
+log = logging.getLogger("broadcast")
+
+CHANNEL = "qc_broadcast"
+IDLE_SEC = 30.0
+LEASE_SEC = 120            # без heartbeat столько — задачу подхватит другая реплика
+CURSOR_ROWS = 5000
+PROGRESS_EVERY_SEC = 3.0
+MAX_ATTEMPTS = 3
+
+_wakeup = asyncio.Event()
+_bucket = TokenBucket(settings.BROADCAST_RPS, settings.BROADCAST_RPS)
+_stats = {"jobs": 0, "sent": 0, "failed": 0, "retry_after": 0, "throttled_sec": 0.0}
+
+
+def broadcast_stats() -> dict:
+    return dict(_stats)
+
+
+on_notify(CHANNEL, lambda _payload: _wakeup.set())
+
+
+# ===================== API для админки
+
+async def create_job(admin_tg: int, lang: str, texts: dict[str, str], segment: dict, total: int) -> int:
+    """texts — варианты {lang|'*': текст} из segments.parse; total — segments.count(segment)."""
+    job_id = await fetchval("""
+        INSERT INTO broadcast_jobs (admin_tg, lang, text, texts, segment, total)
+        VALUES ($1, $2, $3, $4::jsonb, $5::jsonb, $6)
+        RETURNING id
+    """, admin_tg, lang, texts.get(segments.DEFAULT) or next(iter(texts.values())),
+        json.dumps(texts), json.dumps(segment), total)
+    await notify(CHANNEL)
+    return job_id
+
+
+async def attach_progress(job_id: int, chat_id: int, msg_id: int):
+    """Сообщение, которое воркер будет редактировать прогрессом."""
+    await fetchrow(
+        "UPDATE broadcast_jobs SET progress_chat_id=$2, progress_msg_id=$3 WHERE id=$1 RETURNING id",
+        job_id, chat_id, msg_id,
+    )
+
+
+async def cancel_job(job_id: int) -> bool:
+    return await fetchval("""
+        UPDATE broadcast_jobs SET status='canceled', finished_at=NOW()
+        WHERE id=$1 AND status IN ('queued','running')
+        RETURNING TRUE
+    """, job_id) or False
+
+
+def progress_text(job) -> str:
+    return i18n.t(job["lang"], "broadcast_progress", id=job["id"], ok=job["sent"],
+                  bad=job["failed"], total=job["total"])
+
+
+def cancel_kb(job_id: int, lang: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[[
+        InlineKeyboardButton(text=i18n.t(lang, "broadcast_cancel"), callback_data=f"bc_cancel:{job_id}")
+    ]])
+
+
+# ===================== Воркер
+
+async def _send_one(bot: Bot, tg_id: int, text: str) -> bool:
+    attempt = 0
+    while True:
+        _stats["throttled_sec"] += await _bucket.acquire()
+        try:
+            await bot.send_message(tg_id, text)
+            return True
+        except TelegramRetryAfter as e:
+            # не ошибка получателя: ждём вместе со всеми и пробуем снова
+            _stats["retry_after"] += 1
+            _bucket.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest):
+            # заблокировал бота / чат не найден — повтор не поможет
+            return False
+        except Exception as e:
+            attempt += 1
+            if attempt >= MAX_ATTEMPTS:
+                log.debug("send to %s failed: %s: %s", tg_id, type(e).__name__, e)
+                return False
+            await asyncio.sleep(2 ** attempt)
+
+
+async def _claim():
+    # свои задачи (owner = мы, т.е. процесс перезапустился) берём сразу, чужие — по протухшей аренде
+    return await fetchrow("""
+        UPDATE broadcast_jobs SET status='running', owner=$1, heartbeat_at=NOW()
+        WHERE id = (
+            SELECT id FROM broadcast_jobs
+            WHERE status IN ('queued','running')
+              AND (heartbeat_at IS NULL OR owner = $1
+                   OR heartbeat_at < NOW() - make_interval(secs => $2))
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """, APP_NAME, LEASE_SEC)
+
+
+async def _edit_progress(bot: Bot, job, text: str, markup=None):
+    if not job["progress_msg_id"]:
+        return
+    try:
+        await bot.edit_message_text(text, chat_id=job["progress_chat_id"],
+                                    message_id=job["progress_msg_id"], reply_markup=markup)
+    except TelegramBadRequest:
+        pass  # message is not modified / удалено
+    except Exception as e:
+        log.debug("progress edit failed: %s: %s", type(e).__name__, e)
+
+
+async def _flush(bot: Bot, job_id: int, texts: dict[str, str], chunk: list):
+    """Отправить пачку и записать чекпойнт. -> строка задачи или None, если аренду перехватили."""
+    sem = asyncio.Semaphore(settings.BROADCAST_CONCURRENCY)
+
+    async def one(r):
+        text = texts.get(r["language"]) or texts.get(segments.DEFAULT)
+        if not text:
+            return False  # сегмент отсекает такие языки; сюда попадём, только если язык сменили на ходу
+        async with sem:
+            return await _send_one(bot, r["tg_id"], text)
+
+    results = await asyncio.gather(*(one(r) for r in chunk))
+    ok = sum(results)
+    bad = len(results) - ok
+    _stats["sent"] += ok
+    _stats["failed"] += bad
+    return await fetchrow("""
+        UPDATE broadcast_jobs
+        SET last_user_id=$2, sent=sent+$3, failed=failed+$4, heartbeat_at=NOW()
+        WHERE id=$1 AND owner=$5
+        RETURNING *
+    """, job_id, chunk[-1]["id"], ok, bad, APP_NAME)
+
+
+async def run_job(bot: Bot, job):
+    job_id = job["id"]
+    texts = json.loads(job["texts"]) if job["texts"] else {segments.DEFAULT: job["text"]}
+    where, seg_args = segments.compile_where(json.loads(job["segment"] or "{}"), first_arg=2)
+    query = f"SELECT u.id, u.tg_id, u.language FROM users u WHERE u.id > $1 AND {where} ORDER BY u.id"
+    last = job["last_user_id"]
+    log.info("broadcast #%s: start from user_id>%s", job_id, last)
+    progress_at = 0.0
+    con = await dedicated_connection()
+    try:
+        while job["status"] == "running":
+            chunk, read = [], 0
+            async with con.transaction(readonly=True):
+                async for r in con.cursor(query, last, *seg_args, prefetch=settings.BROADCAST_CHUNK):
+                    chunk.append(r)
+                    read += 1
+                    if len(chunk) < settings.BROADCAST_CHUNK and read < CURSOR_ROWS:
+                        continue
+                    job = await _flush(bot, job_id, texts, chunk)
+                    chunk = []
+                    if job is None or job["status"] != "running" or read >= CURSOR_ROWS:
+                        break
+                    last = job["last_user_id"]
+                    if time.monotonic() - progress_at >= PROGRESS_EVERY_SEC:
+                        progress_at = time.monotonic()
+                        await _edit_progress(bot, job, progress_text(job), cancel_kb(job_id, job["lang"]))
+            if chunk:
+                job = await _flush(bot, job_id, texts, chunk)
+            if job is None:
+                log.warning("broadcast #%s: lease lost", job_id)
+                return
+            if read < CURSOR_ROWS and job["status"] == "running":
+                # курсор кончился раньше лимита — получателей больше нет
+                job = await fetchrow("""
+                    UPDATE broadcast_jobs SET status='done', finished_at=NOW()
+                    WHERE id=$1 AND status='running' RETURNING *
+                """, job_id) or job
+            last = job["last_user_id"]
+    finally:
+        await con.close()
+
+    log.info("broadcast #%s: %s, sent=%s failed=%s", job_id, job["status"], job["sent"], job["failed"])
+    await _edit_progress(bot, job, i18n.t(job["lang"], "broadcast_done", ok=job["sent"], bad=job["failed"]))
+
+
+async def broadcast_loop(bot: Bot):
+    while True:
+        try:
+            job = await _claim()
+            if job:
+                _stats["jobs"] += 1
+                await run_job(bot, job)
+                continue
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("broadcast iteration failed: %s: %s", type(e).__name__, e)
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), IDLE_SEC)
+        except asyncio.TimeoutError:
+            pass
@@ -0,0 +1,147 @@
+# app/services/catalog.py
+"""
+Каталог цепочек/шагов в памяти процесса.
+
+chains/steps меняет только админка, поэтому читаем их из БД один раз на старте
+и пересобираем целиком по NOTIFY (в т.ч. с других реплик). Снимок неизменяемый:
+читатели берут ссылку на текущий Catalog, пересборка подменяет её одной операцией.
+"""
+import asyncio
+import logging
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Mapping
+
+from ..db import fetch, notify, on_notify
+from ..utils.links import normalize_url
+
+log = logging.getLogger("catalog")
+
+CHANNEL = "qc_catalog"
+LANGS = ("uk", "ru", "en")
+
+
+@dataclass(frozen=True, slots=True)
+class Step:
+    id: int
+    chain_id: int
+    order_no: int
+    url: str                 # уже нормализован
+    reward_qc: int
+    verify_chat_id: int | None
+    is_active: bool
+    titles: tuple[str, ...]  # в порядке LANGS
+    descs: tuple[str, ...]
+
+    def title(self, lang: str) -> str:
+        return self.titles[_lang_idx(lang)]
+
+    def desc(self, lang: str) -> str:
+        return self.descs[_lang_idx(lang)]
+
+
+@dataclass(frozen=True, slots=True)
+class Chain:
+    id: int
+    key: str
+    is_active: bool
+    steps: tuple[Step, ...]  # только активные, по order_no
+
+
+@dataclass(frozen=True, slots=True)
+class Catalog:
+    chains: tuple[Chain, ...]
+    by_chain: Mapping[int, Chain]
+    by_step: Mapping[int, Step]  # все шаги, включая выключенные
+
+
+def _lang_idx(lang: str) -> int:
+    return LANGS.index(lang) if lang in LANGS else LANGS.index("en")
+
+
+_EMPTY = Catalog((), MappingProxyType({}), MappingProxyType({}))
+_catalog: Catalog | None = None
+_reload_lock = asyncio.Lock()
+_reload_task: asyncio.Task | None = None
+_dirty = False
+
+
+async def _build() -> Catalog:
+    chain_rows = await fetch("SELECT id, key, is_active FROM chains ORDER BY id ASC")
+    step_rows = await fetch("SELECT * FROM steps ORDER BY chain_id ASC, order_no ASC")
+
+    by_step: dict[int, Step] = {}
+    per_chain: dict[int, list[Step]] = {}
+    for r in step_rows:
+        st = Step(
+            id=r["id"],
+            chain_id=r["chain_id"],
+            order_no=r["order_no"],
+            url=normalize_url(r["url"]),
+            reward_qc=r["reward_qc"],
+            verify_chat_id=r["verify_chat_id"],
+            is_active=r["is_active"],
+            titles=tuple(r[f"title_{l}"] or "" for l in LANGS),
+            descs=tuple(r[f"desc_{l}"] or "" for l in LANGS),
+        )
+        by_step[st.id] = st
+        if st.is_active:
+            per_chain.setdefault(st.chain_id, []).append(st)
+
+    chains = tuple(
+        Chain(r["id"], r["key"], r["is_active"], tuple(per_chain.get(r["id"], ())))
+        for r in chain_rows
+    )
+    return Catalog(
+        chains=chains,
+        by_chain=MappingProxyType({c.id: c for c in chains}),
+        by_step=MappingProxyType(by_step),
+    )
+
+
+async def reload() -> Catalog:
+    global _catalog
+    async with _reload_lock:
+        _catalog = await _build()
+    log.info("catalog loaded: %d chains, %d steps", len(_catalog.chains), len(_catalog.by_step))
+    return _catalog
+
+
+async def get() -> Catalog:
+    if _catalog is None:
+        return await reload()
+    return _catalog
+
+
+def current() -> Catalog:
+    return _catalog or _EMPTY
+
+
+async def _drain():
+    global _dirty
+    while _dirty:
+        _dirty = False
+        try:
+            await reload()
+        except Exception as e:
+            log.warning("catalog reload failed: %s: %s", type(e).__name__, e)
+
+
+def _on_notify(_payload: str | None):
+    # пачка NOTIFY подряд схлопывается; пришедший во время пересборки — даст ещё один проход
+    global _reload_task, _dirty
+    _dirty = True
+    if _reload_task is None or _reload_task.done():
+        _reload_task = asyncio.get_running_loop().create_task(_drain())
+
+
+on_notify(CHANNEL, _on_notify)
+
+
+async def notify_changed():
+    """Вызывать после любой правки chains/steps: пересобираем у себя и будим остальные реплики."""
+    await reload()
+    try:
+        await notify(CHANNEL)
+    except Exception as e:
+        log.warning("catalog notify failed: %s: %s", type(e).__name__, e)
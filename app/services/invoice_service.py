@@ -0,0 +1,206 @@
+# app/services/invoice_service.py
+"""
+Инвойсы активации (MonoPay + CryptoBot) для экрана оплаты.
+
+Открытые инвойсы обоих провайдеров берём одним запросом, недостающие создаём параллельно,
+а параллельные запросы одного юзера (/start и тут же lang:) ждут одну и ту же операцию —
+без дублей инвойсов.
+
+У инвойса есть срок (payments.expires_at): истекающие раньше чем через INVOICE_REFRESH_MARGIN_SEC
+не показываем. Фоновый prewarm_loop() заранее создаёт свежие инвойсы тем, кто выбрал язык,
+но не оплатил, — экран активации обычно отдаётся из БД без похода к провайдерам.
+Если провайдер не отвечает, prewarm его не трогает с экспоненциальным backoff (до PROVIDER_BACKOFF_MAX_SEC),
+юзеры с неудачей пропускаются на USER_BACKOFF_SEC; истёкшие инвойсы переводим в expired тем же проходом.
+"""
+import asyncio
+import logging
+import time
+
+from ..config import settings
+from ..db import fetch, execute
+from .tasks_service import get_user_by_id
+from ..utils.payments import create_monopay_invoice, create_cryptobot_invoice
+
+log = logging.getLogger("invoices")
+
+PROVIDER_BACKOFF_MIN_SEC = 30
+PROVIDER_BACKOFF_MAX_SEC = 3600
+USER_BACKOFF_SEC = 1800
+EXPIRE_BATCH = 1000
+
+_inflight: dict[int, asyncio.Task] = {}  # user_id -> задача провижининга
+_provider_fails: dict[str, tuple[int, float]] = {}  # provider -> (ошибок подряд, не трогать до monotonic)
+_user_retry_at: dict[int, float] = {}               # user_id -> не греть до monotonic
+
+
+def _provider_failed(provider: str):
+    fails = _provider_fails.get(provider, (0, 0.0))[0] + 1
+    delay = min(PROVIDER_BACKOFF_MIN_SEC * 2 ** (fails - 1), PROVIDER_BACKOFF_MAX_SEC)
+    _provider_fails[provider] = (fails, time.monotonic() + delay)
+
+
+def _provider_ok(provider: str) -> bool:
+    return _provider_fails.get(provider, (0, 0.0))[1] <= time.monotonic()
+
+
+async def _provision(user_row) -> tuple[str | None, str | None]:
+    user_id = user_row["id"]
+    tg_id = user_row["tg_id"]
+
+    # 1) открытые и не истекающие инвойсы обоих провайдеров — одним запросом (payments_open_idx)
+    rows = await fetch(
+        """SELECT DISTINCT ON (provider) provider, link
+           FROM payments
+           WHERE user_id=$1 AND provider IN ('monopay','cryptobot') AND status IN ('created','pending')
+             AND (expires_at IS NULL OR expires_at > NOW() + make_interval(secs => $2))
+           ORDER BY provider, id DESC""",
+        user_id, settings.INVOICE_REFRESH_MARGIN_SEC,
+    )
+    links = {r["provider"]: r["link"] for r in rows}
+
+    # 2) недостающие — параллельно
+    order_suffix = str(int(time.time()))
+    description = "Activation"
+    jobs = {}
+    if not links.get("monopay") and settings.MONOPAY_TOKEN:
+        jobs["monopay"] = (f"ACT-MONO:{tg_id}:{order_suffix}", "UAH", create_monopay_invoice)
+    if not links.get("cryptobot") and settings.CRYPTO_PAY_TOKEN:
+        jobs["cryptobot"] = (f"ACT-CRYPTO:{tg_id}:{order_suffix}", "USD", create_cryptobot_invoice)
+
+    if jobs:
+        results = await asyncio.gather(
+            *(create(order_id=order_id, description=description) for order_id, _, create in jobs.values()),
+            return_exceptions=True,
+        )
+        providers, uuids, urls, currencies, order_ids = [], [], [], [], []
+        for (provider, (order_id, currency, _)), inv in zip(jobs.items(), results):
+            if isinstance(inv, BaseException):
+                # один провайдер лёг — второй всё равно покажем
+                log.warning("%s invoice create failed for user %s: %s: %s",
+                            provider, user_id, type(inv).__name__, inv)
+                _provider_failed(provider)
+                continue
+            _provider_fails.pop(provider, None)
+            providers.append(provider)
+            uuids.append(inv.invoice_id)
+            urls.append(inv.pay_url)
+            currencies.append(currency)
+            order_ids.append(order_id)
+            links[provider] = inv.pay_url
+
+        if providers:
+            await execute(
+                """INSERT INTO payments (user_id, provider, uuid, link, status, currency, amount_usd, order_id, expires_at)
+                   SELECT $1, t.provider, t.uuid, t.link, 'created', t.currency, $2, t.order_id,
+                          NOW() + make_interval(secs => $8)
+                   FROM unnest($3::text[], $4::text[], $5::text[], $6::text[], $7::text[])
+                        AS t(provider, uuid, link, currency, order_id)""",
+                user_id, settings.PRICE_USD, providers, uuids, urls, currencies, order_ids,
+                settings.INVOICE_TTL_SEC,
+            )
+
+    return links.get("monopay"), links.get("cryptobot")
+
+
+async def get_or_create_invoices(user_row) -> tuple[str | None, str | None]:
+    """
+    Возвращает (pay_url_mono, pay_url_crypto).
+    Одновременные вызовы для одного юзера схлопываются в одну операцию.
+    """
+    user_id = user_row["id"]
+    task = _inflight.get(user_id)
+    if task is None:
+        task = asyncio.create_task(_provision(user_row))
+        _inflight[user_id] = task
+        task.add_done_callback(lambda _t: _inflight.pop(user_id, None))
+    # shield: отмена одного ожидающего не должна убивать общую операцию
+    return await asyncio.shield(task)
+
+
+# ===================== Фоновое создание инвойсов
+
+async def expire_stale() -> int:
+    """Истёкшие открытые инвойсы -> expired (поздний вебхук всё равно проведётся: SETTLE_SQL ищет по uuid)."""
+    res = await execute("""
+        UPDATE payments SET status='expired', updated_at=NOW()
+        WHERE id IN (
+            SELECT id FROM payments
+            WHERE status IN ('created','pending') AND expires_at < NOW()
+            LIMIT $1
+        )
+    """, EXPIRE_BATCH)
+    return int(res.split()[-1])  # 'UPDATE n'
+
+
+async def prewarm_once(batch: int) -> tuple[int, int]:
+    """
+    Одна пачка: юзеры без свежего инвойса хотя бы у одного включённого и живого провайдера.
+    -> (взято юзеров, из них получили все нужные инвойсы).
+    """
+    want_mono = bool(settings.MONOPAY_TOKEN) and _provider_ok("monopay")
+    want_crypto = bool(settings.CRYPTO_PAY_TOKEN) and _provider_ok("cryptobot")
+    if not (want_mono or want_crypto):
+        return 0, 0
+    now = time.monotonic()
+    for uid in [uid for uid, t in _user_retry_at.items() if t <= now]:
+        del _user_retry_at[uid]
+    rows = await fetch("""
+        SELECT u.id
+        FROM users u
+        WHERE u.status='inactive' AND u.language IS NOT NULL
+          AND u.created_at > NOW() - make_interval(days => $3)
+          AND u.id <> ALL($6::bigint[])
+          AND (
+              ($1 AND NOT EXISTS (
+                  SELECT 1 FROM payments p
+                  WHERE p.user_id=u.id AND p.provider='monopay' AND p.status IN ('created','pending')
+                    AND (p.expires_at IS NULL OR p.expires_at > NOW() + make_interval(secs => $4))
+              ))
+              OR
+              ($2 AND NOT EXISTS (
+                  SELECT 1 FROM payments p
+                  WHERE p.user_id=u.id AND p.provider='cryptobot' AND p.status IN ('created','pending')
+                    AND (p.expires_at IS NULL OR p.expires_at > NOW() + make_interval(secs => $4))
+              ))
+          )
+        ORDER BY u.created_at DESC
+        LIMIT $5
+    """, want_mono, want_crypto, settings.INVOICE_PREWARM_MAX_AGE_DAYS,
+        settings.INVOICE_REFRESH_MARGIN_SEC, batch, list(_user_retry_at))
+
+    # по одному: не грузим провайдеров и пул пачкой запросов
+    warmed = 0
+    for r in rows:
+        user = await get_user_by_id(r["id"])
+        if not user or user["status"] == "active":
+            continue
+        mono, crypto_link = await get_or_create_invoices(user)
+        if (want_mono and not mono) or (want_crypto and not crypto_link):
+            # этот юзер снова окажется первым в выборке — не долбим провайдера им каждый проход
+            _user_retry_at[r["id"]] = time.monotonic() + USER_BACKOFF_SEC
+            if not (_provider_ok("monopay") or _provider_ok("cryptobot")):
+                break  # лежат все — остаток пачки подождёт backoff
+        else:
+            warmed += 1
+    return len(rows), warmed
+
+
+async def prewarm_loop():
+    interval = settings.INVOICE_PREWARM_INTERVAL_SEC
+    if interval <= 0:
+        return
+    while True:
+        n = warmed = 0
+        try:
+            expired = await expire_stale()
+            if expired:
+                log.info("expired %d stale invoices", expired)
+            n, warmed = await prewarm_once(settings.INVOICE_PREWARM_BATCH)
+            if warmed:
+                log.info("prewarmed invoices for %d users", warmed)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("invoice prewarm failed: %s: %s", type(e).__name__, e)
+        # полная пачка с прогрессом — вероятно, есть ещё; без прогресса ждём полный интервал
+        await asyncio.sleep(5 if n >= settings.INVOICE_PREWARM_BATCH and warmed else interval)
@@ -0,0 +1,43 @@
+# app/services/ledger.py
+"""
+Журнал QC (qc_ledger).
+
+Любое изменение баланса — INSERT проводки; users.balance_qc / earned_total_qc обновляет тригер
+журнала в той же транзакции (schema.LEDGER_SQL), так что чтение баланса остаётся O(1),
+а история восстанавливается суммой проводок по юзеру. Проводки не меняются и не удаляются
+(тригеры qc_ledger_readonly / qc_ledger_nodelete, FK на users — RESTRICT).
+Виды: opening (баланс на момент включения журнала), step, referral, admin,
+withdraw_hold (резерв под заявку на вывод), withdraw_release (возврат резерва при отказе).
+"""
+from ..db import fetchrow
+
+USERS_CHANNEL = "qc_users"  # см. tasks_service.USERS_CHANNEL
+
+# Заявка на вывод и холд — один statement. Строка юзера блокируется (FOR UPDATE), поэтому две
+# параллельные заявки сериализуются, и вторая перепроверит balance_qc >= суммы уже после первой.
+RESERVE_SQL = f"""
+WITH u AS (
+    SELECT id, tg_id FROM users
+    WHERE tg_id=$1 AND $2 > 0 AND balance_qc >= $2
+    FOR UPDATE
+),
+w AS (
+    INSERT INTO withdrawals (user_id, amount_qc, country, method, details, method_code)
+    SELECT id, $2, $3, $4, $5, $6 FROM u
+    RETURNING id, user_id, amount_qc, country, method, details, method_code, status, created_at
+),
+l AS (
+    INSERT INTO qc_ledger (user_id, amount, kind, ref_id)
+    SELECT user_id, -amount_qc, 'withdraw_hold', id FROM w
+    RETURNING id
+)
+SELECT w.*, (SELECT id FROM l) AS ledger_id,
+       pg_notify('{USERS_CHANNEL}', u.tg_id::text || ':') AS _n
+FROM w JOIN u ON u.id = w.user_id
+"""
+
+
+async def reserve_withdrawal(tg_id: int, amount_qc: int, country: str, method: str, details: str,
+                             method_code: str | None = None):
+    """Создать заявку и зарезервировать сумму. None — не хватает баланса (или сумма <= 0)."""
+    return await fetchrow(RESERVE_SQL, tg_id, amount_qc, country, method, details, method_code)
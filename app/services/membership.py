@@ -0,0 +1,111 @@
+# app/services/membership.py
+"""
+Проверка подписки (steps.verify_chat_id) через getChatMember.
+
+- короткий кеш ответа на (chat, user): «да» живёт дольше, «нет» — коротко (юзер мог только что вступить);
+- одновременные проверки одной пары ждут один и тот же запрос;
+- общий token bucket на все getChatMember, чтобы не ловить флуд-лимиты Telegram.
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from ..config import settings
+from ..utils.ratelimit import TokenBucket
+
+log = logging.getLogger("membership")
+
+OK_STATUSES = ("member", "administrator", "creator")
+MAX_ENTRIES = 50_000
+
+_cache: dict[tuple[int, int], tuple[float, bool]] = {}  # (chat, user) -> (expires, ok)
+_inflight: dict[tuple[int, int], asyncio.Future] = {}
+_bucket = TokenBucket(settings.MEMBER_CHECK_RPS, settings.MEMBER_CHECK_BURST)
+
+_stats = {
+    "hits": 0,
+    "misses": 0,
+    "coalesced": 0,
+    "api_calls": 0,
+    "throttled": 0,      # сколько раз ждали токен
+    "throttled_sec": 0.0,
+    "retry_after": 0,
+    "errors": 0,
+}
+
+
+def membership_stats() -> dict:
+    total = _stats["hits"] + _stats["misses"]
+    return {
+        **_stats,
+        "size": len(_cache),
+        "inflight": len(_inflight),
+        "hit_rate": round(_stats["hits"] / total, 4) if total else 0.0,
+    }
+
+
+def _store(key: tuple[int, int], ok: bool):
+    ttl = settings.MEMBER_CACHE_TTL_OK if ok else settings.MEMBER_CACHE_TTL_NO
+    if len(_cache) >= MAX_ENTRIES:
+        now = time.monotonic()
+        for k in [k for k, (exp, _) in _cache.items() if exp < now]:
+            del _cache[k]
+        while len(_cache) >= MAX_ENTRIES:
+            del _cache[next(iter(_cache))]
+    _cache[key] = (time.monotonic() + ttl, ok)
+
+
+async def _ask(bot: Bot, chat_id: int, user_id: int) -> bool | None:
+    """None — ответа нет (троттлинг/ошибка), такой результат не кешируем."""
+    waited = await _bucket.acquire()
+    if waited:
+        _stats["throttled"] += 1
+        _stats["throttled_sec"] += waited
+    _stats["api_calls"] += 1
+    try:
+        member = await bot.get_chat_member(chat_id, user_id)
+    except TelegramRetryAfter as e:
+        _stats["retry_after"] += 1
+        _bucket.pause(e.retry_after)
+        log.warning("getChatMember RetryAfter %ss (chat %s)", e.retry_after, chat_id)
+        return None
+    except TelegramBadRequest:
+        # «user not found»/«member list is inaccessible» — для нас это «не подписан»
+        return False
+    except Exception as e:
+        _stats["errors"] += 1
+        log.warning("getChatMember failed (chat %s): %s: %s", chat_id, type(e).__name__, e)
+        return None
+    return member is not None and getattr(member, "status", None) in OK_STATUSES
+
+
+async def is_member(bot: Bot, chat_id: int, user_id: int) -> bool:
+    key = (chat_id, user_id)
+    item = _cache.get(key)
+    if item is not None and item[0] >= time.monotonic():
+        _stats["hits"] += 1
+        return item[1]
+    _stats["misses"] += 1
+
+    fut = _inflight.get(key)
+    if fut is not None:
+        _stats["coalesced"] += 1
+        return await asyncio.shield(fut)
+
+    fut = asyncio.get_running_loop().create_future()
+    _inflight[key] = fut
+    try:
+        ok = await _ask(bot, chat_id, user_id)
+        if ok is not None:
+            _store(key, ok)
+        fut.set_result(bool(ok))
+        return bool(ok)
+    except BaseException as e:
+        fut.set_exception(e)
+        fut.exception()  # помечаем как полученное, чтобы asyncio не ругался без ожидающих
+        raise
+    finally:
+        _inflight.pop(key, None)
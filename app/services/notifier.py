@@ -0,0 +1,142 @@
+# app/services/notifier.py
+"""
+Transactional outbox для сообщений юзерам.
+
+Строку в notifications_outbox пишет та же транзакция, что меняет данные (например settle_payment
+при активации), а этот воркер доставляет её в Telegram. Ничего не теряется при падении между
+COMMIT и отправкой, и ничего не уходит, если транзакция откатилась.
+Будим воркер через NOTIFY qc_outbox (с любой реплики), плюс редкий опрос на всякий случай.
+"""
+import asyncio
+import json
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+
+from ..db import execute, fetch, on_notify
+from ..utils.i18n import i18n
+from ..utils.keyboards import main_menu_kb
+
+log = logging.getLogger("notifier")
+
+CHANNEL = "qc_outbox"
+BATCH = 20
+CONCURRENCY = 5
+IDLE_SEC = 10.0
+LEASE_SEC = 60
+MAX_ATTEMPTS = 6
+
+_wakeup = asyncio.Event()
+_stats = {"sent": 0, "retried": 0, "failed": 0}
+
+
+def notifier_stats() -> dict:
+    return dict(_stats)
+
+
+on_notify(CHANNEL, lambda _payload: _wakeup.set())
+
+
+# ===================== Рендер по kind
+
+def _render_activated(lang: str, payload: dict):
+    texts = i18n._texts.get(lang) or i18n._texts["en"]
+    return texts.get("activated", "✅ Доступ активирован."), main_menu_kb(texts)
+
+
+_RENDERERS = {
+    "activated": _render_activated,
+}
+
+
+# ===================== Доставка
+
+async def _deliver(bot: Bot, row) -> tuple[str, str | None, float]:
+    """-> (результат sent|retry|failed, ошибка, через сколько секунд повторить)."""
+    render = _RENDERERS.get(row["kind"])
+    if render is None:
+        return "failed", f"unknown kind {row['kind']}", 0
+    payload = json.loads(row["payload"]) if row["payload"] else {}
+    text, markup = render(row["language"] or "en", payload)
+    try:
+        await bot.send_message(row["tg_id"], text, reply_markup=markup)
+        return "sent", None, 0
+    except TelegramRetryAfter as e:
+        return "retry", f"RetryAfter {e.retry_after}", e.retry_after
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # заблокировал бота / чат не найден — повтор не поможет
+        return "failed", f"{type(e).__name__}: {e}", 0
+    except Exception as e:
+        if row["attempts"] >= MAX_ATTEMPTS:
+            return "failed", f"{type(e).__name__}: {e}", 0
+        return "retry", f"{type(e).__name__}: {e}", min(2 ** row["attempts"], 600)
+
+
+async def send_pending(bot: Bot, batch: int = BATCH) -> int:
+    rows = await fetch("""
+        WITH c AS (
+            UPDATE notifications_outbox
+            SET attempts = attempts + 1,
+                next_attempt_at = NOW() + make_interval(secs => $2)
+            WHERE id IN (
+                SELECT id FROM notifications_outbox
+                WHERE status='new' AND next_attempt_at <= NOW()
+                ORDER BY id
+                LIMIT $1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, tg_id, kind, payload, attempts
+        )
+        SELECT c.*, u.language
+        FROM c LEFT JOIN users u ON u.tg_id = c.tg_id
+    """, batch, LEASE_SEC)
+    if not rows:
+        return 0
+
+    sem = asyncio.Semaphore(CONCURRENCY)
+
+    async def one(r):
+        async with sem:
+            return r["id"], await _deliver(bot, r)
+
+    results = await asyncio.gather(*(one(r) for r in rows))
+
+    sent = [i for i, (res, _, _) in results if res == "sent"]
+    if sent:
+        await execute(
+            "UPDATE notifications_outbox SET status='sent', sent_at=NOW(), last_error=NULL WHERE id = ANY($1::bigint[])",
+            sent,
+        )
+        _stats["sent"] += len(sent)
+    for i, (res, err, delay) in results:
+        if res == "failed":
+            _stats["failed"] += 1
+            log.warning("outbox %s failed: %s", i, err)
+            await execute("UPDATE notifications_outbox SET status='failed', last_error=$2 WHERE id=$1", i, err)
+        elif res == "retry":
+            _stats["retried"] += 1
+            await execute("""
+                UPDATE notifications_outbox
+                SET last_error=$2, next_attempt_at=NOW() + make_interval(secs => $3)
+                WHERE id=$1
+            """, i, err, float(delay))
+    return len(rows)
+
+
+async def notifier_loop(bot: Bot):
+    while True:
+        try:
+            n = await send_pending(bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("notifier iteration failed: %s: %s", type(e).__name__, e)
+            n = 0
+        if n:
+            continue
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), IDLE_SEC)
+        except asyncio.TimeoutError:
+            pass
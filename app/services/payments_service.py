@@ -0,0 +1,294 @@
+# app/services/payments_service.py
+"""
+Проведение оплат MonoPay / CryptoBot.
+
+Вебхук только проверяет подпись и кладёт тело в inbox (payment_events, дедуп по provider+event_id),
+а settler в фоне разбирает inbox пачками с ретраями. Так ответ провайдеру — один INSERT,
+а всплеск оплат не выедает маленький пул соединений.
+"""
+import asyncio
+import json
+import logging
+
+from ..config import settings
+from ..db import execute, fetch, fetchrow, fetchval
+from ..utils.payments import get_cryptobot_invoices
+from .referrals import credit_ctes
+
+log = logging.getLogger("payments")
+ref_log = logging.getLogger("payments.ref")
+
+SETTLE_BATCH = 20
+SETTLE_IDLE_SEC = 2.0
+SETTLE_LEASE_SEC = 60      # пока событие «в работе», другие реплики его не берут
+SETTLE_MAX_ATTEMPTS = 8
+
+_wakeup = asyncio.Event()
+_stats = {"stored": 0, "duplicates": 0, "settled": 0, "retried": 0, "failed": 0}
+_recon_stats = {"runs": 0, "checked": 0, "paid": 0, "expired": 0, "api_calls": 0, "errors": 0}
+
+
+def settler_stats() -> dict:
+    return {**_stats, "cryptobot_reconciler": dict(_recon_stats)}
+
+
+class PaymentNotFound(Exception):
+    """Вебхук про оплату, а строки payments ещё нет (вебхук обогнал INSERT) — событие ретраим."""
+
+
+# ===================== Inbox
+
+def cryptobot_event_id(data: dict) -> str:
+    if data.get("update_id") is not None:
+        return str(data["update_id"])
+    payload = data.get("payload") or {}
+    return f"{data.get('update_type')}:{payload.get('invoice_id')}"
+
+
+def monopay_event_id(data: dict) -> str:
+    # Mono шлёт несколько вебхуков на один инвойс (created/processing/success...)
+    return f"{data.get('invoiceId') or data.get('invoice_id')}:{data.get('status')}:{data.get('modifiedDate') or ''}"
+
+
+async def store_payment_event(provider: str, event_id: str, body: str) -> bool:
+    """True — новое событие, False — повтор (провайдер ретраит), уже лежит в inbox."""
+    new_id = await fetchval("""
+        INSERT INTO payment_events (provider, event_id, payload)
+        VALUES ($1, $2, $3::jsonb)
+        ON CONFLICT (provider, event_id) DO NOTHING
+        RETURNING id
+    """, provider, event_id, body)
+    if new_id is None:
+        _stats["duplicates"] += 1
+        return False
+    _stats["stored"] += 1
+    _wakeup.set()
+    return True
+
+
+# ===================== Проведение
+
+# Одна транзакция (один statement): помечаем платёж, активируем юзера, начисляем реф-бонус.
+# Повторная оплата уже активного юзера (второй инвойс) только помечает платёж: ни бонуса, ни уведомления.
+# Платёж ищем двумя индексными выборками (uuid / (provider, order_id)) вместо OR.
+# Реф-бонус — CTE из referrals.credit_ctes, идемпотентен по referral_rewards UNIQUE(referee_id).
+# pg_notify в RETURNING — сброс кеша юзеров (см. tasks_service.USERS_CHANNEL), уйдёт на COMMIT.
+# Сообщение «доступ активирован» кладём в outbox (notifier.py) той же транзакцией.
+SETTLE_SQL = f"""
+WITH p AS (
+    UPDATE payments SET status='paid', updated_at=NOW()
+    WHERE id = (
+        SELECT id FROM (
+            SELECT id FROM payments WHERE provider=$1 AND uuid = ANY($2::text[])
+            UNION ALL
+            SELECT id FROM payments WHERE provider=$1 AND order_id = ANY($2::text[])
+        ) c
+        ORDER BY id DESC LIMIT 1
+    )
+    RETURNING id, user_id
+),
+u AS (
+    UPDATE users SET status='active'
+    FROM p
+    WHERE users.id = p.user_id AND users.status <> 'active'
+    RETURNING users.id, users.tg_id, users.referrer_id,
+              pg_notify('qc_users', users.tg_id::text || ':') AS _n
+),{credit_ctes("u", "$3")},
+n AS (
+    INSERT INTO notifications_outbox (tg_id, kind, dedup_key)
+    SELECT u.tg_id, 'activated', 'activated:' || u.id
+    FROM u
+    ON CONFLICT (dedup_key) DO NOTHING
+    RETURNING id, pg_notify('qc_outbox', '') AS _n
+)
+SELECT p.id AS payment_id, u.id AS user_id, u.tg_id, (SELECT tg_id FROM rc) AS ref_tg,
+       (SELECT id FROM n) AS notification_id
+FROM p LEFT JOIN u ON TRUE
+"""
+
+
+async def settle_payment(provider: str, keys: list[str]):
+    """
+    Проводит оплату по любому из ключей (uuid или order_id платежа провайдера).
+    Возвращает payment_id, user_id, tg_id, ref_tg (кому начислен бонус сейчас) или None, если платёж не наш.
+    Повторный вызов безопасен: статусы те же, бонус второй раз не начислится.
+    """
+    keys = [str(k) for k in keys if k]
+    if not keys:
+        return None
+    row = await fetchrow(SETTLE_SQL, provider, keys, settings.REF_BONUS_QC)
+    if row and row["ref_tg"]:
+        ref_log.info("[ref] OK +%s QC to inviter %s (invitee %s)",
+                     settings.REF_BONUS_QC, row["ref_tg"], row["tg_id"])
+    return row
+
+
+async def settle_cryptobot(data: dict) -> None:
+    if data.get("update_type") != "invoice_paid":
+        return
+    payload = data.get("payload") or {}
+    inv = str(payload.get("invoice_id"))
+    row = await settle_payment("cryptobot", [inv])
+    if row is None:
+        raise PaymentNotFound(f"cryptobot invoice {inv}")
+    log.info("CryptoBot invoice_paid: %s -> %s", inv, dict(row))
+
+
+async def settle_monopay(data: dict) -> None:
+    status = (data.get("status") or "").lower()
+    if status != "success":
+        return
+    info = data.get("merchantPaymInfo") or {}
+    reference = info.get("reference") or data.get("reference")
+    invoice_id = data.get("invoiceId") or data.get("invoice_id")
+    row = await settle_payment("monopay", [invoice_id, reference])
+    if row is None:
+        raise PaymentNotFound(f"monopay invoice={invoice_id} reference={reference}")
+    log.info("Mono success: invoice=%s reference=%s -> %s", invoice_id, reference, dict(row))
+
+
+_SETTLERS = {
+    "cryptobot": settle_cryptobot,
+    "monopay": settle_monopay,
+}
+
+
+# ===================== Settler
+
+async def settle_pending(batch: int = SETTLE_BATCH) -> int:
+    """
+    Берём пачку новых событий (SKIP LOCKED + аренда), проводим по одному. Возвращает размер пачки.
+    Ошибка или PaymentNotFound — повтор с бэкоффом, после SETTLE_MAX_ATTEMPTS — failed.
+    """
+    rows = await fetch("""
+        UPDATE payment_events
+        SET attempts = attempts + 1,
+            next_attempt_at = NOW() + make_interval(secs => $2)
+        WHERE id IN (
+            SELECT id FROM payment_events
+            WHERE status='new' AND next_attempt_at <= NOW()
+            ORDER BY id
+            LIMIT $1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, provider, payload, attempts
+    """, batch, SETTLE_LEASE_SEC)
+    if not rows:
+        return 0
+
+    done: list[int] = []
+    for r in sorted(rows, key=lambda x: x["id"]):
+        try:
+            settle = _SETTLERS.get(r["provider"])
+            if settle is not None:
+                await settle(json.loads(r["payload"]))
+            done.append(r["id"])
+        except Exception as e:
+            if r["attempts"] >= SETTLE_MAX_ATTEMPTS:
+                _stats["failed"] += 1
+                log.error("payment event %s failed for good: %s: %s", r["id"], type(e).__name__, e)
+                await execute(
+                    "UPDATE payment_events SET status='failed', last_error=$2 WHERE id=$1",
+                    r["id"], f"{type(e).__name__}: {e}",
+                )
+            else:
+                _stats["retried"] += 1
+                backoff = min(2 ** r["attempts"], 600)
+                log.warning("payment event %s retry in %ss: %s: %s", r["id"], backoff, type(e).__name__, e)
+                await execute("""
+                    UPDATE payment_events
+                    SET last_error=$2, next_attempt_at=NOW() + make_interval(secs => $3)
+                    WHERE id=$1
+                """, r["id"], f"{type(e).__name__}: {e}", backoff)
+
+    if done:
+        await execute(
+            "UPDATE payment_events SET status='done', processed_at=NOW(), last_error=NULL WHERE id = ANY($1::bigint[])",
+            done,
+        )
+        _stats["settled"] += len(done)
+    return len(rows)
+
+
+async def settler_loop():
+    while True:
+        try:
+            n = await settle_pending()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("settler iteration failed: %s: %s", type(e).__name__, e)
+            n = 0
+        if n:
+            continue  # есть ещё — сразу следующая пачка
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), SETTLE_IDLE_SEC)
+        except asyncio.TimeoutError:
+            pass
+
+
+# ===================== Звірка CryptoBot
+# Запасной путь на случай потерянного вебхука: все открытые cryptobot-платежи страницами (keyset по id),
+# статусы — одним getInvoices на страницу, оплаченные проводим, истёкшие закрываем.
+
+async def reconcile_cryptobot_once(page: int) -> int:
+    _recon_stats["runs"] += 1
+    last_id = 0
+    checked = 0
+    while True:
+        rows = await fetch("""
+            SELECT id, uuid FROM payments
+            WHERE provider='cryptobot' AND status IN ('created','pending') AND id > $1
+            ORDER BY id
+            LIMIT $2
+        """, last_id, page)
+        if not rows:
+            break
+        last_id = rows[-1]["id"]
+        ids = [r["uuid"] for r in rows if r["uuid"] and r["uuid"].isdigit()]
+        if not ids:
+            continue
+
+        _recon_stats["api_calls"] += 1
+        items = await get_cryptobot_invoices(ids)
+        checked += len(ids)
+
+        expired = []
+        for inv in items:
+            status = (getattr(inv, "status", None) or "").lower()
+            uuid = str(inv.invoice_id)
+            if status == "paid":
+                if await settle_payment("cryptobot", [uuid]):
+                    _recon_stats["paid"] += 1
+                    log.info("CryptoBot reconcile: %s paid (missed webhook)", uuid)
+            elif status == "expired":
+                expired.append(uuid)
+        if expired:
+            await execute(
+                "UPDATE payments SET status='expired', updated_at=NOW() "
+                "WHERE provider='cryptobot' AND uuid = ANY($1::text[]) AND status IN ('created','pending')",
+                expired,
+            )
+            _recon_stats["expired"] += len(expired)
+        if len(rows) < page:
+            break
+
+    _recon_stats["checked"] += checked
+    return checked
+
+
+async def reconciler_loop():
+    interval = settings.CRYPTO_RECONCILE_INTERVAL_SEC
+    if interval <= 0 or not settings.CRYPTO_PAY_TOKEN:
+        return
+    page = max(1, min(settings.CRYPTO_RECONCILE_PAGE, 1000))
+    while True:
+        try:
+            await reconcile_cryptobot_once(page)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _recon_stats["errors"] += 1
+            log.warning("CryptoBot reconcile failed: %s: %s", type(e).__name__, e)
+        await asyncio.sleep(interval)
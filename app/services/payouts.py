@@ -0,0 +1,365 @@
+# app/services/payouts.py
+"""
+Автовиплати схвалених заявок (status='processed', сума під холдом), де юзер сам вибрав
+спосіб «@CryptoBot» (method_code='cryptobot'): гроші йдуть на гаманець @CryptoBot його Telegram-акаунта,
+про що йому кажуть при виборі. Заявки «Криптовалюта» з адресою й решта — вручну.
+
+Кожна заявка — рядок payouts зі своїм статусом:
+    new -> sending -> done
+                   -> retry -> sending ...      (збій з невідомим результатом, повтор з backoff)
+                   -> failed                    (провайдер однозначно відмовив з першої спроби)
+                   -> unknown                   (спроби вичерпано / відмова після збою — чи дійшли гроші, невідомо)
+    new -> canceled (адмін сам виплатив/відхилив заявку, поки вона чекала в черзі)
+Заявка (withdrawals) з моменту першої спроби — paying: кнопки адмінки (статуси OPEN) її не чіпають,
+тож відхилити чи вдруге виплатити вручну заявку, за якою, можливо, вже пішов переказ, не вийде.
+Назад у processed вона повертається тільки після однозначної відмови (failed). unknown лишається paying,
+доки оператор не звірить з провайдером:
+    python -m app.services.payouts unknown
+    python -m app.services.payouts resolve <withdrawal_id> paid|unpaid
+
+Воркер (payout_loop, на кожній репліці) пачкою PAYOUT_BATCH:
+  - ставить у чергу нові processed-заявки (один INSERT … SELECT);
+  - бере пачку одним UPDATE з FOR UPDATE SKIP LOCKED (аренда LEASE_SEC);
+  - виконує перекази паралельно, не більше PAYOUT_CONCURRENCY одночасно;
+  - результат кожного — один statement: done разом з withdrawals -> paid (withdrawals.paid_ctes).
+Ключ ідемпотентності spend_id = wd-<id withdrawals>: повтор після збою чи падіння процесу
+провайдер не проведе вдруге.
+
+Провайдер — PAYOUT_PROVIDER: "cryptobot" (transfer з балансу застосунку в @CryptoBot на tg_id юзера)
+або "fake" (нічого не надсилає, для тестів і стейджингу); порожньо — воркер вимкнений.
+"""
+import abc
+import asyncio
+import logging
+import random
+from decimal import Decimal
+
+import aiohttp
+
+from ..config import settings
+from ..db import execute, fetch, fetchrow
+from .withdrawals import paid_ctes
+
+log = logging.getLogger("payouts")
+
+LEASE_SEC = 300          # sending без результату довше — переказ повторимо з тим самим spend_id
+MAX_BACKOFF_SEC = 3600
+
+_stats = {"batches": 0, "done": 0, "retried": 0, "failed": 0, "unknown": 0, "canceled": 0}
+
+
+def payout_stats() -> dict:
+    return {"provider": settings.PAYOUT_PROVIDER or None, **_stats}
+
+
+# ===================== Провайдери
+
+class PayoutError(Exception):
+    """retryable=False — провайдер однозначно відмовив (юзера нема, сума не проходить тощо)."""
+
+    def __init__(self, msg: str, retryable: bool = True):
+        super().__init__(msg)
+        self.retryable = retryable
+
+
+class PayoutProvider(abc.ABC):
+    name = ""
+
+    @abc.abstractmethod
+    async def transfer(self, tg_id: int, asset: str, amount: Decimal, spend_id: str, comment: str) -> str | None:
+        """
+        -> id переказу в провайдера (None — переказ із цим spend_id уже був проведений раніше).
+        Повтор з тим самим spend_id не має платити вдруге. PayoutError(retryable=False) — лише коли
+        провайдер точно нічого не переказав.
+        """
+
+
+class CryptoBotPayoutProvider(PayoutProvider):
+    name = "cryptobot"
+
+    # не вистачає коштів на балансі застосунку — поповнять, і повтор пройде
+    RETRY_NAMES = {"INSUFFICIENT_FUNDS", "NOT_ENOUGH_COINS"}
+
+    async def transfer(self, tg_id, asset, amount, spend_id, comment):
+        # aiocryptopay потрібен тільки цьому провайдеру
+        from aiocryptopay.exceptions import CodeErrorFactory
+        from ..utils.payments import crypto, crypto_call
+
+        try:
+            tr = await crypto_call(crypto().transfer(user_id=tg_id, asset=asset, amount=float(amount),
+                                                     spend_id=spend_id, comment=comment))
+        except CodeErrorFactory as e:
+            name = str(getattr(e, "name", "") or "")
+            if "SPEND_ID" in name and ("USED" in name or "EXIST" in name):
+                return None  # цей spend_id уже проведено — попередня спроба дійшла
+            code = getattr(e, "code", 0) or 0
+            raise PayoutError(f"{code} {name}", retryable=code == 429 or code >= 500 or name in self.RETRY_NAMES)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise PayoutError(f"{type(e).__name__}: {e}")
+        return str(tr.transfer_id)
+
+
+class FakePayoutProvider(PayoutProvider):
+    """
+    Нічого не надсилає: перекази — у self.sent за spend_id (повтор не платить вдруге).
+    fail_rate (за замовчуванням PAYOUT_FAKE_FAIL_RATE) — частка збоїв до переказу;
+    script — черга сценаріїв для тестів: "error" (збій до переказу), "lost" (переказ пройшов,
+    відповідь загубилась), "reject" (однозначна відмова); порожня — звичайна поведінка.
+    """
+    name = "fake"
+
+    def __init__(self, fail_rate: float | None = None):
+        self.sent: dict[str, tuple[int, str, Decimal]] = {}
+        self.calls = 0
+        self.fail_rate = settings.PAYOUT_FAKE_FAIL_RATE if fail_rate is None else fail_rate
+        self.script: list[str] = []
+
+    async def transfer(self, tg_id, asset, amount, spend_id, comment):
+        self.calls += 1
+        await asyncio.sleep(0)
+        step = self.script.pop(0) if self.script else None
+        if step == "reject":
+            raise PayoutError("fake rejection", retryable=False)
+        if step == "error" or (step is None and spend_id not in self.sent and random.random() < self.fail_rate):
+            raise PayoutError("fake transient failure")
+        self.sent.setdefault(spend_id, (tg_id, asset, amount))
+        if step == "lost":
+            raise PayoutError("fake timeout after transfer")
+        return f"fake-{spend_id}"
+
+
+_PROVIDERS = {p.name: p for p in (CryptoBotPayoutProvider, FakePayoutProvider)}
+_provider: PayoutProvider | None = None
+
+
+def get_provider() -> PayoutProvider | None:
+    global _provider
+    if _provider is None and settings.PAYOUT_PROVIDER:
+        cls = _PROVIDERS.get(settings.PAYOUT_PROVIDER)
+        if cls is None:
+            raise ValueError(f"unknown PAYOUT_PROVIDER={settings.PAYOUT_PROVIDER!r}")
+        _provider = cls()
+    return _provider
+
+
+# ===================== SQL
+
+ENQUEUE_SQL = """
+INSERT INTO payouts (withdrawal_id, provider, spend_id, asset, amount)
+SELECT w.id, $1, 'wd-' || w.id, $2, ROUND(w.amount_qc * $3::numeric, 2)
+FROM withdrawals w
+WHERE w.status = 'processed' AND w.method_code = 'cryptobot'
+  AND NOT EXISTS (SELECT 1 FROM payouts p WHERE p.withdrawal_id = w.id)
+  -- старі заявки без холду (до журналу) — тільки вручну: баланс міг уже піти на інші заявки
+  AND EXISTS (SELECT 1 FROM qc_ledger h WHERE h.kind = 'withdraw_hold' AND h.ref_id = w.id)
+ORDER BY w.id
+LIMIT $4
+ON CONFLICT (withdrawal_id) DO NOTHING
+"""
+
+# заявку закрив адмін, поки виплата чекала в черзі
+CANCEL_SQL = """
+UPDATE payouts p SET status='canceled', updated_at=NOW()
+FROM withdrawals w
+WHERE p.status = 'new' AND w.id = p.withdrawal_id AND w.status <> 'processed'
+"""
+
+# аренда sending спливла, а спроби вичерпано (процес падав посеред переказу) — далі тільки оператор
+STALE_SQL = """
+UPDATE payouts SET status='unknown', last_error=COALESCE(last_error, 'lease expired'), updated_at=NOW()
+WHERE status = 'sending' AND next_attempt_at <= NOW() AND attempts >= $1
+"""
+
+CLAIM_SQL = """
+WITH c AS (
+    SELECT p.id, p.withdrawal_id
+    FROM payouts p JOIN withdrawals wd ON wd.id = p.withdrawal_id
+    WHERE p.status IN ('new','retry','sending') AND p.next_attempt_at <= NOW() AND p.attempts < $3
+      AND ((p.status = 'new' AND wd.status = 'processed')
+           OR (p.status IN ('retry','sending') AND wd.status = 'paying'))
+    ORDER BY p.next_attempt_at
+    LIMIT $1
+    FOR UPDATE OF p, wd SKIP LOCKED
+),
+w AS (
+    UPDATE withdrawals SET status='paying', updated_at=NOW()
+    FROM c WHERE withdrawals.id = c.withdrawal_id
+    RETURNING withdrawals.id, withdrawals.user_id
+)
+UPDATE payouts p
+SET status='sending', attempts=p.attempts+1, updated_at=NOW(),
+    next_attempt_at = NOW() + make_interval(secs => $2)
+FROM c JOIN w ON w.id = c.withdrawal_id JOIN users u ON u.id = w.user_id
+WHERE p.id = c.id
+RETURNING p.*, u.tg_id
+"""
+
+# $3 — з яких статусів payouts: sending (воркер) або unknown (оператор підтвердив переказ)
+DONE_SQL = f"""
+WITH p AS (
+    UPDATE payouts SET status='done', external_id=COALESCE($2, external_id), updated_at=NOW()
+    WHERE id=$1 AND status = ANY($3::text[])
+    RETURNING withdrawal_id
+),{paid_ctes("status = 'paying' AND id = (SELECT withdrawal_id FROM p)")}
+SELECT (SELECT COUNT(*) FROM p) AS done, (SELECT COUNT(*) FROM w) AS paid, (SELECT COUNT(*) FROM n) AS _n
+"""
+
+# збій з невідомим результатом: заявка лишається paying, повтор з тим самим spend_id через $3 с
+RETRY_SQL = """
+UPDATE payouts SET status='retry', last_error=$2, updated_at=NOW(),
+                   next_attempt_at = NOW() + make_interval(secs => $3)
+WHERE id=$1 AND status='sending'
+"""
+
+# гроші не дійшли напевно (відмова провайдера / рішення оператора) — заявка знову в адмінці
+FAILED_SQL = """
+WITH p AS (
+    UPDATE payouts SET status='failed', last_error=$2, updated_at=NOW()
+    WHERE id=$1 AND status = ANY($3::text[])
+    RETURNING withdrawal_id
+)
+UPDATE withdrawals SET status='processed', updated_at=NOW()
+WHERE id = (SELECT withdrawal_id FROM p) AND status='paying'
+RETURNING id
+"""
+
+UNKNOWN_SQL = """
+UPDATE payouts SET status='unknown', last_error=$2, updated_at=NOW()
+WHERE id=$1 AND status='sending'
+"""
+
+
+# ===================== Воркер
+
+async def _pay_one(provider: PayoutProvider, row):
+    try:
+        ext = await provider.transfer(row["tg_id"], row["asset"], row["amount"], row["spend_id"],
+                                      f"Withdrawal #{row['withdrawal_id']}")
+    except asyncio.CancelledError:
+        raise  # аренда відпаде, наступна спроба — з тим самим spend_id
+    except Exception as e:
+        err = str(e)[:500] or type(e).__name__
+        rejected = isinstance(e, PayoutError) and not e.retryable
+        if rejected and row["attempts"] == 1:
+            # однозначна відмова з першої спроби — переказу не було
+            await execute(FAILED_SQL, row["id"], err, ["sending"])
+            outcome = "failed"
+        elif not rejected and row["attempts"] < settings.PAYOUT_MAX_ATTEMPTS:
+            await execute(RETRY_SQL, row["id"], err, min(30 * 2 ** row["attempts"], MAX_BACKOFF_SEC))
+            outcome = "retried"
+        else:
+            # спроби вичерпано або відмова після збою: попередня спроба могла дійти
+            await execute(UNKNOWN_SQL, row["id"], err)
+            outcome = "unknown"
+        _stats[outcome] += 1
+        (log.info if outcome == "retried" else log.warning)(
+            "payout #%s (withdrawal #%s) %s: %s", row["id"], row["withdrawal_id"], outcome, err
+        )
+        return
+    res = await fetchrow(DONE_SQL, row["id"], ext, ["sending"])
+    if res["done"]:
+        _stats["done"] += 1
+    else:
+        log.warning("payout #%s: lease lost after transfer %s", row["id"], ext)
+
+
+async def run_batch(provider: PayoutProvider) -> int:
+    """Одна пачка. -> скільки виплат узяли в роботу."""
+    await execute(ENQUEUE_SQL, provider.name, settings.PAYOUT_ASSET, Decimal(str(settings.PAYOUT_QC_RATE)),
+                  settings.PAYOUT_BATCH)
+    canceled = await execute(CANCEL_SQL)
+    _stats["canceled"] += int(canceled.split()[-1])  # 'UPDATE n'
+    stale = await execute(STALE_SQL, settings.PAYOUT_MAX_ATTEMPTS)
+    _stats["unknown"] += int(stale.split()[-1])
+    rows = await fetch(CLAIM_SQL, settings.PAYOUT_BATCH, LEASE_SEC, settings.PAYOUT_MAX_ATTEMPTS)
+    if not rows:
+        return 0
+    _stats["batches"] += 1
+    sem = asyncio.Semaphore(settings.PAYOUT_CONCURRENCY)
+
+    async def one(r):
+        async with sem:
+            await _pay_one(provider, r)
+
+    results = await asyncio.gather(*(one(r) for r in rows), return_exceptions=True)
+    for r, res in zip(rows, results):
+        if isinstance(res, Exception):
+            # запис результату не вдався — рядок лишився sending і повториться після аренди
+            log.warning("payout #%s: %s: %s", r["id"], type(res).__name__, res)
+    return len(rows)
+
+
+# ===================== Оператор
+
+async def unknown():
+    return await fetch("""
+        SELECT p.*, u.tg_id FROM payouts p
+        JOIN withdrawals w ON w.id = p.withdrawal_id JOIN users u ON u.id = w.user_id
+        WHERE p.status = 'unknown'
+        ORDER BY p.id
+    """)
+
+
+async def resolve(withdrawal_id: int, paid: bool) -> bool:
+    """
+    Рішення оператора по unknown-виплаті після звірки з провайдером (переказ за spend_id):
+    paid — заявка -> paid; інакше -> failed, заявка знову processed в адмінці. -> False, якщо такої unknown нема.
+    """
+    row = await fetchrow("SELECT id FROM payouts WHERE withdrawal_id=$1 AND status='unknown'", withdrawal_id)
+    if row is None:
+        return False
+    if paid:
+        res = await fetchrow(DONE_SQL, row["id"], None, ["unknown"])
+        return bool(res["done"])
+    return bool(await fetchrow(FAILED_SQL, row["id"], "operator: not paid", ["unknown"]))
+
+
+async def payout_loop():
+    provider = get_provider()
+    if provider is None:
+        return
+    log.info("payouts enabled: provider=%s asset=%s", provider.name, settings.PAYOUT_ASSET)
+    while True:
+        n = 0
+        try:
+            n = await run_batch(provider)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("payout iteration failed: %s: %s", type(e).__name__, e)
+        if n < settings.PAYOUT_BATCH:
+            await asyncio.sleep(settings.PAYOUT_INTERVAL_SEC)
+
+
+async def _cli():
+    import argparse
+    from ..db import connect, close
+
+    p = argparse.ArgumentParser(prog="python -m app.services.payouts")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    sub.add_parser("unknown", help="виплати з невідомим результатом")
+    r = sub.add_parser("resolve", help="рішення після звірки з провайдером")
+    r.add_argument("withdrawal_id", type=int)
+    r.add_argument("outcome", choices=("paid", "unpaid"))
+    args = p.parse_args()
+
+    await connect()
+    try:
+        if args.cmd == "unknown":
+            for row in await unknown():
+                print(f"withdrawal #{row['withdrawal_id']}: {row['amount']} {row['asset']} -> tg {row['tg_id']}, "
+                      f"spend_id={row['spend_id']}, attempts={row['attempts']}, error={row['last_error']}")
+            return 0
+        if not await resolve(args.withdrawal_id, args.outcome == "paid"):
+            print(f"no unknown payout for withdrawal #{args.withdrawal_id}")
+            return 1
+        print(f"withdrawal #{args.withdrawal_id}: {args.outcome}")
+        return 0
+    finally:
+        await close()
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_cli()))
@@ -0,0 +1,220 @@
+# app/services/reconcile.py
+"""
+Звірка балансів з журналом і таблицями-джерелами.
+
+Для кожного юзера перевіряємо:
+  - balance_qc / earned_total_qc == сума проводок qc_ledger (цілісність проекції);
+  - кожен user_steps, referral_rewards (awarded) і withdrawals після ввімкнення журналу
+    (opening-проводки) має свою проводку step / referral / withdraw_hold;
+  - суми step / referral дорівнюють steps.reward_qc / referral_rewards.amount_qc
+    (нагороду кроку змінили вже після виконання — теж потрапить сюди, перевіряється вручну);
+  - відхилена заявка з холдом має повернення withdraw_release.
+Розбіжності пишемо в balance_audit (один рядок на юзера за прогін), підсумок — у balance_audit_runs.
+
+Юзерів йдемо keyset-пачками по id: одна пачка = один set-based statement (один снапшот, одне
+з'єднання з пулу на час запиту). Між пачками пауза, щоб звірка займала не більше RECONCILE_DUTY
+часу БД — можна ганяти в проді посеред дня.
+
+Одночасно йде не більше одного прогону: унікальний частковий індекс balance_audit_runs_running_idx
+по status='running'; прогін без heartbeat довше RUN_LEASE_SEC закриваємо як failed і беремо новий.
+Фоном — раз на RECONCILE_INTERVAL_SEC (запуск бере одна репліка), вручну:
+    python -m app.services.reconcile
+"""
+import asyncio
+import logging
+import time
+
+from ..config import settings
+from ..db import execute, fetchrow, fetchval
+
+log = logging.getLogger("reconcile")
+
+RUN_LEASE_SEC = 600  # «running» без heartbeat довше — вважаємо завислим
+
+# $4 — момент увімкнення журналу (created_at opening-проводок) або NULL; до нього проводок не було
+BATCH_SQL = """
+WITH b AS (
+    SELECT id, balance_qc, earned_total_qc FROM users
+    WHERE id > $2
+    ORDER BY id
+    LIMIT $3
+),
+l AS (
+    SELECT user_id, SUM(amount) AS bal, SUM(earned_delta) AS earned
+    FROM qc_ledger
+    WHERE user_id IN (SELECT id FROM b)
+    GROUP BY user_id
+),
+-- виконані кроки: проводки нема / сума не дорівнює нагороді кроку
+s AS (
+    SELECT us.user_id,
+           COUNT(*) FILTER (WHERE q.id IS NULL) AS missing,
+           COUNT(*) FILTER (WHERE q.amount <> st.reward_qc OR q.earned_delta <> st.reward_qc) AS wrong
+    FROM user_steps us
+    JOIN steps st ON st.id = us.step_id
+    LEFT JOIN qc_ledger q ON q.kind = 'step' AND q.ref_id = us.id
+    WHERE us.user_id IN (SELECT id FROM b) AND us.completed_at > COALESCE($4::timestamptz, '-infinity')
+    GROUP BY us.user_id
+),
+-- реф-бонуси: проводки нема / сума не дорівнює referral_rewards.amount_qc
+r AS (
+    SELECT rr.referrer_id AS user_id,
+           COUNT(*) FILTER (WHERE q.id IS NULL) AS missing,
+           COUNT(*) FILTER (WHERE q.amount IS DISTINCT FROM rr.amount_qc
+                                 OR q.earned_delta IS DISTINCT FROM rr.amount_qc) AS wrong
+    FROM referral_rewards rr
+    LEFT JOIN qc_ledger q ON q.kind = 'referral' AND q.ref_id = rr.referee_id
+    WHERE rr.referrer_id IN (SELECT id FROM b) AND rr.awarded
+      AND rr.awarded_at > COALESCE($4::timestamptz, '-infinity')
+    GROUP BY rr.referrer_id
+),
+-- заявки: без холду; відхилені з холдом, але без повернення
+w AS (
+    SELECT wd.user_id,
+           COUNT(*) FILTER (WHERE h.id IS NULL AND wd.created_at > COALESCE($4::timestamptz, '-infinity')) AS missing,
+           COUNT(*) FILTER (WHERE h.id IS NOT NULL AND wd.status = 'rejected' AND NOT EXISTS (
+               SELECT 1 FROM qc_ledger q WHERE q.kind = 'withdraw_release' AND q.ref_id = wd.id
+           )) AS no_release
+    FROM withdrawals wd
+    LEFT JOIN qc_ledger h ON h.kind = 'withdraw_hold' AND h.ref_id = wd.id
+    WHERE wd.user_id IN (SELECT id FROM b)
+    GROUP BY wd.user_id
+),
+ins AS (
+    INSERT INTO balance_audit (run_id, user_id, balance_qc, ledger_balance, earned_total_qc, ledger_earned,
+                               missing_step_credits, missing_ref_credits, missing_holds,
+                               wrong_step_credits, wrong_ref_credits, missing_releases)
+    SELECT $1, b.id, b.balance_qc, COALESCE(l.bal, 0), b.earned_total_qc, COALESCE(l.earned, 0),
+           COALESCE(s.missing, 0), COALESCE(r.missing, 0), COALESCE(w.missing, 0),
+           COALESCE(s.wrong, 0), COALESCE(r.wrong, 0), COALESCE(w.no_release, 0)
+    FROM b
+    LEFT JOIN l ON l.user_id = b.id
+    LEFT JOIN s ON s.user_id = b.id
+    LEFT JOIN r ON r.user_id = b.id
+    LEFT JOIN w ON w.user_id = b.id
+    WHERE b.balance_qc <> COALESCE(l.bal, 0)
+       OR b.earned_total_qc <> COALESCE(l.earned, 0)
+       OR s.missing > 0 OR s.wrong > 0 OR r.missing > 0 OR r.wrong > 0
+       OR w.missing > 0 OR w.no_release > 0
+    RETURNING 1
+)
+SELECT (SELECT MAX(id) FROM b) AS last_id,
+       (SELECT COUNT(*) FROM b) AS checked,
+       (SELECT COUNT(*) FROM ins) AS mismatched
+"""
+
+
+async def _start_run(source: str) -> int | None:
+    # завислий прогін (репліка впала) звільняє місце
+    await execute("""
+        UPDATE balance_audit_runs SET status='failed', finished_at=NOW()
+        WHERE status='running' AND heartbeat_at < NOW() - make_interval(secs => $1)
+    """, RUN_LEASE_SEC)
+    # інша репліка вже звіряє — конфлікт по індексу; фоновий прогін був нещодавно — не запускаємось
+    return await fetchval("""
+        INSERT INTO balance_audit_runs (source)
+        SELECT $1
+        WHERE NOT ($1 = 'auto' AND EXISTS (
+            SELECT 1 FROM balance_audit_runs
+            WHERE source='auto' AND status <> 'failed' AND started_at > NOW() - make_interval(secs => $2)
+        ))
+        ON CONFLICT ((1)) WHERE status='running' DO NOTHING
+        RETURNING id
+    """, source, max(settings.RECONCILE_INTERVAL_SEC - 60, 0))
+
+
+async def run(source: str = "auto", batch: int | None = None, duty: float | None = None):
+    """Один повний прогін. -> рядок balance_audit_runs або None, якщо запуск зайнятий."""
+    batch = batch or settings.RECONCILE_BATCH
+    duty = min(max(duty or settings.RECONCILE_DUTY, 0.01), 1.0)
+    run_id = await _start_run(source)
+    if run_id is None:
+        return None
+    log.info("reconcile run #%s started (%s)", run_id, source)
+    last = checked = mismatched = 0
+    try:
+        # усі opening-проводки писались однією транзакцією (однаковий NOW()) — досить будь-якої, по індексу
+        since = await fetchval("SELECT created_at FROM qc_ledger WHERE kind='opening' LIMIT 1")
+        while True:
+            t0 = time.monotonic()
+            row = await fetchrow(BATCH_SQL, run_id, last, batch, since)
+            spent = time.monotonic() - t0
+            if not row["checked"]:
+                break
+            last = row["last_id"]
+            checked += row["checked"]
+            mismatched += row["mismatched"]
+            alive = await fetchval("""
+                UPDATE balance_audit_runs
+                SET last_user_id=$2, checked=$3, mismatched=$4, heartbeat_at=NOW()
+                WHERE id=$1 AND status='running'
+                RETURNING TRUE
+            """, run_id, last, checked, mismatched)
+            if not alive:
+                log.warning("reconcile run #%s: lease lost, stopping", run_id)
+                return None
+            # duty cycle: на кожну секунду запиту — (1 - duty) / duty секунд паузи
+            await asyncio.sleep(spent * (1 - duty) / duty)
+    except BaseException:
+        try:
+            await execute(
+                "UPDATE balance_audit_runs SET status='failed', finished_at=NOW() WHERE id=$1 AND status='running'",
+                run_id,
+            )
+        except Exception:
+            pass  # не світимо цю помилку замість початкової; завислий run відпаде по RUN_LEASE_SEC
+        raise
+    row = await fetchrow("""
+        UPDATE balance_audit_runs SET status='done', finished_at=NOW(), heartbeat_at=NOW()
+        WHERE id=$1 AND status='running' RETURNING *
+    """, run_id)
+    if row is None:
+        log.warning("reconcile run #%s: lease lost before finish", run_id)
+        return None
+    (log.warning if mismatched else log.info)(
+        "reconcile run #%s done: checked=%s mismatched=%s", run_id, checked, mismatched
+    )
+    return row
+
+
+async def reconcile_loop():
+    if settings.RECONCILE_INTERVAL_SEC <= 0:
+        return
+    while True:
+        try:
+            await run("auto")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("reconcile failed: %s: %s", type(e).__name__, e)
+        # частіше, ніж інтервал: _start_run сам відсіє, якщо прогін уже був
+        await asyncio.sleep(min(settings.RECONCILE_INTERVAL_SEC, 3600))
+
+
+async def _cli():
+    import argparse
+    from ..db import connect, close
+
+    p = argparse.ArgumentParser(prog="python -m app.services.reconcile")
+    p.add_argument("--batch", type=int, default=None)
+    p.add_argument("--duty", type=float, default=None, help="0..1, частка часу на запити")
+    args = p.parse_args()
+
+    await connect()
+    try:
+        row = await run("cli", args.batch, args.duty)
+        if row is None:
+            print("another reconcile run is in progress")
+            return 1
+        print(f"run #{row['id']}: checked={row['checked']} mismatched={row['mismatched']}")
+        if row["mismatched"]:
+            print(f"details: SELECT * FROM balance_audit WHERE run_id={row['id']} ORDER BY user_id;")
+        return 0
+    finally:
+        await close()
+
+
+if __name__ == "__main__":
+    import sys
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(_cli()))
@@ -0,0 +1,125 @@
+# app/services/referrals.py
+"""
+Реферальный бонус: пригласивший получает REF_BONUS_QC, когда приглашённый активирован.
+
+Пригласивший — только users.referrer_id (внутренний id), без угадываний tg_id/id.
+Начисление — один statement: INSERT в referral_rewards (UNIQUE(referee_id)) и проводка в qc_ledger
+(баланс обновит тригер журнала) в одной CTE-цепочке; повтор/гонка двух реплик упирается в уникальность и ничего не начисляет.
+Те же CTE встраиваются в проведение оплаты (payments_service.SETTLE_SQL).
+
+Счётчики реферера (referral_stats) ведутся инкрементально теми же statement'ами:
+регистрация приглашённого (invite_ctes в ensure_user) и начисление бонуса (credit_ctes).
+Экраны читают их по PK / по индексу топа, без сканов users.
+"""
+import logging
+
+from ..config import settings
+from ..db import fetch, fetchrow, fetchval
+
+log = logging.getLogger("payments.ref")
+
+
+def credit_ctes(src: str, amount: str) -> str:
+    """
+    CTE начисления для встраивания в WITH: src — CTE/таблица с колонками id, referrer_id
+    (приглашённые), amount — выражение суммы ($N). Дают CTE rr (награды), rl (проводки журнала),
+    rc (пригласившие: tg_id тех, кому начислено сейчас) и rs (их счётчики).
+    """
+    return f"""
+rr AS (
+    INSERT INTO referral_rewards (referrer_id, referee_id, awarded, awarded_at, amount_qc)
+    SELECT {src}.referrer_id, {src}.id, TRUE, NOW(), {amount}
+    FROM {src}
+    WHERE {src}.referrer_id IS NOT NULL AND {src}.referrer_id <> {src}.id
+    ON CONFLICT (referee_id) DO UPDATE
+        SET awarded=TRUE, awarded_at=NOW(), amount_qc=EXCLUDED.amount_qc
+        WHERE NOT referral_rewards.awarded
+    RETURNING referrer_id, referee_id, amount_qc
+),
+rl AS (
+    INSERT INTO qc_ledger (user_id, amount, earned_delta, kind, ref_id)
+    SELECT referrer_id, amount_qc, amount_qc, 'referral', referee_id FROM rr
+    RETURNING user_id
+),
+rc AS (
+    SELECT users.tg_id, pg_notify('qc_users', users.tg_id::text || ':') AS _n
+    FROM users JOIN rl ON users.id = rl.user_id
+),
+rs AS (
+    INSERT INTO referral_stats (user_id, activated, bonus_qc)
+    SELECT referrer_id, 1, amount_qc FROM rr
+    ON CONFLICT (user_id) DO UPDATE
+        SET activated = referral_stats.activated + 1,
+            bonus_qc = referral_stats.bonus_qc + EXCLUDED.bonus_qc,
+            updated_at = NOW()
+    RETURNING user_id
+)"""
+
+
+def invite_ctes(src: str) -> str:
+    """
+    CTE счётчиков при регистрации: src — CTE с колонкой referrer_id только что созданного юзера.
+    invited +1 пригласившему, invited_l2 +1 его пригласившему. Дают CTE ri1, ri2.
+    """
+    return f"""
+ri1 AS (
+    INSERT INTO referral_stats (user_id, invited)
+    SELECT {src}.referrer_id, 1 FROM {src} WHERE {src}.referrer_id IS NOT NULL
+    ON CONFLICT (user_id) DO UPDATE
+        SET invited = referral_stats.invited + 1, updated_at = NOW()
+    RETURNING user_id
+),
+ri2 AS (
+    INSERT INTO referral_stats (user_id, invited_l2)
+    SELECT r.referrer_id, 1
+    FROM {src} JOIN users r ON r.id = {src}.referrer_id
+    WHERE r.referrer_id IS NOT NULL AND r.referrer_id <> {src}.referrer_id
+    ON CONFLICT (user_id) DO UPDATE
+        SET invited_l2 = referral_stats.invited_l2 + 1, updated_at = NOW()
+    RETURNING user_id
+)"""
+
+
+CREDIT_SQL = f"""
+WITH s AS (
+    SELECT id, referrer_id FROM users WHERE tg_id=$1 AND status='active'
+),{credit_ctes("s", "$2")}
+SELECT tg_id FROM rc
+"""
+
+
+async def credit_referrer(tg_id: int) -> int | None:
+    """
+    Начислить бонус пригласившему активного юзера tg_id, если ещё не начислен.
+    Возвращает tg_id пригласившего, если начислено этим вызовом.
+    """
+    ref_tg = await fetchval(CREDIT_SQL, tg_id, settings.REF_BONUS_QC)
+    if ref_tg:
+        log.info("[ref] OK +%s QC to inviter %s (invitee %s)", settings.REF_BONUS_QC, ref_tg, tg_id)
+    return ref_tg
+
+
+async def get_stats(user_id: int):
+    """Счётчики реферера (одна строка по PK) или None, если он никого не приглашал."""
+    return await fetchrow(
+        "SELECT invited, activated, bonus_qc, invited_l2 FROM referral_stats WHERE user_id=$1", user_id
+    )
+
+
+async def top_referrers(limit: int = 10, after: tuple[int, int] | None = None):
+    """
+    Топ по активированным приглашённым. Keyset-пагинация по (activated, user_id) —
+    after = (activated, user_id) последней строки предыдущей страницы.
+    """
+    if after is None:
+        return await fetch("""
+            SELECT s.*, u.tg_id FROM referral_stats s JOIN users u ON u.id = s.user_id
+            ORDER BY s.activated DESC, s.user_id DESC
+            LIMIT $1
+        """, limit)
+    return await fetch("""
+        SELECT s.*, u.tg_id FROM referral_stats s JOIN users u ON u.id = s.user_id
+        WHERE (s.activated, s.user_id) < ($2, $3)
+        ORDER BY s.activated DESC, s.user_id DESC
+        LIMIT $1
+    """, limit, after[0], after[1])
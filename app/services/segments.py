@@ -0,0 +1,118 @@
+# app/services/segments.py
+"""
+Аудитории рассылок.
+
+Сегмент — dict (хранится в broadcast_jobs.segment JSONB):
+    status   'active' | 'inactive'
+    langs    ['uk', 'ru', ...]
+    since    активность (выполненный шаг) за последние N дней
+    earned   [min, max] по earned_total_qc, любая граница может быть None
+    pending  True — есть заявка на вывод в статусе pending
+Компилируется в WHERE по users u: колонки users + EXISTS по индексам
+(users_segment_idx, users_earned_idx, user_steps_user_done_idx, withdrawals_pending_user_idx,
+см. schema.run_broadcast_migration). Юзеры без языка (не прошли /start) не попадают никогда.
+
+Задаётся первой строкой текста рассылки:
+    segment: status=active lang=uk,ru since=7 earned=100..500 pending=yes
+Варианты по языкам — блоки, начинающиеся строкой [uk] / [ru] / [en]; текст до первого блока —
+вариант по умолчанию для остальных языков.
+"""
+import re
+
+from ..db import fetchval
+
+LANGS = ("uk", "ru", "en")
+DEFAULT = "*"
+
+_VARIANT_RE = re.compile(r"^\[(uk|ru|en)\]\s*$", re.M)
+
+
+def parse(text: str) -> tuple[dict, dict[str, str]]:
+    """-> (сегмент, варианты {lang|'*': текст}). ValueError — на кривой заголовок."""
+    seg: dict = {}
+    first, _, rest = text.partition("\n")
+    if first.lower().startswith("segment:"):
+        for tok in first.split(":", 1)[1].split():
+            key, _, val = tok.partition("=")
+            key, val = key.lower(), val.strip().lower()
+            if key == "status" and val in ("active", "inactive"):
+                seg["status"] = val
+            elif key == "lang" and val and set(val.split(",")) <= set(LANGS):
+                seg["langs"] = sorted(set(val.split(",")))
+            elif key == "since" and val.isdigit():
+                seg["since"] = int(val)
+            elif key == "earned" and re.fullmatch(r"\d*\.\.\d*", val) and val != "..":
+                lo, hi = val.split("..")
+                seg["earned"] = [int(lo) if lo else None, int(hi) if hi else None]
+            elif key == "pending" and val in ("yes", "1", "true"):
+                seg["pending"] = True
+            else:
+                raise ValueError(tok)
+        text = rest
+
+    variants: dict[str, str] = {}
+    parts = _VARIANT_RE.split(text)
+    # [до первого маркера, lang1, текст1, lang2, текст2, ...]
+    if parts[0].strip():
+        variants[DEFAULT] = parts[0].strip()
+    for lang, body in zip(parts[1::2], parts[2::2]):
+        if body.strip():
+            variants[lang] = body.strip()
+    if not variants:
+        raise ValueError("empty text")
+
+    if DEFAULT not in variants:
+        # без варианта по умолчанию остальным языкам слать нечего — сужаем аудиторию
+        langs = set(seg.get("langs") or LANGS) & set(variants)
+        seg["langs"] = sorted(langs)
+    return seg, variants
+
+
+def compile_where(seg: dict, first_arg: int = 1) -> tuple[str, list]:
+    """-> (условие по users u, аргументы начиная с $first_arg)."""
+    conds = ["u.language IS NOT NULL"]
+    args: list = []
+
+    def arg(v) -> str:
+        args.append(v)
+        return f"${first_arg + len(args) - 1}"
+
+    if seg.get("status"):
+        conds.append(f"u.status = {arg(seg['status'])}")
+    if seg.get("langs") is not None:
+        conds.append(f"u.language = ANY({arg(list(seg['langs']))}::text[])")
+    lo, hi = seg.get("earned") or (None, None)
+    if lo is not None:
+        conds.append(f"u.earned_total_qc >= {arg(lo)}")
+    if hi is not None:
+        conds.append(f"u.earned_total_qc <= {arg(hi)}")
+    if seg.get("since"):
+        conds.append(
+            "EXISTS (SELECT 1 FROM user_steps s WHERE s.user_id = u.id"
+            f" AND s.completed_at >= NOW() - make_interval(days => {arg(int(seg['since']))}))"
+        )
+    if seg.get("pending"):
+        conds.append("EXISTS (SELECT 1 FROM withdrawals w WHERE w.user_id = u.id AND w.status = 'pending')")
+    return " AND ".join(conds), args
+
+
+async def count(seg: dict) -> int:
+    where, args = compile_where(seg)
+    return await fetchval(f"SELECT COUNT(*) FROM users u WHERE {where}", *args)
+
+
+def describe(seg: dict) -> str:
+    """Короткое описание для превью в админке."""
+    parts = []
+    if seg.get("status"):
+        parts.append(f"status={seg['status']}")
+    if seg.get("langs") is not None:
+        parts.append("lang=" + (",".join(seg["langs"]) or "-"))
+    if seg.get("since"):
+        parts.append(f"since={seg['since']}d")
+    if seg.get("earned"):
+        lo, hi = seg["earned"]
+        parts.append(f"earned={'' if lo is None else lo}..{'' if hi is None else hi}")
+    if seg.get("pending"):
+        parts.append("pending=yes")
+    return " ".join(parts) or "all"
@@ -0,0 +1,54 @@
+# app/services/stats.py
+"""
+Статистика админки — сума 16 рядків-шардів stats_counters.
+
+Лічильники ведуть тригери в транзакціях, що змінюють дані (schema.STATS_SQL), кожна транзакція —
+у свій шард, тож записи не стоять у черзі на одному рядку, а екран не робить повних агрегатів.
+Раз на STATS_RESYNC_INTERVAL_SEC перераховуємо все з нуля (qc_stats_resync) і пишемо в лог,
+якщо щось розійшлось — ручні правки в БД, зміни до тригерів.
+"""
+import asyncio
+import logging
+
+from ..config import settings
+from ..db import fetchrow
+
+log = logging.getLogger("stats")
+
+TOTALS_SQL = """
+SELECT SUM(users_total)::bigint AS users_total, SUM(users_active)::bigint AS users_active,
+       SUM(balance_sum)::bigint AS balance_sum, SUM(earned_sum)::bigint AS earned_sum,
+       SUM(payments_total)::bigint AS payments_total, SUM(referrals_total)::bigint AS referrals_total,
+       MAX(updated_at) AS updated_at, MAX(resynced_at) AS resynced_at
+FROM stats_counters
+"""
+
+
+async def get():
+    return await fetchrow(TOTALS_SQL)
+
+
+async def resync():
+    """Повний перерахунок; -> актуальний рядок лічильників."""
+    drift = await fetchrow("SELECT * FROM qc_stats_resync()")
+    if drift and any(drift.values()):
+        log.warning("stats drift corrected: %s", dict(drift))
+    return await fetchrow(TOTALS_SQL)
+
+
+async def stats_loop():
+    """
+    Перший перерахунок — одразу на старті за будь-якого інтервалу: на базі, де лічильники
+    щойно з'явились, він їх заповнює. Далі — раз на STATS_RESYNC_INTERVAL_SEC (0 — без повторів).
+    """
+    interval = settings.STATS_RESYNC_INTERVAL_SEC
+    while True:
+        try:
+            await resync()
+            if interval <= 0:
+                return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("stats resync failed: %s: %s", type(e).__name__, e)
+        await asyncio.sleep(interval if interval > 0 else 60)
@@ -1,17 +1,174 @@
+import time
+import logging
+from collections import OrderedDict
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+from types import MappingProxyType
 from zoneinfo import ZoneInfo
 from typing import Optional
-from ..db import fetch, fetchrow, execute, fetchval
+from ..db import fetchrow, execute, fetchval, notify, on_notify, APP_NAME
 from ..config import settings
+from . import catalog, referrals
 
 KYIV = ZoneInfo(settings.TZ_KYIV)
 
 DAILY_LIMIT = 10
 CHAIN_COOLDOWN = timedelta(minutes=30)
 
+log = logging.getLogger("tasks_service")
+
+# ===== Кеш строк users между апдейтами (LRU + TTL)
+# Свои записи обновляют кеш на месте; чужие (вебхуки, другие реплики) приходят NOTIFY на USERS_CHANNEL
+# с payload "<tg_id>:<application_name писателя>" — свои же уведомления пропускаем.
+USERS_CHANNEL = "qc_users"
+
+class _UserCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._rows: OrderedDict[int, tuple[float, MappingProxyType]] = OrderedDict()  # tg_id -> (expires, row)
+        self._tg_by_id: dict[int, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, tg_id: int):
+        item = self._rows.get(tg_id)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                self.drop(tg_id)
+            self.misses += 1
+            return None
+        self._rows.move_to_end(tg_id)
+        self.hits += 1
+        return item[1]
+
+    def peek(self, tg_id: int):
+        # без учёта в hit/miss и без продления LRU
+        item = self._rows.get(tg_id)
+        return item[1] if item is not None and item[0] >= time.monotonic() else None
+
+    def get_by_id(self, user_id: int):
+        tg_id = self._tg_by_id.get(user_id)
+        if tg_id is None:
+            self.misses += 1
+            return None
+        return self.get(tg_id)
+
+    def put(self, row):
+        if self.maxsize <= 0:
+            return
+        self._rows[row["tg_id"]] = (time.monotonic() + self.ttl, row)
+        self._rows.move_to_end(row["tg_id"])
+        self._tg_by_id[row["id"]] = row["tg_id"]
+        while len(self._rows) > self.maxsize:
+            _, (_, old) = self._rows.popitem(last=False)
+            self._tg_by_id.pop(old["id"], None)
+            self.evictions += 1
+
+    def drop(self, tg_id: int):
+        item = self._rows.pop(tg_id, None)
+        if item is not None:
+            self._tg_by_id.pop(item[1]["id"], None)
+
+    def clear(self):
+        self._rows.clear()
+        self._tg_by_id.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._rows),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+_cache = _UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL)
+
+def user_cache_stats() -> dict:
+    return _cache.stats()
+
+def _on_users_notify(payload: str | None):
+    if payload is None:
+        # переподключили LISTEN — что пропустили, неизвестно
+        _cache.clear()
+        return
+    tg_raw, _, writer = payload.partition(":")
+    if writer == APP_NAME:
+        return
+    try:
+        _cache.drop(int(tg_raw))
+        _cache.invalidations += 1
+    except ValueError:
+        log.warning("bad %s payload: %r", USERS_CHANNEL, payload)
+
+on_notify(USERS_CHANNEL, _on_users_notify)
+
+async def invalidate_user(tg_id: int):
+    """Для записей в users мимо сервиса (вебхуки оплат и т.п.): сбросить у себя и у других реплик."""
+    _forget(tg_id)
+    await notify(USERS_CHANNEL, f"{tg_id}:")
+
+def drop_cached_user(tg_id: int):
+    """Только локально: следующий get_user перечитает строку."""
+    _forget(tg_id)
+
+def _write_through(update_sql: str) -> str:
+    # UPDATE ... RETURNING * + NOTIFY другим репликам в том же запросе (доставится на COMMIT)
+    return f"""
+        WITH w AS ({update_sql})
+        SELECT w.*, pg_notify('{USERS_CHANNEL}', w.tg_id::text || ':' || current_setting('application_name')) AS _notified
+        FROM w
+    """
+
+# ===== Identity map на один апдейт (открывает UserMiddleware)
+# ключи: ("tg", tg_id) и ("id", users.id) -> один и тот же снимок строки
+_identity: ContextVar[dict | None] = ContextVar("qc_user_identity", default=None)
+
+def open_identity_map():
+    return _identity.set({})
+
+def close_identity_map(token):
+    _identity.reset(token)
+
+def _remember(row):
+    """Кладём свежую строку users в identity map и в кеш. Снимок read-only."""
+    if not row:
+        return row
+    if not isinstance(row, MappingProxyType):
+        row = MappingProxyType({k: v for k, v in row.items() if k != "_notified"})
+    m = _identity.get()
+    if m is not None:
+        m[("tg", row["tg_id"])] = row
+        m[("id", row["id"])] = row
+    _cache.put(row)
+    return row
+
+def _forget(tg_id: int):
+    m = _identity.get()
+    if m is not None:
+        row = m.pop(("tg", tg_id), None)
+        if row:
+            m.pop(("id", row["id"]), None)
+    _cache.drop(tg_id)
+
+_INSERT_USER_SQL = f"""
+WITH ins AS (
+    INSERT INTO users (tg_id, referrer_id)
+    VALUES ($1, $2)
+    ON CONFLICT (tg_id) DO NOTHING
+    RETURNING referrer_id
+),{referrals.invite_ctes("ins")}
+SELECT 1
+"""
+
 async def ensure_user(tg_id: int, referrer_tg: int | None = None):
     # 1) вже існує — віддаємо як є
-    row = await fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id)
+    row = await get_user(tg_id)
     if row:
         return row
 
@@ -20,123 +177,116 @@ async def ensure_user(tg_id: int, referrer_tg: int | None = None):
     if referrer_tg and referrer_tg != tg_id:
         ref_id = await fetchval("SELECT id FROM users WHERE tg_id=$1", referrer_tg)
 
-    # 3) Акуратне вставлення: якщо запис уже створився паралельно, просто ігноруємо
-    await execute(
-        """
-        INSERT INTO users (tg_id, referrer_id)
-        VALUES ($1, $2)
-        ON CONFLICT (tg_id) DO NOTHING
-        """,
-        tg_id,
-        ref_id,
-    )
+    # 3) Акуратне вставлення: якщо запис уже створився паралельно, просто ігноруємо;
+    #    лічильники реферера — тим самим statement, тільки якщо вставка відбулась
+    await execute(_INSERT_USER_SQL, tg_id, ref_id)
 
     # 4) Повертаємо актуальний запис
-    return await fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id)
+    return _remember(await fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id))
 
 async def set_language(tg_id: int, lang: str):
-    await execute("UPDATE users SET language=$1 WHERE tg_id=$2", lang, tg_id)
+    _remember(await fetchrow(_write_through("UPDATE users SET language=$1 WHERE tg_id=$2 RETURNING *"), lang, tg_id))
 
 async def get_user(tg_id: int):
-    return await fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id)
+    m = _identity.get()
+    if m is not None and ("tg", tg_id) in m:
+        return m[("tg", tg_id)]
+    row = _cache.get(tg_id)
+    if row is not None:
+        if m is not None:
+            m[("tg", tg_id)] = m[("id", row["id"])] = row
+        return row
+    return _remember(await fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id))
+
+async def get_user_by_id(user_id: int):
+    m = _identity.get()
+    if m is not None and ("id", user_id) in m:
+        return m[("id", user_id)]
+    row = _cache.get_by_id(user_id)
+    if row is not None:
+        if m is not None:
+            m[("tg", row["tg_id"])] = m[("id", user_id)] = row
+        return row
+    return _remember(await fetchrow("SELECT * FROM users WHERE id=$1", user_id))
 
 async def get_or_create_chain(key: str):
     row = await fetchrow("SELECT * FROM chains WHERE key=$1", key)
     if row:
         return row
     await fetchrow("INSERT INTO chains (key) VALUES ($1) RETURNING id", key)
+    await catalog.notify_changed()
     return await fetchrow("SELECT * FROM chains WHERE key=$1", key)
 
 async def list_chains():
-    return await fetch("SELECT * FROM chains ORDER BY id ASC")
+    return (await catalog.get()).chains
 
 async def list_chain_steps(chain_id: int):
-    return await fetch("SELECT * FROM steps WHERE chain_id=$1 AND is_active=TRUE ORDER BY order_no ASC", chain_id)
-
-async def user_next_step(tg_id: int, chain_id: int):
-    user = await get_user(tg_id)
-    completed_ids = await fetch("SELECT step_id FROM user_steps WHERE user_id=$1", user["id"])
-    completed_set = {r["step_id"] for r in completed_ids}
-    steps = await list_chain_steps(chain_id)
-    for s in steps:
-        if s["id"] not in completed_set:
-            return s
-    return None
-
-async def get_cooldown_left(tg_id: int, chain_id: int) -> float:
-    user = await get_user(tg_id)
-    st = await fetchrow("SELECT next_available_at FROM user_chain_state WHERE user_id=$1 AND chain_id=$2", user["id"], chain_id)
-    now = datetime.now(tz=KYIV)
-    if not st:
-        return 0
-    naa = st["next_available_at"]
-    if naa is None or naa <= now:
-        return 0
-    return (naa - now).total_seconds()
-
-async def set_cooldown(tg_id: int, chain_id: int):
-    user = await get_user(tg_id)
-    naa = datetime.now(tz=KYIV) + CHAIN_COOLDOWN
-    await fetchrow("""
-        INSERT INTO user_chain_state (user_id, chain_id, next_available_at)
-        VALUES ($1,$2,$3)
-        ON CONFLICT (user_id, chain_id) DO UPDATE SET next_available_at=EXCLUDED.next_available_at
-    """, user["id"], chain_id, naa)
-
-async def award_qc(tg_id: int, qc: int):
-    await execute("""
-        UPDATE users SET balance_qc = balance_qc + $1,
-                         earned_total_qc = earned_total_qc + $1
-        WHERE tg_id=$2
-    """, qc, tg_id)
-
-async def mark_step_completed(tg_id: int, step_id: int):
-    user_id = await fetchval("SELECT id FROM users WHERE tg_id=$1", tg_id)
-    await fetchrow("INSERT INTO user_steps (user_id, step_id) VALUES ($1,$2) ON CONFLICT DO NOTHING", user_id, step_id)
-
-async def inc_today_and_check_limit(tg_id: int) -> bool:
-    # returns True if limit is OK (not exceeded)
-    now = datetime.now(tz=KYIV)
-    today = now.date()
-    row = await fetchrow("SELECT today_date, today_count FROM users WHERE tg_id=$1", tg_id)
+    ch = (await catalog.get()).by_chain.get(chain_id)
+    return ch.steps if ch else ()
+
+async def get_step(step_id: int):
+    return (await catalog.get()).by_step.get(step_id)
+
+async def get_tasks_dashboard(tg_id: int):
+    """
+    Экран «🎯 Задания» за один запрос: структура цепочек — из каталога в памяти,
+    из БД — только прогресс юзера (пройденные шаги и кулдауны).
+    Возвращает по каждой активной цепочке dict: chain_id, key, step_id, reward_qc, cooldown_sec.
+    step_id=None — цепочка пройдена (или в ней нет активных шагов).
+    """
+    cat = await catalog.get()
+    row = await fetchrow("""
+        SELECT ARRAY(SELECT step_id FROM user_steps WHERE user_id=u.id) AS done,
+               ARRAY(SELECT chain_id FROM user_chain_state
+                     WHERE user_id=u.id AND next_available_at > NOW() ORDER BY chain_id) AS cd_chains,
+               ARRAY(SELECT EXTRACT(EPOCH FROM (next_available_at - NOW()))::float FROM user_chain_state
+                     WHERE user_id=u.id AND next_available_at > NOW() ORDER BY chain_id) AS cd_secs
+        FROM users u WHERE u.tg_id=$1
+    """, tg_id)
     if not row:
-        return False
-    if row["today_date"] != today:
-        await execute("UPDATE users SET today_date=$1, today_count=0 WHERE tg_id=$2", today, tg_id)
-        count = 0
-    else:
-        count = row["today_count"]
-    if count >= DAILY_LIMIT:
-        return False
-    await execute("UPDATE users SET today_count=today_count+1, today_date=$1 WHERE tg_id=$2", today, tg_id)
-    return True
-
-async def create_invoice(user_id: int, uuid: str, link: str, amount: float):
-    await fetchrow("""
-        INSERT INTO payments (user_id, uuid, link, amount_usd, status)
-        VALUES ($1,$2,$3,$4,'created')
-        ON CONFLICT (uuid) DO NOTHING
-    """, user_id, uuid, link, amount)
-
-async def set_payment_status(uuid: str, status: str):
-    await execute("UPDATE payments SET status=$1, updated_at=NOW() WHERE uuid=$2", status, uuid)
-
-async def get_payment_by_uuid(uuid: str):
-    return await fetchrow("SELECT * FROM payments WHERE uuid=$1", uuid)
+        return []
+    done = set(row["done"])
+    cooldowns = dict(zip(row["cd_chains"], row["cd_secs"]))
 
-async def activate_user(tg_id: int):
-    await execute("UPDATE users SET status='active' WHERE tg_id=$1", tg_id)
+    items = []
+    for ch in cat.chains:
+        if not ch.is_active:
+            continue
+        nxt = next((st for st in ch.steps if st.id not in done), None)
+        items.append({
+            "chain_id": ch.id,
+            "key": ch.key,
+            "step_id": nxt.id if nxt else None,
+            "reward_qc": nxt.reward_qc if nxt else None,
+            "cooldown_sec": max(cooldowns.get(ch.id, 0), 0),
+        })
+    return items
 
-async def award_referral_if_needed(tg_id: int):
-    # Award +60 QC to referrer when this user becomes active, once.
-    u = await get_user(tg_id)
-    if not u or not u["referrer_id"]:
-        return
-    exists = await fetchrow("SELECT * FROM referral_rewards WHERE referee_id=$1", u["id"])
-    if exists:
-        return
-    ref_qc = 60
-    # Add reward
-    await execute("UPDATE users SET balance_qc=balance_qc+$1, earned_total_qc=earned_total_qc+$1 WHERE id=$2", ref_qc, u["referrer_id"])
-    await fetchrow("INSERT INTO referral_rewards (referrer_id, referee_id, awarded, awarded_at) VALUES ($1,$2,TRUE,NOW())",
-                   u["referrer_id"], u["id"])
+async def complete_step(tg_id: int, step_id: int, chain_id: int):
+    """
+    Атомарное зачисление шага за один round trip (см. qc_complete_step в schema.py).
+    outcome: ok | limit | cooldown | already_done | no_step | no_user;
+    плюс reward, new_balance, done_today, wait_sec (для cooldown).
+    """
+    today = datetime.now(tz=KYIV).date()
+    res = await fetchrow(
+        "SELECT * FROM qc_complete_step($1, $2, $3, $4, $5, $6)",
+        tg_id, step_id, chain_id, today, DAILY_LIMIT, CHAIN_COOLDOWN,
+    )
+    if res["outcome"] == "ok":
+        # обновляем снимок на месте тем, что вернула функция — без перечитывания строки
+        old = (_identity.get() or {}).get(("tg", tg_id)) or _cache.peek(tg_id)
+        if old is not None:
+            _remember(MappingProxyType({
+                **old,
+                "balance_qc": res["new_balance"],
+                "earned_total_qc": old["earned_total_qc"] + res["reward"],
+                "today_date": today,
+                "today_count": res["done_today"],
+            }))
+        else:
+            _forget(tg_id)
+    return res
+
+async def activate_user(tg_id: int):
+    _remember(await fetchrow(_write_through("UPDATE users SET status='active' WHERE tg_id=$1 RETURNING *"), tg_id))
@@ -0,0 +1,98 @@
+# app/services/update_queue.py
+"""
+Быстрый ACK для Telegram-вебхука: апдейт кладём в очередь и сразу отвечаем 200,
+обрабатывают воркеры. Шардирование по from_user.id — апдейты одного юзера идут
+строго по порядку в одном воркере, разные юзеры — параллельно.
+Очередь шарда ограничена: если полна, submit() возвращает False и вебхук отвечает 503
+(Telegram повторит доставку позже) — это и есть backpressure.
+"""
+import asyncio
+import logging
+
+from aiogram import Bot, Dispatcher
+
+log = logging.getLogger("update_queue")
+
+
+def shard_key(update: dict) -> int:
+    """from_user.id апдейта; если юзера нет (channel_post и т.п.) — chat.id, иначе update_id."""
+    for key, obj in update.items():
+        if key == "update_id" or not isinstance(obj, dict):
+            continue
+        for field in ("from", "user"):
+            u = obj.get(field)
+            if isinstance(u, dict) and u.get("id") is not None:
+                return int(u["id"])
+        chat = obj.get("chat") or (obj.get("message") or {}).get("chat")
+        if isinstance(chat, dict) and chat.get("id") is not None:
+            return int(chat["id"])
+    return int(update.get("update_id") or 0)
+
+
+class UpdateQueue:
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int, maxsize: int):
+        self.dp = dp
+        self.bot = bot
+        self.workers = max(1, workers)
+        per_shard = max(1, maxsize // self.workers)
+        self._queues = [asyncio.Queue(maxsize=per_shard) for _ in range(self.workers)]
+        self._tasks: list[asyncio.Task] = []
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        for i, q in enumerate(self._queues):
+            self._tasks.append(asyncio.create_task(self._worker(q), name=f"tg-worker-{i}"))
+        log.info("update queue started: %d workers, %d per shard", self.workers, self._queues[0].maxsize)
+
+    async def stop(self, timeout: float = 10.0):
+        # даём доработать то, что уже приняли (Telegram считает это доставленным)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            log.warning("update queue: %d updates dropped on shutdown", self.depth())
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def submit(self, update: dict) -> bool:
+        q = self._queues[shard_key(update) % self.workers]
+        try:
+            q.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "depth": self.depth(),
+            "max_shard_depth": max(q.qsize() for q in self._queues),
+            "shard_capacity": self._queues[0].maxsize,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+        }
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            update = await q.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                log.exception("update %s failed: %s", update.get("update_id"), e)
+            finally:
+                q.task_done()
@@ -0,0 +1,147 @@
+# app/services/withdrawals.py
+"""
+Очередь заявок на вывод для админки.
+
+Статусы: pending -> processed (одобрено) -> paid; из pending/processed можно в rejected.
+processed -> paying -> paid — автовыплата (services/payouts.py); paying админка не трогает,
+обратно в processed заявку возвращает только однозначный отказ провайдера или оператор.
+Страницы — keyset по id внутри статуса (частичные индексы withdrawals_pending_idx /
+withdrawals_processed_idx), так что тысяча заявок в очереди стоит столько же, сколько десять.
+Каждое действие — один statement с условием на текущий статус: повторный клик или два админа
+одновременно ничего не сломают.
+
+Деньги: сумма зарезервирована холдом при создании заявки (ledger.reserve_withdrawal).
+Отказ возвращает её проводкой withdraw_release. Выплата старой заявки без холда (до журнала)
+списывает сумму проводкой withdraw_hold в момент выплаты — только если баланс её покрывает
+(та же сумма могла уйти в новые заявки); иначе заявка не выплачивается и помечается в ответе и логе.
+"""
+import logging
+import zlib
+
+from ..db import fetch, fetchrow
+
+log = logging.getLogger("withdrawals")
+
+OPEN = ("pending", "processed")
+USERS_CHANNEL = "qc_users"  # см. tasks_service.USERS_CHANNEL
+
+
+async def page(status: str, after_id: int = 0, limit: int = 10):
+    return await fetch("""
+        SELECT w.*, u.tg_id
+        FROM withdrawals w JOIN users u ON u.id = w.user_id
+        WHERE w.status = $1 AND w.id > $2
+        ORDER BY w.id
+        LIMIT $3
+    """, status, after_id, limit)
+
+
+async def approve(wd_id: int):
+    return await fetchrow("""
+        UPDATE withdrawals SET status='processed', updated_at=NOW()
+        WHERE id=$1 AND status='pending'
+        RETURNING *
+    """, wd_id)
+
+
+def paid_ctes(cond: str) -> str:
+    """
+    CTE выплаты для встраивания в WITH: cond — условие на withdrawals (без алиасов). Дают CTE
+    wc (кандидаты: wid, ok — есть холд или баланс покрывает нарастающую сумму заявок юзера без холда),
+    w (выплаченные заявки), l (списание у старых заявок без холда) и n (NOTIFY сброса кеша юзеров).
+    """
+    return f"""
+wc AS (
+    SELECT x.id AS wid,
+           x.held OR SUM(x.amount_qc) FILTER (WHERE NOT x.held)
+                         OVER (PARTITION BY x.user_id ORDER BY x.id) <= u.balance_qc AS ok
+    FROM (
+        SELECT id, user_id, amount_qc,
+               EXISTS (SELECT 1 FROM qc_ledger h
+                       WHERE h.kind='withdraw_hold' AND h.ref_id = withdrawals.id) AS held
+        FROM withdrawals
+        WHERE {cond}
+    ) x
+    JOIN users u ON u.id = x.user_id
+),
+w AS (
+    UPDATE withdrawals SET status='paid', updated_at=NOW()
+    FROM wc
+    WHERE withdrawals.id = wc.wid AND wc.ok AND {cond}
+    RETURNING withdrawals.id, withdrawals.user_id, withdrawals.amount_qc
+),
+l AS (
+    INSERT INTO qc_ledger (user_id, amount, kind, ref_id)
+    SELECT w.user_id, -w.amount_qc, 'withdraw_hold', w.id FROM w
+    ON CONFLICT (kind, ref_id) DO NOTHING
+    RETURNING user_id
+),
+n AS (
+    SELECT pg_notify('{USERS_CHANNEL}', u.tg_id::text || ':') FROM users u JOIN l ON u.id = l.user_id
+)"""
+
+
+# Выплата списка id: по строке на кандидата; paid=FALSE — старая заявка без холда, баланса не хватает
+PAID_SQL = f"""
+WITH {paid_ctes("status = ANY($1::text[]) AND id = ANY($2::bigint[])")}
+SELECT wc.wid AS id, wc.ok, wc.wid IN (SELECT id FROM w) AS paid, (SELECT COUNT(*) FROM n) AS _n
+FROM wc
+"""
+
+
+def _flag_short(rows):
+    short = [r["id"] for r in rows if not r["ok"]]
+    if short:
+        log.warning("legacy withdrawals without hold not paid, balance too low: %s", short)
+    return short
+
+
+async def mark_paid(wd_id: int):
+    """-> строка (id, ok, paid) или None, если заявка уже не открыта. ok=False — не хватает баланса."""
+    rows = await fetch(PAID_SQL, list(OPEN), [wd_id])
+    _flag_short(rows)
+    return rows[0] if rows else None
+
+
+def page_token(ids: list[int]) -> str:
+    """Отпечаток набора id на экране — влезает в callback_data вместо самого списка."""
+    return f"{zlib.crc32(','.join(map(str, ids)).encode()):08x}"
+
+
+async def mark_page_paid(status: str, after_id: int, last_id: int, token: str) -> tuple[int, int] | None:
+    """
+    «Выплатить страницу»: ровно те заявки, что были на экране. Набор статуса status в (after_id, last_id]
+    сверяем с отпечатком страницы; если за это время туда попала новая заявка (одобрил другой админ) —
+    None, ничего не платим. Выплачиваем по списку id, так что и между проверкой и UPDATE лишнее не попадёт.
+    -> (выплачено, не выплачено из-за баланса).
+    """
+    ids = [r["id"] for r in await fetch("""
+        SELECT id FROM withdrawals
+        WHERE status = $1 AND id > $2 AND id <= $3
+        ORDER BY id
+    """, status, after_id, last_id)]
+    if not ids or page_token(ids) != token:
+        return None
+    rows = await fetch(PAID_SQL, [status], ids)
+    return sum(r["paid"] for r in rows), len(_flag_short(rows))
+
+
+async def reject(wd_id: int):
+    return await fetchrow(f"""
+        WITH w AS (
+            UPDATE withdrawals SET status='rejected', updated_at=NOW()
+            WHERE id=$1 AND status = ANY($2::text[])
+            RETURNING id, user_id, amount_qc
+        ),
+        l AS (
+            INSERT INTO qc_ledger (user_id, amount, kind, ref_id)
+            SELECT w.user_id, w.amount_qc, 'withdraw_release', w.id FROM w
+            WHERE EXISTS (SELECT 1 FROM qc_ledger h WHERE h.kind='withdraw_hold' AND h.ref_id = w.id)
+            RETURNING user_id, amount
+        ),
+        n AS (
+            SELECT pg_notify('{USERS_CHANNEL}', u.tg_id::text || ':') FROM users u JOIN l ON u.id = l.user_id
+        )
+        SELECT w.*, (SELECT amount FROM l) AS released, (SELECT COUNT(*) FROM n) AS _n
+        FROM w
+    """, wd_id, list(OPEN))
@@ -113,6 +113,12 @@ def admin_menu_kb(texts: dict) -> InlineKeyboardMarkup:
             callback_data="admin:withdraws",
         ),
     )
+    kb.row(
+        InlineKeyboardButton(
+            text=texts.get("admin_refs", "Рефералы"),
+            callback_data="admin:refs",
+        ),
+    )
     return kb.as_markup()
 
 
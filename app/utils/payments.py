@@ -1,5 +1,5 @@
 import os
-import json
+import asyncio
 import aiohttp
 import logging
 from dataclasses import dataclass
@@ -12,6 +12,57 @@ log = logging.getLogger("payments")
 MONO_BASE = "https://api.monobank.ua"
 
 
+# ===== Общие клиенты (создаются на старте, живут весь процесс)
+# Одна aiohttp-сессия с keep-alive пулом на все запросы к Mono и один AioCryptoPay
+# (он держит свою сессию) — без TLS-хендшейка на каждый экран активации.
+
+_http: aiohttp.ClientSession | None = None
+_crypto: AioCryptoPay | None = None
+
+
+async def init_clients():
+    http()
+    if settings.CRYPTO_PAY_TOKEN:
+        crypto()
+
+
+async def close_clients():
+    global _http, _crypto
+    if _crypto is not None:
+        await _crypto.close()
+        _crypto = None
+    if _http is not None:
+        await _http.close()
+        _http = None
+
+
+def http() -> aiohttp.ClientSession:
+    # лениво — на случай вызова до init_clients() (скрипты, тесты)
+    global _http
+    if _http is None or _http.closed:
+        _http = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=settings.HTTP_TIMEOUT, connect=settings.HTTP_CONNECT_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=settings.HTTP_POOL_SIZE, ttl_dns_cache=300, keepalive_timeout=60),
+        )
+    return _http
+
+
+def crypto() -> AioCryptoPay:
+    global _crypto
+    if _crypto is None:
+        _crypto = AioCryptoPay(token=settings.CRYPTO_PAY_TOKEN, network=_crypto_network())
+    return _crypto
+
+
+async def crypto_call(coro):
+    """
+    Вызов AioCryptoPay с тем же лимитом, что у общей сессии (HTTP_TIMEOUT): свою сессию клиент
+    создаёт сам и таймаут туда не передать, а зависший CryptoBot не должен держать создание инвойсов,
+    прогрев, сверку и выплаты. По истечении — asyncio.TimeoutError.
+    """
+    return await asyncio.wait_for(coro, settings.HTTP_TIMEOUT)
+
+
 # ===== Helpers
 
 def usd_to_uah_cop(usd: float) -> int:
@@ -56,13 +107,12 @@ async def create_monopay_invoice(order_id: str, description: str = "Activation")
         # редирект — опционально (можно на твою страницу «спасибо»)
         # "redirectUrl": (settings.WEBHOOK_URL or "").rstrip("/") + "/paid",
         "paymentType": "debit",
-        "validityDuration": 86400,       # 24h, опционально
+        "validityDuration": settings.INVOICE_TTL_SEC,  # совпадает с payments.expires_at
     }
 
-    async with aiohttp.ClientSession() as s:
-        async with s.post(f"{MONO_BASE}/api/merchant/invoice/create",
-                          json=payload, headers=headers, timeout=30) as r:
-            data = await r.json()
+    async with http().post(f"{MONO_BASE}/api/merchant/invoice/create",
+                           json=payload, headers=headers) as r:
+        data = await r.json()
     log.info("Mono create_invoice resp: %s", data)
 
     invoice_id = data.get("invoiceId") or data.get("invoice_id", "")
@@ -83,24 +133,33 @@ async def create_cryptobot_invoice(order_id: str, description: str = "Activation
     Создаёт инвойс в CryptoBot в фиате USD.
     Возвращает bot_invoice_url.
     """
-    crypto = AioCryptoPay(token=settings.CRYPTO_PAY_TOKEN, network=_crypto_network())
-    inv = await crypto.create_invoice(
+    inv = await crypto_call(crypto().create_invoice(
         currency_type="fiat",
         fiat="USD",
         amount=float(settings.PRICE_USD),
         description=description,
         payload=order_id,
-    )
-    await crypto.close()
+        expires_in=settings.INVOICE_TTL_SEC,
+    ))
     return Invoice("cryptobot", str(inv.invoice_id), inv.bot_invoice_url, extra={"status": inv.status})
 
+async def get_cryptobot_invoices(invoice_ids: list[str]) -> list:
+    """
+    Пачка инвойсов CryptoBot одним запросом (getInvoices принимает до 1000 id).
+    """
+    if not invoice_ids:
+        return []
+    ids = [int(i) for i in invoice_ids]
+    items = await crypto_call(crypto().get_invoices(invoice_ids=ids, count=len(ids)))
+    if items is None:
+        return []
+    return items if isinstance(items, list) else [items]
+
 async def get_cryptobot_invoice(invoice_id: str):
     """
     Получить инфо по инвойсу CryptoBot (по id).
     """
-    crypto = AioCryptoPay(token=settings.CRYPTO_PAY_TOKEN, network=_crypto_network())
-    items = await crypto.get_invoices(invoice_ids=[int(invoice_id)])
-    await crypto.close()
+    items = await crypto_call(crypto().get_invoices(invoice_ids=[int(invoice_id)]))
     return items[0] if items else None
 
 
@@ -0,0 +1,48 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Простой token bucket для asyncio: rate токенов в секунду, не больше capacity про запас.
+    acquire() ждёт, пока токен появится (очередь — через lock, по порядку прихода).
+    pause() — «заморозить» ведро, например на время RetryAfter от Telegram.
+    """
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        if rate <= 0:
+            raise ValueError(f"TokenBucket rate must be > 0, got {rate!r}")
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1.0))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        # ведро пустое, копить начинаем только после паузы: иначе сразу после RetryAfter
+        # ушёл бы полный capacity, накопленный за паузу
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+        self._updated = self._paused_until
+
+    async def acquire(self, tokens: float = 1.0) -> float:
+        """Возвращает, сколько секунд пришлось ждать (0 — без троттлинга)."""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    delay = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= tokens:
+                        self._tokens -= tokens
+                        return waited
+                    delay = (tokens - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
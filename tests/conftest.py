@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+# Тести з Postgres створюють і видаляють тимчасові бази — тільки на окремому сервері з TEST_DATABASE_URL,
+# ніколи з DATABASE_URL застосунку. Settings вистачає заглушок.
+os.environ.setdefault("BOT_TOKEN", "test")
+os.environ.setdefault("DATABASE_URL", "postgresql://test/test")
+
+
+@pytest.fixture
+def pg_dsn():
+    dsn = os.environ.get("TEST_DATABASE_URL")
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    return dsn
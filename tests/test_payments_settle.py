@@ -0,0 +1,100 @@
+"""
+settle_pending: вебхук, що обігнав INSERT у payments, не губиться — подія повторюється з бекофом,
+поки платіж не з'явиться, і стає failed лише після SETTLE_MAX_ATTEMPTS.
+"""
+import asyncio
+import json
+
+import pytest
+
+from app.services import payments_service
+from app.services.payments_service import SETTLE_MAX_ATTEMPTS, settle_pending
+
+
+class Inbox:
+    def __init__(self):
+        self.events: dict[int, dict] = {}
+        self.payments: set[str] = set()  # uuid платежів, що вже лежать у payments
+        self.settled: list[str] = []
+
+    def add(self, event_id: int, provider: str, payload: dict):
+        self.events[event_id] = {"id": event_id, "provider": provider, "payload": json.dumps(payload),
+                                 "status": "new", "attempts": 0, "due": True, "last_error": None}
+
+    async def fetch(self, query, batch, lease):
+        rows = []
+        for e in sorted(self.events.values(), key=lambda e: e["id"]):
+            if e["status"] == "new" and e["due"] and len(rows) < batch:
+                e["attempts"] += 1
+                e["due"] = False
+                rows.append(dict(e))
+        return rows
+
+    async def execute(self, query, *args):
+        if "status='done'" in query:
+            for i in args[0]:
+                self.events[i].update(status="done", last_error=None)
+        elif "status='failed'" in query:
+            self.events[args[0]].update(status="failed", last_error=args[1])
+        else:  # retry: next_attempt_at = NOW() + backoff
+            self.events[args[0]]["last_error"] = args[1]
+        return "UPDATE 1"
+
+    async def settle_payment(self, provider, keys):
+        uuid = next((k for k in keys if k in self.payments), None)
+        if uuid is None:
+            return None
+        self.settled.append(uuid)
+        return {"payment_id": 1, "user_id": 1, "tg_id": 1, "ref_tg": None, "notification_id": None}
+
+    def tick(self):
+        """Бекоф минув."""
+        for e in self.events.values():
+            e["due"] = True
+
+
+@pytest.fixture
+def inbox(monkeypatch):
+    mem = Inbox()
+    monkeypatch.setattr(payments_service, "fetch", mem.fetch)
+    monkeypatch.setattr(payments_service, "execute", mem.execute)
+    monkeypatch.setattr(payments_service, "settle_payment", mem.settle_payment)
+    return mem
+
+
+def _paid(invoice_id: str) -> dict:
+    return {"update_id": 1, "update_type": "invoice_paid", "payload": {"invoice_id": invoice_id}}
+
+
+def test_webhook_before_payment_row_is_retried(inbox):
+    inbox.add(1, "cryptobot", _paid("555"))
+
+    asyncio.run(settle_pending())
+    assert inbox.events[1]["status"] == "new"
+    assert "PaymentNotFound" in inbox.events[1]["last_error"]
+
+    inbox.payments.add("555")  # INSERT у payments нарешті закомітився
+    inbox.tick()
+    asyncio.run(settle_pending())
+    assert inbox.events[1]["status"] == "done"
+    assert inbox.settled == ["555"]
+
+
+def test_unknown_invoice_fails_after_max_attempts(inbox):
+    inbox.add(1, "monopay", {"invoiceId": "mono-1", "status": "success"})
+
+    for _ in range(SETTLE_MAX_ATTEMPTS - 1):
+        asyncio.run(settle_pending())
+        inbox.tick()
+        assert inbox.events[1]["status"] == "new"
+    asyncio.run(settle_pending())
+    assert inbox.events[1]["status"] == "failed"
+    assert inbox.events[1]["attempts"] == SETTLE_MAX_ATTEMPTS
+    assert not inbox.settled
+
+
+def test_non_payment_updates_are_done(inbox):
+    inbox.add(1, "monopay", {"invoiceId": "mono-1", "status": "processing"})
+
+    asyncio.run(settle_pending())
+    assert inbox.events[1]["status"] == "done"
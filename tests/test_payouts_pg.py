@@ -0,0 +1,183 @@
+"""
+run_batch проти справжньої схеми Postgres: SQL воркера (черга, claim, done/retry/failed/unknown) виконується як є.
+Кожен тест — в окремій тимчасовій базі (потрібне право CREATEDB), яку наприкінці видаляємо.
+Без TEST_DATABASE_URL тести з базою пропускаються.
+"""
+import asyncio
+import uuid
+
+import asyncpg
+import pytest
+
+from app import db, schema
+from app.config import settings
+from app.services import ledger, payouts, withdrawals
+from app.services.payouts import FakePayoutProvider, PayoutProvider, run_batch
+
+
+@pytest.fixture
+def pg(pg_dsn, monkeypatch):
+    monkeypatch.setattr(settings, "PAYOUT_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr(settings, "PAYOUT_BATCH", 10)
+    monkeypatch.setattr(settings, "PAYOUT_CONCURRENCY", 2)
+
+    async def run(scenario):
+        name = f"qc_test_{uuid.uuid4().hex[:12]}"
+        con = await asyncpg.connect(pg_dsn)
+        await con.execute(f"CREATE DATABASE {name}")
+        try:
+            db._pool = await asyncpg.create_pool(pg_dsn, database=name, min_size=1, max_size=3)
+            try:
+                # як on_startup у main.py
+                await schema.ensure_schema()
+                await schema.run_stars_migration()
+                await schema.run_payments_migration()
+                await schema.run_referrals_migration()
+                await schema.run_broadcast_migration()
+                await scenario()
+            finally:
+                await db.close()
+        finally:
+            await con.execute(f"DROP DATABASE {name}")
+            await con.close()
+
+    return lambda scenario: asyncio.run(run(scenario))
+
+
+async def _withdrawal(tg_id: int, amount_qc: int = 10_000, approve: bool = True, code: str = "cryptobot") -> int:
+    """Юзер з балансом, заявка з холдом (за замовчуванням — на @CryptoBot); approve — одразу processed."""
+    user_id = await db.fetchval("INSERT INTO users (tg_id) VALUES ($1) RETURNING id", tg_id)
+    await db.execute("INSERT INTO qc_ledger (user_id, amount, earned_delta, kind) VALUES ($1, $2, $2, 'admin')",
+                     user_id, amount_qc)
+    wd = await ledger.reserve_withdrawal(tg_id, amount_qc, "UA", code, "wallet", code)
+    if approve:
+        assert await withdrawals.approve(wd["id"])
+    return wd["id"]
+
+
+async def _state(wd_id: int):
+    return await db.fetchrow("""
+        SELECT w.status AS wd, p.status, p.attempts, p.external_id
+        FROM withdrawals w LEFT JOIN payouts p ON p.withdrawal_id = w.id
+        WHERE w.id = $1
+    """, wd_id)
+
+
+async def _due():
+    """Backoff і аренда минули."""
+    await db.execute("UPDATE payouts SET next_attempt_at = NOW()")
+
+
+def test_provider_interface_is_abstract():
+    with pytest.raises(TypeError):
+        PayoutProvider()
+
+
+def test_batch_pays_approved_withdrawals(pg):
+    async def scenario():
+        a = await _withdrawal(101)
+        b = await _withdrawal(102, 20_000)
+        pending = await _withdrawal(103, approve=False)
+        address = await _withdrawal(104, code="crypto")  # крипта на адресу — вручну
+        typed = await _withdrawal(105, code=None)
+        provider = FakePayoutProvider(fail_rate=0)
+
+        assert await run_batch(provider) == 2
+        assert dict(await _state(a)) == {"wd": "paid", "status": "done", "attempts": 1, "external_id": f"fake-wd-{a}"}
+        assert (await _state(b))["wd"] == "paid"
+        for wd in (pending, address, typed):
+            assert (await _state(wd))["status"] is None
+        assert (await _state(address))["wd"] == "processed"
+        assert await db.fetchval("SELECT amount FROM payouts WHERE withdrawal_id=$1", b) == 100  # 20000 * 0.005
+        # повторний прохід нічого не платить вдруге
+        await _due()
+        assert await run_batch(provider) == 0
+        assert provider.calls == 2
+
+    pg(scenario)
+
+
+def test_lost_reply_is_retried_with_same_spend_id(pg):
+    async def scenario():
+        wd = await _withdrawal(101)
+        provider = FakePayoutProvider(fail_rate=0)
+        provider.script = ["lost"]
+
+        await run_batch(provider)
+        assert dict(await _state(wd)) == {"wd": "paying", "status": "retry", "attempts": 1, "external_id": None}
+        # адмінка не може ні відхилити, ні виплатити заявку в paying
+        assert await withdrawals.mark_paid(wd) is None
+
+        assert await run_batch(provider) == 0  # backoff ще не минув
+        await _due()
+        await run_batch(provider)
+        assert dict(await _state(wd)) == {"wd": "paid", "status": "done", "attempts": 2, "external_id": f"fake-wd-{wd}"}
+        assert provider.calls == 2 and list(provider.sent) == [f"wd-{wd}"]
+
+    pg(scenario)
+
+
+def test_first_attempt_rejection_returns_withdrawal_to_admin(pg):
+    async def scenario():
+        wd = await _withdrawal(101)
+        provider = FakePayoutProvider(fail_rate=0)
+        provider.script = ["reject"]
+
+        await run_batch(provider)
+        assert dict(await _state(wd)) == {"wd": "processed", "status": "failed", "attempts": 1, "external_id": None}
+        # failed більше не ставиться в чергу
+        await _due()
+        assert await run_batch(provider) == 0
+        assert not provider.sent
+
+    pg(scenario)
+
+
+def test_exhausted_attempts_stay_paying_until_resolved(pg):
+    async def scenario():
+        wd = await _withdrawal(101)
+        provider = FakePayoutProvider(fail_rate=0)
+        provider.script = ["error"] * settings.PAYOUT_MAX_ATTEMPTS
+
+        for _ in range(settings.PAYOUT_MAX_ATTEMPTS):
+            assert await run_batch(provider) == 1
+            await _due()
+        assert dict(await _state(wd)) == {"wd": "paying", "status": "unknown",
+                                          "attempts": settings.PAYOUT_MAX_ATTEMPTS, "external_id": None}
+        assert await run_batch(provider) == 0
+        assert provider.calls == settings.PAYOUT_MAX_ATTEMPTS
+
+        assert await payouts.resolve(wd, paid=True)
+        assert (await _state(wd))["wd"] == "paid"
+
+    pg(scenario)
+
+
+def test_expired_lease_after_last_attempt_is_unknown(pg):
+    async def scenario():
+        wd = await _withdrawal(101)
+        provider = FakePayoutProvider(fail_rate=0)
+        await run_batch(provider)
+        # процес упав посеред останньої спроби: sending з вичерпаними спробами
+        await db.execute("UPDATE withdrawals SET status='paying' WHERE id=$1", wd)
+        await db.execute("UPDATE payouts SET status='sending', attempts=$1", settings.PAYOUT_MAX_ATTEMPTS)
+        await _due()
+
+        assert await run_batch(provider) == 0
+        assert (await _state(wd))["status"] == "unknown"
+
+    pg(scenario)
+
+
+def test_canceled_when_admin_closed_request_first(pg):
+    async def scenario():
+        wd = await _withdrawal(101)
+        provider = FakePayoutProvider(fail_rate=0)
+        await db.execute(payouts.ENQUEUE_SQL, "fake", "USDT", 0.005, 10)
+        await db.execute("UPDATE withdrawals SET status='rejected' WHERE id=$1", wd)
+
+        assert await run_batch(provider) == 0
+        assert dict(await _state(wd)) == {"wd": "rejected", "status": "canceled", "attempts": 0, "external_id": None}
+        assert provider.calls == 0
+
+    pg(scenario)